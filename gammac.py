@@ -21,22 +21,40 @@
 
 from __future__ import print_function
 
-import sys, signal, datetime, socket, argparse, json
+import os, sys, time, signal, datetime, socket, argparse, json
+import gc_wire as wire
+import gc_transport as fragmentation
 
 exit_dump = False
 
+reassembler = fragmentation.Reassembler()
+
 def signalHandler(signal, frame):
 
     global exit_dump
     exit_dump = True
 
+def receive(skt, bufsiz):
+
+    # Read datagrams until a complete message has arrived
+    while True:
+        data, server = skt.recvfrom(bufsiz)
+        data = reassembler.add(data, server)
+        if data is not None:
+            return data, server
+
 def handleOneResponse(skt, timeout, bufsiz):
 
     skt.settimeout(timeout)
 
     try:
-        data, server = skt.recvfrom(bufsiz)
-        print("received %s" % json.loads(data.decode("utf-8")))
+        # Progress reports come before the response proper
+        while True:
+            data, server = receive(skt, bufsiz)
+            response = wire.decode(data)
+            print("received %s" % response)
+            if not response['command'].endswith('_progress'):
+                break
 
     except socket.timeout:
         print("Timeout waiting for response")
@@ -44,27 +62,238 @@ def handleOneResponse(skt, timeout, bufsiz):
     except socket.error as err:
         print("Interrupted")
 
-def handleResponses(skt, timeout, bufsiz):
+def handleSubscription(skt, timeout, bufsiz, msg, address):
 
+    # Repeat the subscribe request as a heartbeat every timeout seconds. A
+    # reliable subscription acknowledges every spectrum
     global exit_dump
     skt.settimeout(timeout)
+    heartbeat = time.time() + timeout
+    session_name = None
+    acked = -1 # Every index up to this one has arrived
+    received = set() # Indices above acked
 
     while not exit_dump:
         try:
-            data, server = skt.recvfrom(bufsiz)
-            print("received %s" % json.loads(data.decode("utf-8")))
+            if time.time() >= heartbeat:
+                skt.sendto(bytes(json.dumps(msg)), address)
+                heartbeat = time.time() + timeout
+            data, server = receive(skt, bufsiz)
+            response = wire.decode(data)
+            if response['command'] == 'spectrum_aggregate':
+                print("received %s %d from %s, %.1f cps over %d spectrums, %s" % (response['command'], response['index'],
+                    response.get('detector_id'), response['count_rate'], response['window'], ', '.join("%s %.1f cps" % (roi['name'], roi['rate']) for roi in response['rois'])))
+            elif response['command'] in ('spectrum', 'spectrum_summary'):
+                print("received %s %d from %s, total count %d" % (response['command'], response['index'], response.get('detector_id'),
+                    response['total_count']))
+                if msg.get('reliable', False):
+                    if response['session_name'] != session_name:
+                        session_name, acked, received = response['session_name'], -1, set()
+                    if response['index'] > acked:
+                        received.add(response['index'])
+                    while acked + 1 in received:
+                        acked += 1
+                        received.remove(acked)
+                    skt.sendto(bytes(json.dumps({'command': "spectrum_ack", 'session_name': session_name,
+                        'ack': acked, 'sack': sorted(received)[-64:]})), address)
+            else:
+                print("received %s" % response)
 
         except socket.error as err:
             pass
 
+    msg['command'] = "unsubscribe"
+    skt.sendto(bytes(json.dumps(msg)), address)
+
+def saveDumpProgress(path, state, next_chunk):
+
+    with open(path + '.dump', 'w') as f:
+        json.dump({'session_name': state['session_name'], 'snapshot': state['snapshot'],
+            'chunk_size': state['chunk_size'], 'offset': next_chunk}, f)
+
+def handleDump(skt, timeout, bufsiz, msg, address, output):
+
+    # Write the session database to output. Progress is kept next to it, so an
+    # interrupted dump resumes where it stopped
+    global exit_dump
+    skt.settimeout(timeout)
+    skt.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    bufsiz = max(bufsiz, 65536)
+    state = None # The dump_session_success response
+    f = None
+    next_chunk = 0
+    started = time.time()
+
+    try:
+        while not exit_dump:
+            try:
+                data, server = receive(skt, bufsiz)
+
+                if fragmentation.isChunk(data):
+                    if state is None:
+                        continue
+                    try:
+                        snapshot, index, chunk = fragmentation.decodeChunk(data)
+                    except ValueError as err:
+                        print(err)
+                        continue
+                    if snapshot != state['snapshot']:
+                        continue
+                    # Chunks out of order are dropped and sent again
+                    if index == next_chunk:
+                        f.seek(index * state['chunk_size'])
+                        f.write(chunk)
+                        next_chunk += 1
+                        if next_chunk % 64 == 0:
+                            saveDumpProgress(output, state, next_chunk)
+                    skt.sendto(bytes(json.dumps({'command': "dump_ack", 'snapshot': state['snapshot'], 'ack': next_chunk})), address)
+                    continue
+
+                response = wire.decode(data)
+                if response['command'] == 'dump_session_success':
+                    state = response
+                    output = output or state['session_name'] + '.db'
+                    next_chunk = state['offset']
+                    if f is not None:
+                        f.close()
+                    f = open(output, 'r+b' if next_chunk > 0 and os.path.isfile(output) else 'wb')
+                    print("dumping session %s to %s, %d bytes in %d chunks from chunk %d" % (state['session_name'], output,
+                        state['size'], state['chunks'], next_chunk))
+                    saveDumpProgress(output, state, next_chunk)
+
+                elif response['command'] == 'dump_session_complete':
+                    if state is not None and response['snapshot'] == state['snapshot']:
+                        f.truncate(response['size'])
+                        f.close()
+                        f = None
+                        os.remove(output + '.dump')
+                        elapsed = time.time() - started
+                        print("dump complete, %d bytes in %.1f seconds, %.0f kB/s" % (response['size'], elapsed, response['size'] / elapsed / 1024.0))
+                        return
+
+                else:
+                    print("received %s" % response)
+                    if response['command'] == 'error' or response['command'].startswith('dump_session_'):
+                        return
+
+            except socket.timeout:
+                if state is not None:
+                    print("Timeout waiting for chunks, resuming at chunk %d" % next_chunk)
+                    msg.update(session_name=state['session_name'], snapshot=state['snapshot'],
+                        chunk_size=state['chunk_size'], offset=next_chunk)
+                else:
+                    print("Timeout waiting for response, retrying")
+                skt.sendto(bytes(json.dumps(msg)), address)
+
+            except socket.error as err:
+                pass
+    finally:
+        if f is not None:
+            f.close()
+            saveDumpProgress(output, state, next_chunk)
+
+def handleMetrics(skt, timeout, bufsiz):
+
+    skt.settimeout(timeout)
+
+    try:
+        data, server = receive(skt, bufsiz)
+        response = wire.decode(data)
+        if response['command'] != 'get_metrics_success':
+            print("received %s" % response)
+            return
+
+        print("uptime %.0f s" % response['uptime'])
+        for name, count in sorted(response.get('counters', {}).items()):
+            print("%-20s %8d" % (name, count))
+        print("%-20s %8s %8s %10s %10s %10s" % ('name', 'count', 'errors', 'p50 ms', 'p99 ms', 'max ms'))
+        for name, timer in sorted(response['timers'].items()):
+            print("%-20s %8d %8d %10.3f %10.3f %10.3f" % (name, timer['count'], timer['errors'],
+                timer['p50'] * 1e3, timer['p99'] * 1e3, timer['max'] * 1e3))
+
+    except socket.timeout:
+        print("Timeout waiting for response")
+
+    except socket.error as err:
+        print("Interrupted")
+
+def handleList(skt, timeout, bufsiz):
+
+    skt.settimeout(timeout)
+
+    try:
+        data, server = receive(skt, bufsiz)
+        response = wire.decode(data)
+        if response['command'] != 'list_sessions_success':
+            print("received %s" % response)
+            return
+
+        for entry in response['sessions']:
+            print("%-32s %-24s %8d spectrums %10d counts %10d bytes%s" % (entry['name'], entry['start_time'] or '-',
+                entry['spectrums'], entry['total_count'], entry['file_size'], " running" if entry['running'] else ""))
+        print("sessions %d to %d of %d" % (response['offset'] + 1, response['offset'] + len(response['sessions']), response['total']))
+
+    except socket.timeout:
+        print("Timeout waiting for response")
+
+    except socket.error as err:
+        print("Interrupted")
+
+def handleSync(skt, timeout, bufsiz, msg, address):
+
+    # Resume from the last received index if the stream stalls
+    global exit_dump
+    skt.settimeout(timeout)
+
+    while not exit_dump:
+        try:
+            data, server = receive(skt, bufsiz)
+            response = wire.decode(data)
+            if response['command'] == 'spectrum':
+                print("received spectrum %d" % response['index'])
+                msg['resume_index'] = response['index']
+            else:
+                print("received %s" % response)
+                if response['command'] in ('sync_session_complete', 'error'):
+                    return
+
+        except socket.timeout:
+            print("Timeout waiting for spectrums, resuming after index %d" % msg['resume_index'])
+            skt.sendto(bytes(json.dumps(msg)), address)
+
+        except socket.error as err:
+            pass
+
+def parseRoi(value):
+
+    try:
+        name, start, end = value.split(':')
+        return {'name': name, 'start': int(start), 'end': int(end)}
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected NAME:START:END, got %s" % value)
+
 def main():
 
     signal.signal(signal.SIGINT, signalHandler)
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('mode', help = "Possible values are: config, start, stop, dump")
+    parser.add_argument('mode', help = "Possible values are: config, start, stop, dump, status, metrics, sync, subscribe, list")
     parser.add_argument('--session', help = "Name of session to operate on")
     parser.add_argument('--ip', default = '127.0.0.1:9999', help = "IP address and port of remote peer. Default 127.0.0.1:9999")
+    parser.add_argument('--last-index', type = int, default = -1, help = "Sync spectrums after this index. Default -1")
+    parser.add_argument('--wire-format', default = wire.FORMAT_JSON, choices = wire.FORMATS, help = "Format of spectrum messages requested by config, start and sync. Default json")
+    parser.add_argument('--mtu', type = int, help = "Largest datagram sent by the daemon, longer messages are fragmented. Default unlimited")
+    parser.add_argument('--output', help = "File the dump mode writes the session database to. Default <session>.db")
+    parser.add_argument('--stream', default = 'full', choices = ('full', 'summary'), help = "Live stream to subscribe to, summaries carry no channels. Default full")
+    parser.add_argument('--reliable', action = 'store_true', help = "Acknowledge spectrums so lost ones are sent again")
+    parser.add_argument('--multicast', help = "Subscribe this multicast group:port instead of the client address")
+    parser.add_argument('--aggregate', action = 'store_true', help = "Have start aggregate the session into spectrum_aggregate messages, implied by --roi")
+    parser.add_argument('--aggregate-channels', action = 'store_true', help = "Subscribe to the accumulated spectrum along with spectrum_aggregate messages")
+    parser.add_argument('--aggregate-window', type = int, default = 10, help = "Spectrums in the rolling sums of spectrum_aggregate messages. Default 10")
+    parser.add_argument('--aggregate-interval', type = float, default = 1.0, help = "Seconds between spectrum_aggregate messages, 0 disables them. Default 1")
+    parser.add_argument('--roi', type = parseRoi, action = 'append', default = [], help = "Region of interest NAME:START:END in channels, may be repeated")
+    parser.add_argument('--offset', type = int, default = 0, help = "Sessions to skip in list mode. Default 0")
+    parser.add_argument('--limit', type = int, default = 20, help = "Sessions shown by list mode. Default 20")
     parser.add_argument('--timeout', type = int, default = 5, help = "Receive timeout for responses in seconds. Default 5")
     parser.add_argument('--buffersize', type = int, default = 8192, help = "Size of response buffer in bytes. Default 8192")
     args = parser.parse_args()
@@ -84,7 +313,9 @@ def main():
             'fine_gain': 1.375,
             'num_channels': 1024,
             'lld': 3,
-            'uld': 110
+            'uld': 110,
+            'wire_format': args.wire_format,
+            'mtu': args.mtu
         }
         args.timeout = 30
         responseFunc = handleOneResponse
@@ -96,10 +327,13 @@ def main():
             'ip': ip,
             'session_name': session_name,
             'comment': "gammac",
+            'wire_format': args.wire_format,
             'livetime': 2,
             'detector_data': '{"TypeName":"NaI-2x2","CurrentHV":691,"CurrentNumChannels":1024,"Serialnumber":"CP-932","CurrentCoarseGain":1.0,"CurrentFineGain":2.647,"CurrentLivetime":2,"CurrentLLD":3,"CurrentULD":110,"EnergyCurveCoefficients":[-16.322600665547952,1.5798230485869882,2.5686852946056607E-07,-2.0953782940494292E-07]}',
             'detector_type_data': '{"Name":"NaI-2x2","MaxNumChannels":2048,"MinHV":1,"MaxHV":1300,"GEScript":"Nai-2tom.py"}'
         }
+        if args.aggregate or args.roi:
+            msg['aggregate'] = {'window': args.aggregate_window, 'interval': args.aggregate_interval, 'rois': args.roi}
         responseFunc = handleOneResponse
 
     elif args.mode == 'stop':
@@ -110,14 +344,45 @@ def main():
             responseFunc = handleOneResponse
 
     elif args.mode == 'dump':
-        msg = { 'command': "dump_session" }
-        args.timeout = 30
-        responseFunc = handleResponses
+        msg = { 'command': "dump_session", 'mtu': args.mtu }
+        output = args.output or (args.session + '.db' if args.session else None)
+        if args.session:
+            msg['session_name'] = args.session
+            # Resume an interrupted dump
+            if os.path.isfile(output + '.dump'):
+                with open(output + '.dump') as f:
+                    msg.update(json.load(f))
+        responseFunc = lambda skt, timeout, bufsiz: handleDump(skt, timeout, bufsiz, msg, address, output)
+
+    elif args.mode == 'sync':
+        if args.session is None:
+            print('Missing session argument')
+        else:
+            msg = { 'command': "sync_session", 'session_name': args.session, 'indices_list': [],
+                'last_index': args.last_index, 'resume_index': -1, 'wire_format': args.wire_format, 'mtu': args.mtu }
+            responseFunc = lambda skt, timeout, bufsiz: handleSync(skt, timeout, bufsiz, msg, address)
 
     elif args.mode == 'status':
         msg = { 'command': "get_status" }
         responseFunc = handleOneResponse
 
+    elif args.mode == 'subscribe':
+        msg = { 'command': "subscribe", 'stream': args.stream, 'timeout': 3 * args.timeout,
+            'reliable': args.reliable, 'aggregate_channels': args.aggregate_channels, 'wire_format': args.wire_format, 'mtu': args.mtu }
+        if args.multicast:
+            msg['address'] = args.multicast
+        responseFunc = lambda skt, timeout, bufsiz: handleSubscription(skt, timeout, bufsiz, msg, address)
+
+    elif args.mode == 'list':
+        msg = { 'command': "list_sessions", 'offset': args.offset, 'limit': args.limit, 'mtu': args.mtu }
+        if args.session:
+            msg['name'] = args.session
+        responseFunc = handleList
+
+    elif args.mode == 'metrics':
+        msg = { 'command': "get_metrics" }
+        responseFunc = handleMetrics
+
     else:
         print("Invalid options")
         os.exit(1)
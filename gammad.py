@@ -21,262 +21,987 @@
 
 from __future__ import print_function
 
-import os, sys, json, threading, importlib
+import os, sys, json, time, importlib
 
 from twisted.internet import reactor, threads, defer, task
 from twisted.internet.protocol import DatagramProtocol
-from twisted.python import log
+from twisted.python import log, failure
+from twisted.python.threadpool import ThreadPool
 
 import gc_gps as gps
 import gc_database as database
+import gc_wire as wire
+import gc_sync as sync
+import gc_metrics as metrics
+import gc_subscribers as subscribers
+import gc_reliable as reliable
+import gc_dump as dump
+import gc_aggregate as aggregate
+import gc_process as process
+import gc_journal as journal
 from gc_exceptions import ProtocolError
 
-log.startLogging(sys.stdout)
-
 class SessionState: Ready, Busy = range(2)
 
 class SpectrumState: Ready, Busy = range(2)
 
-class DetectorState: Cold, Warm = range(2)
+class DetectorState: Cold, Warming, Warm = range(3)
+
+# Seconds between detector_config_progress messages while a detector warms up
+PROGRESS_INTERVAL = 2.0
+
+# Commands that change plugin state, only one may run at a time
+LIFECYCLE_COMMANDS = ('detector_config', 'start_session', 'stop_session')
+
+_number = (int, long, float)
+
+# Seconds between checks for expired subscriptions
+EXPIRE_INTERVAL = 5.0
+
+# Command handlers and the keys, with types, their messages must carry
+COMMANDS = {
+    'detector_config': ('handleDetectorConfig', (('detector_data', dict), )),
+    'start_session': ('handleStartSession', (('session_name', basestring), ('ip', basestring), ('comment', basestring), ('livetime', _number))),
+    'stop_session': ('handleStopSession', (('session_name', basestring), )),
+    'dump_session': ('handleDumpSession', ()),
+    'get_status': ('handleGetStatus', ()),
+    'get_metrics': ('handleGetMetrics', ()),
+    'list_sessions': ('handleListSessions', ()),
+    'subscribe': ('handleSubscribe', ()),
+    'unsubscribe': ('handleUnsubscribe', ()),
+    'spectrum_ack': ('handleSpectrumAck', (('session_name', basestring), ('ack', _number))),
+    'dump_ack': ('handleDumpAck', (('snapshot', _number), ('ack', _number))),
+    'sync_session': ('handleSyncSession', (('session_name', basestring), ('indices_list', list), ('last_index', _number)))
+}
+
+def describe(cmd):
+    return cmd.replace('_', ' ').capitalize()
+
+def validate(cmd, msg, schema):
+
+    for key, types in schema:
+        if not key in msg:
+            raise ProtocolError('error', "%s failed, %s missing" % (describe(cmd), key))
+        if not isinstance(msg[key], types):
+            raise ProtocolError('error', "%s failed, invalid %s" % (describe(cmd), key))
+
+def detectorConfigs(detector_data):
+    """
+    Return (detector id, configuration) of the detectors in detector_data,
+    either a list under 'detectors' or a single detector. Detector ids default
+    to the plugin name and must be unique
+    """
+    configs = detector_data.get('detectors', [detector_data])
+    if not isinstance(configs, list) or not configs:
+        raise ProtocolError('detector_config_error', "Detector config failed, detectors must be a non-empty list")
+    result = []
+    for config in configs:
+        if not isinstance(config, dict) or not isinstance(config.get('plugin_name'), basestring):
+            raise ProtocolError('detector_config_error', "Detector config failed, plugin_name missing")
+        detector_id = config.get('detector_id', config['plugin_name'])
+        if not isinstance(detector_id, basestring) or detector_id in [r[0] for r in result]:
+            raise ProtocolError('detector_config_error', "Detector config failed, detector_id must be unique")
+        result.append((detector_id, config))
+    return result
+
+def gather(deferreds):
+    """
+    Return a Deferred firing with the results of deferreds, or with the first
+    failure among them
+    """
+    d = defer.gatherResults(deferreds, consumeErrors=True)
+    d.addErrback(lambda err: err.value.subFailure)
+    return d
+
+class DetectorWorker(object):
+    """
+    One configured detector and the thread its calls run on
+    """
+    def __init__(self, detector_id, plugin_name, detector, config):
+        self.detector_id = detector_id
+        self.plugin_name = plugin_name
+        self.detector = detector
+        self.config = config
+        self.spectrum_state = SpectrumState.Ready
+        self.spectrum_index = 0 # Index of the next spectrum of this detector
+        self.spectrum_failures = 0
+        self.livetime = 0.0
+        # Detectors acquire in parallel, but calls to one detector run one at
+        # a time, so plugins need not be thread safe
+        self.pool = ThreadPool(1, 1, 'detector-%s' % detector_id)
+        self.pool.start()
+
+    def call(self, f, *args):
+        return threads.deferToThreadPool(reactor, self.pool, f, *args)
+
+    def stop(self):
+        self.pool.stop()
 
 class Controller(DatagramProtocol):
 
-    def __init__(self):
+    def __init__(self, gps_thread=None):
 
-        self.client_address = None
+        self.peers = subscribers.PeerTable() # Options and subscriptions by address
+        self.expire_loop = task.LoopingCall(self.expireSubscribers)
+        self.window = reliable.SpectrumWindow() # Recent spectrums for retransmission
+        self.retransmit_loop = task.LoopingCall(self.retransmit)
 
         self.detector_state = DetectorState.Cold
         self.detector_data = None
 
         self.session_args = None
-        self.session_loop = None
         self.session_state = SessionState.Ready
+        self.session_start_time = None
+        self.session_stop_time = None
+        self.session_livetime = 0.0
+
+        self.spectrum_index = 0 # Index of the next spectrum of the session
+        self.index_reserved = 0 # Indices below this are reserved in the journal
+
+        self.database_writer = None
+
+        self.aggregators = {} # Rolling and accumulated sums of the session by detector id
+        self.aggregate_loop = None
+        self.aggregate_indices = {} # Index of the last spectrum published in an aggregate by detector id
+
+        self.sync_streams = {} # Active sync streams keyed by client address
+        self.dumps = {} # Active session dumps keyed by client address
+
+        self.gps = gps_thread if gps_thread is not None else gps.GpsThread()
+
+        self.plugins = {} # Loaded plugin modules by name
+        self.workers = [] # Configured detectors
+        # Plugin modules are loaded and set up on their own thread, so a slow
+        # plugin never blocks the reactor
+        self.plugin_pool = ThreadPool(1, 1, 'plugin')
+        self.pending_command = None # Lifecycle command waiting for the plugin thread
+        # Journal writes are synced to disk, they are done in order on a
+        # thread of their own
+        self.journal_pool = ThreadPool(1, 1, 'journal')
+        # Spectrums to retransmit that left the window are read from the
+        # session database on a thread of their own, one lookup per peer at
+        # a time
+        self.retransmit_pool = ThreadPool(1, 1, 'retransmit')
+        self.retransmit_lookups = set() # Addresses of peers with a lookup running
+
+        self.metrics = metrics.Metrics()
+        self.receive_log = metrics.LogLimiter()
+        self.send_log = metrics.LogLimiter()
+
+    def sendResponse(self, msg, addr):
+
+        # Peers that never set options get unfragmented json
+        self.send_log.msg("Send response: %s" % msg['command'])
+        peer = self.peers.find(addr)
+        datagrams = peer.encode(msg) if peer is not None else [wire.encode(msg, wire.FORMAT_JSON)]
+        for datagram in datagrams:
+            self.transport.write(datagram, addr)
+        return len(datagrams)
+
+    def sendResponseWithCommand(self, command, msg, addr):
 
-        self.spectrum_state = SpectrumState.Ready
-        self.spectrum_index = 0
-        self.spectrum_failures = 0
+        msg['command'] = command
+        self.sendResponse(msg, addr)
+
+    def sendResponseWithInfo(self, command, info, addr):
+
+        msg = {'command':"%s" % command, 'message':"%s" % info}
+        self.sendResponse(msg, addr)
+
+    def sendData(self, data, addr):
+
+        peer = self.peers.find(addr)
+        datagrams = peer.fragmenter.fragment(data) if peer is not None else [data]
+        for datagram in datagrams:
+            self.transport.write(datagram, addr)
+        return len(datagrams)
 
-        self.database_connection = None
+    def publish(self, msg, summary=None, select=None):
 
-        self.gps_stop = threading.Event() # Event used to notify gps thread
-        self.gps = gps.GpsThread(self.gps_stop)
+        # Send to all subscribers, summary goes to summary stream subscribers
+        # or to those select turns down
+        self.send_log.msg("Publish: %s" % msg['command'])
+        return self.peers.publish(msg, self.transport.write, summary, select)
 
-        self.plugin = None
+    def publishInfo(self, command, info):
 
-    def sendResponse(self, msg):
+        self.publish({'command':"%s" % command, 'message':"%s" % info})
 
-        if self.client_address is not None:
-            log.msg("Send response: %s" % msg['command'])
-            self.transport.write(bytes(json.dumps(msg)), self.client_address)
+    def expireSubscribers(self):
+
+        # Sync streams keep their peer alive
+        for address in self.peers.expire(self.sync_streams):
+            log.msg("Subscription of %s:%d expired" % address)
+
+    def sendFailure(self, err, addr):
+
+        # Report a failed plugin call the way datagramReceived reports exceptions
+        if err.check(ProtocolError):
+            log.msg("ProtocolError: %s" % (str(err.value)))
+            self.sendResponseWithInfo(err.value.command, err.value.message, addr)
+        elif err.check(ImportError):
+            log.msg("ImportError: %s" % (str(err.value)))
+            self.sendResponseWithInfo('error', "Unable to import module", addr)
         else:
-            log.msg("Send response failed: Client address invalid")
+            log.msg("Exception: %s" % (str(err.value)))
+            self.sendResponseWithInfo('error', err.getErrorMessage(), addr)
 
-    def sendResponseWithCommand(self, command, msg):
+    def callPlugin(self, f, *args):
 
-        msg['command'] = command
-        self.sendResponse(msg)
+        return threads.deferToThreadPool(reactor, self.plugin_pool, f, *args)
 
-    def sendResponseWithInfo(self, command, info):
+    def callJournal(self, f, *args):
 
-        msg = {'command':"%s" % command, 'message':"%s" % info}
-        self.sendResponse(msg)
+        d = threads.deferToThreadPool(reactor, self.journal_pool, f, *args)
+        d.addErrback(lambda err: log.msg("Session journal failed: %s" % err.getErrorMessage()))
+        return d
+
+    def commandDone(self, result):
+
+        self.pending_command = None
+        return result
 
-    def loadPlugin(self, name):
+    def setClientOptions(self, msg, addr):
 
-        if self.plugin != None:
-            self.plugin.finalizePlugin()
-        modname = 'plugin_' + name
-        return sys.modules[modname] if modname in sys.modules else importlib.import_module(modname)
+        if 'wire_format' in msg and msg['wire_format'] not in wire.FORMATS:
+            raise ProtocolError('error', "Unknown wire format: %s" % msg['wire_format'])
+        if 'wire_format' in msg or 'mtu' in msg:
+            peer = self.peers.get(addr)
+            if 'mtu' in msg:
+                try:
+                    peer.fragmenter.mtu = msg['mtu']
+                except (TypeError, ValueError) as e:
+                    raise ProtocolError('error', str(e))
+            peer.wire_format = msg.get('wire_format', peer.wire_format)
+
+    def loadPlugins(self, loaded, names):
+
+        # Plugins are set up again on every configuration
+        for plugin in loaded.itervalues():
+            plugin.finalizePlugin()
+        plugins = {}
+        for name in names:
+            modname = 'plugin_' + name
+            plugins[name] = sys.modules[modname] if modname in sys.modules else importlib.import_module(modname)
+            plugins[name].initializePlugin()
+        return plugins
 
     def startProtocol(self):
 
         log.msg('Starting GPS thread')
         self.gps.start()
+        self.plugin_pool.start()
+        self.journal_pool.start()
+        self.retransmit_pool.start()
+        self.expire_loop.start(EXPIRE_INTERVAL, now=False)
+        threads.deferToThread(database.prepareSpares).addErrback(log.err)
+        threads.deferToThread(database.prepareCatalog).addErrback(log.err)
+        self.retransmit_loop.start(reliable.RETRANSMIT_INTERVAL, now=False)
+        self.resumeInterruptedSession()
 
     def stopProtocol(self):
 
         log.msg('Stopping GPS thread')
-        if self.plugin != None:
-            self.plugin.finalizePlugin()
-        self.gps_stop.set()
+        for worker in self.workers:
+            worker.pool.callInThread(worker.detector.finalizeDetector)
+            worker.stop()
+        for plugin in self.plugins.itervalues():
+            self.plugin_pool.callInThread(plugin.finalizePlugin)
+        self.plugin_pool.stop()
+        if self.expire_loop.running:
+            self.expire_loop.stop()
+        if self.retransmit_loop.running:
+            self.retransmit_loop.stop()
+        self.retransmit_pool.stop()
+        if self.aggregate_loop is not None and self.aggregate_loop.running:
+            self.aggregate_loop.stop()
+        for stream in self.sync_streams.values():
+            stream.stop()
+        self.sync_streams.clear()
+        for transfer in self.dumps.values():
+            transfer.stop()
+        self.dumps.clear()
+        # The journal is kept, the session resumes when the daemon starts again
+        database.close(self.database_writer)
+        self.database_writer = None
+        self.journal_pool.stop()
+        database.closeReaders()
+        self.gps.stop()
         self.gps.join()
 
     def datagramReceived(self, data, addr):
 
-        self.client_address = addr
+        self.peers.touch(addr)
+        started = time.time()
+        cmd = None
 
         try:
             msg = json.loads(data.decode("utf-8"))
 
-            log.msg("Received %s from %s" % (msg, self.client_address)) # FIXME
-
-            if not 'command' in msg:
+            if not isinstance(msg, dict) or not 'command' in msg:
                 raise ProtocolError('error', "Message has no command");
 
+            self.receive_log.msg("Received %s from %s" % (msg['command'], addr))
+
+            if not msg['command'] in COMMANDS:
+                raise ProtocolError('error', "Unknown command: %s" % msg['command'])
+
             cmd = msg['command']
+            handler, schema = COMMANDS[cmd]
+            validate(cmd, msg, schema)
+
+            if cmd in LIFECYCLE_COMMANDS and self.pending_command is not None:
+                raise ProtocolError(cmd + '_busy', "%s failed, %s is in progress" % (describe(cmd), self.pending_command))
 
-            if cmd == 'detector_config':
-                if self.session_state == SessionState.Busy:
-                    raise ProtocolError('detector_config_busy', "Detector config failed, session is active")
-
-                self.detector_data = msg['detector_data']
-
-                if not 'plugin_name' in self.detector_data:
-                    raise ProtocolError('detector_config_error', "Detector config failed, plugin_name missing")
-
-                self.plugin = self.loadPlugin(self.detector_data['plugin_name'])
-                self.plugin.initializePlugin()
-                self.plugin.initializeDetector(self.detector_data)
-                self.detector_state = DetectorState.Warm
-                self.sendResponseWithCommand('detector_config_success', self.detector_data)
-
-            elif cmd == 'start_session':
-                if self.session_state == SessionState.Busy:
-                    raise ProtocolError('start_session_busy', "Start session failed, session is active")
-
-                self.initializeSession(msg)
-                self.startSession(msg)
-                self.sendResponseWithCommand('start_session_success', msg)
-
-            elif cmd == 'stop_session':
-                if self.session_state == SessionState.Ready:
-                    raise ProtocolError('stop_session_noexist', "Stop session failed, no session active")
-                if self.session_args['session_name'] != msg['session_name']:
-                    raise ProtocolError('stop_session_wrongname', "Stop session failed, wrong session name")
-
-                self.stopSession(msg)
-                self.finalizeSession(msg)
-                self.sendResponseWithCommand('stop_session_success', msg)
-
-            elif cmd == 'dump_session':
-                if self.session_state == SessionState.Ready:
-                    raise ProtocolError('dump_session_none', "Dump session failed, no session active")
-
-                msg["message"] = "dumping session to " + str(self.client_address)
-                self.sendResponseWithCommand('dump_session_success', msg)
-
-            elif cmd == 'get_status':
-                stat = os.statvfs('/') # FIXME: python2 only
-                response = {
-                    'free_disk_space': stat.f_bsize * stat.f_bavail,
-                    'session_running': True if self.session_state == SessionState.Busy else False,
-                    'spectrum_index': 0 if self.session_state == SessionState.Ready else self.spectrum_index,
-                    'detector_configured': True if self.detector_state == DetectorState.Warm else False
-                }
-                self.sendResponseWithCommand('get_status_success', response)
-
-            elif cmd == 'sync_session':
-                specs = database.getSyncSpectrums(msg['session_name'], list(msg['indices_list']), int(msg['last_index']))
-                for s in specs:
-                    spec = {
-                        'command': 'spectrum',
-                        'session_name': s[2],
-                        'index': s[3],
-                        'time': s[4],
-                        'latitude': s[5],
-                        'latitude_error': s[6],
-                        'longitude': s[7],
-                        'longitude_error': s[8],
-                        'altitude': s[9],
-                        'altitude_error': s[10],
-                        'track': s[11],
-                        'track_error': s[12],
-                        'speed': s[13],
-                        'speed_error': s[14],
-                        'climb': s[15],
-                        'climb_error': s[16],
-                        'livetime': s[17],
-                        'realtime': s[18],
-                        'total_count': s[19],
-                        'num_channels': s[20],
-                        'channels': s[21]
-                    }
-                    self.sendResponse(spec)
-
-            else: raise Exception("Unknown command: %s" % cmd)
-
-        except ProtocolError as pe:
-            log.msg("ProtocolError: %s" % (str(pe)))
-            self.sendResponseWithInfo(pe.command, pe.message)
-
-        except ImportError as ie:
-            log.msg("ImportError: %s" % (str(ie)))
-            self.sendResponseWithInfo('error', "Unable to import module")
-
-        except Exception as e:
-            log.msg("Exception: %s" % (str(e)))
-            self.sendResponseWithInfo('error', str(e))
-
-    def initializeSession(self, msg):
+            result = getattr(self, handler)(msg, addr)
 
+        except Exception:
+            self.commandFailed(failure.Failure(), cmd, started, addr)
+
+        else:
+            # Handlers returning a Deferred are timed until it fires
+            if isinstance(result, defer.Deferred):
+                result.addCallbacks(lambda r: self.metrics.record(cmd, time.time() - started),
+                        self.commandFailed, errbackArgs=(cmd, started, addr))
+                result.addErrback(log.err)
+            else:
+                self.metrics.record(cmd, time.time() - started)
+
+    def commandFailed(self, err, cmd, started, addr):
+
+        self.metrics.record(cmd if cmd is not None else 'invalid', time.time() - started, True)
+        self.sendFailure(err, addr)
+
+    def handleDetectorConfig(self, msg, addr):
+
+        if self.session_state == SessionState.Busy:
+            raise ProtocolError('detector_config_busy', "Detector config failed, session is active")
+
+        configs = detectorConfigs(msg['detector_data'])
+        self.setClientOptions(msg, addr)
+        return self.configureDetectors(msg['detector_data'], configs, addr)
+
+    def handleStartSession(self, msg, addr):
+
+        if self.session_state == SessionState.Busy:
+            raise ProtocolError('start_session_busy', "Start session failed, session is active")
+        if self.detector_state != DetectorState.Warm:
+            raise ProtocolError('start_session_error', "Start session failed, detector not configured")
+        try:
+            aggregation = aggregate.parseConfig(msg.get('aggregate'))
+        except ValueError as e:
+            raise ProtocolError('start_session_error', "Start session failed, invalid aggregate: %s" % str(e))
+
+        started = time.time()
+        self.setClientOptions(msg, addr)
+
+        # The session database is set up by its writer thread and the plugin
+        # prepares the session on the plugin thread ahead of the first
+        # acquisition, neither is waited for here
+        d = self.initializeSession(msg)
+
+        def sessionFailed(err):
+            self.publishInfo('start_session_error', "Unable to initialize session: %s" % err.getErrorMessage())
+            if self.session_state == SessionState.Busy and self.session_args['session_name'] == msg['session_name']:
+                return self.endSession(self.session_args)
+
+        d.addErrback(sessionFailed)
+        d.addErrback(log.err)
+
+        # The client starting a session gets the live stream, unless it has
+        # already chosen one
+        peer = self.peers.find(addr)
+        if peer is None or peer.stream is None:
+            self.peers.subscribe(addr)
+        self.startAggregation(msg, aggregation)
+        self.startSession(msg)
+        msg['start_latency'] = time.time() - started
+        self.sendResponseWithCommand('start_session_success', msg, addr)
+
+    def handleStopSession(self, msg, addr):
+
+        if self.session_state == SessionState.Ready:
+            raise ProtocolError('stop_session_noexist', "Stop session failed, no session active")
+        if self.session_args['session_name'] != msg['session_name']:
+            raise ProtocolError('stop_session_wrongname', "Stop session failed, wrong session name")
+
+        def sessionStopped(result):
+            msg['duty_cycle'] = self.dutyCycle()
+            self.sendResponseWithCommand('stop_session_success', msg, addr)
+
+        d = self.endSession(msg)
+        d.addCallback(sessionStopped)
+        return d
+
+    def handleDumpSession(self, msg, addr):
+
+        # Without a session name the running session is dumped
+        if 'session_name' in msg:
+            session_name = msg['session_name']
+        elif self.session_state == SessionState.Busy:
+            session_name = self.session_args['session_name']
+        else:
+            raise ProtocolError('dump_session_none', "Dump session failed, no session active")
+        dbpath = database.sessionFile(session_name)
+        if dbpath is None:
+            raise ProtocolError('dump_session_none', "Dump session failed, no such session: %s" % session_name)
+
+        chunk_size = msg.get('chunk_size', dump.DUMP_CHUNK_SIZE)
+        window = msg.get('window', dump.DUMP_WINDOW)
+        offset = msg.get('offset', 0)
+        if not isinstance(chunk_size, int) or not 512 <= chunk_size <= dump.MAX_CHUNK_SIZE:
+            raise ProtocolError('dump_session_error', "Dump session failed, chunk size must be 512 to %d bytes" % dump.MAX_CHUNK_SIZE)
+        if not isinstance(window, int) or not 1 <= window <= dump.MAX_DUMP_WINDOW:
+            raise ProtocolError('dump_session_error', "Dump session failed, window must be 1 to %d chunks" % dump.MAX_DUMP_WINDOW)
+        if not isinstance(offset, int):
+            raise ProtocolError('dump_session_error', "Dump session failed, invalid offset")
+
+        self.setClientOptions(msg, addr)
+        if addr in self.dumps:
+            self.dumps.pop(addr).stop()
+
+        def snapshotTaken(snapshot):
+            # Resuming needs the same snapshot, otherwise the client starts over
+            transfer = dump.DumpTransfer(lambda data: self.sendData(data, addr), snapshot, chunk_size, window,
+                    offset if msg.get('snapshot') == snapshot.id else 0)
+            if addr in self.dumps:
+                self.dumps.pop(addr).stop()
+            self.dumps[addr] = transfer
+            self.sendResponseWithCommand('dump_session_success', {
+                'session_name': session_name,
+                'snapshot': snapshot.id,
+                'size': snapshot.size,
+                'spectrums': snapshot.spectrums,
+                'chunk_size': chunk_size,
+                'chunks': transfer.chunks,
+                'offset': transfer.offset
+            }, addr)
+
+            def transferDone(transfer):
+                log.msg("Dump of session %s complete, %d chunks sent, %d resent" % (session_name, transfer.sent, transfer.resent))
+                self.sendResponseWithCommand('dump_session_complete', {
+                    'session_name': session_name,
+                    'snapshot': snapshot.id,
+                    'size': snapshot.size
+                }, addr)
+
+            def transferFailed(err):
+                log.msg("Dump of session %s failed: %s" % (session_name, err.getErrorMessage()))
+
+            def transferEnded(result):
+                if self.dumps.get(addr) is transfer:
+                    del self.dumps[addr]
+
+            transfer.done.addCallbacks(transferDone, transferFailed)
+            transfer.done.addBoth(transferEnded)
+            transfer.start()
+
+        # Taking the snapshot may wait for a gap between commits
+        d = threads.deferToThread(dump.Snapshot, dbpath)
+        d.addCallback(snapshotTaken)
+        return d
+
+    def handleDumpAck(self, msg, addr):
+
+        transfer = self.dumps.get(addr)
+        if transfer is not None and transfer.snapshot.id == msg['snapshot']:
+            transfer.ack(int(msg['ack']))
+
+    def handleGetStatus(self, msg, addr):
+
+        stat = os.statvfs('/') # FIXME: python2 only
+        response = {
+            'free_disk_space': stat.f_bsize * stat.f_bavail,
+            'session_running': True if self.session_state == SessionState.Busy else False,
+            'spectrum_index': 0 if self.session_state == SessionState.Ready else self.spectrum_index,
+            'detector_configured': True if self.detector_state == DetectorState.Warm else False,
+            'detector_warming': True if self.detector_state == DetectorState.Warming else False,
+            'duty_cycle': 0.0 if self.session_state == SessionState.Ready else self.dutyCycle(),
+            'subscribers': len(self.peers.subscribers()),
+            'detectors': [{
+                'detector_id': worker.detector_id,
+                'plugin_name': worker.plugin_name,
+                'spectrum_index': worker.spectrum_index,
+                'livetime': worker.livetime
+            } for worker in self.workers]
+        }
+        self.sendResponseWithCommand('get_status_success', response, addr)
+
+    def handleGetMetrics(self, msg, addr):
+
+        self.sendResponseWithCommand('get_metrics_success', self.metrics.summary(), addr)
+
+    def handleListSessions(self, msg, addr):
+
+        # Sessions are listed from the catalog, a page at a time
+        offset = msg.get('offset', 0)
+        limit = msg.get('limit', database.LIST_LIMIT)
+        if not isinstance(offset, int) or offset < 0 or not isinstance(limit, int) or not 1 <= limit <= database.MAX_LIST_LIMIT:
+            raise ProtocolError('list_sessions_error', "List sessions failed, offset must be positive and limit 1 to %d" % database.MAX_LIST_LIMIT)
+        filters = {}
+        for key in ('name', 'since', 'until'):
+            if key in msg:
+                if not isinstance(msg[key], basestring):
+                    raise ProtocolError('list_sessions_error', "List sessions failed, invalid %s" % key)
+                filters[key] = msg[key]
+        if 'running' in msg:
+            if not isinstance(msg['running'], bool):
+                raise ProtocolError('list_sessions_error', "List sessions failed, invalid running")
+            filters['running'] = msg['running']
+        if 'area' in msg:
+            area = msg['area']
+            if not isinstance(area, list) or len(area) != 4 or not all(isinstance(v, _number) for v in area):
+                raise ProtocolError('list_sessions_error', "List sessions failed, area must be [latitude_min, longitude_min, latitude_max, longitude_max]")
+            filters['area'] = area
+        self.setClientOptions(msg, addr)
+
+        def listed(result):
+            sessions, total = result
+            self.sendResponseWithCommand('list_sessions_success', {
+                'sessions': sessions,
+                'total': total,
+                'offset': offset,
+                'limit': limit
+            }, addr)
+
+        d = threads.deferToThread(database.listSessions, offset, limit, **filters)
+        d.addCallback(listed)
+        return d
+
+    def handleSubscribe(self, msg, addr):
+
+        # Sent again as a heartbeat. A multicast group given as address is
+        # subscribed on behalf of its listeners
+        stream = msg.get('stream', subscribers.STREAM_FULL)
+        if stream not in subscribers.STREAMS:
+            raise ProtocolError('subscribe_error', "Subscribe failed, unknown stream: %s" % stream)
+        timeout = msg.get('timeout', subscribers.SUBSCRIBER_TIMEOUT)
+        if not isinstance(timeout, _number) or timeout <= 0:
+            raise ProtocolError('subscribe_error', "Subscribe failed, invalid timeout")
+
+        target = addr
+        if 'address' in msg:
+            host, sep, port = str(msg['address']).partition(':')
+            if not subscribers.isMulticast(host) or not port.isdigit():
+                raise ProtocolError('subscribe_error', "Subscribe failed, address must be a multicast group and port")
+            if msg.get('reliable', False):
+                raise ProtocolError('subscribe_error', "Subscribe failed, multicast groups can not be reliable")
+            target = (host, int(port))
+
+        self.setClientOptions(msg, target)
+        peer = self.peers.subscribe(target, stream, timeout)
+        peer.aggregate_channels = bool(msg.get('aggregate_channels', False))
+        if not msg.get('reliable', False):
+            peer.reliable = None
+        elif peer.reliable is None:
+            peer.reliable = reliable.ReliableState()
+        self.sendResponseWithCommand('subscribe_success', {
+            'address': "%s:%d" % target,
+            'stream': stream,
+            'reliable': peer.reliable is not None,
+            'aggregate_channels': peer.aggregate_channels,
+            'timeout': timeout,
+            'subscribers': len(self.peers.subscribers())
+        }, addr)
+
+    def handleUnsubscribe(self, msg, addr):
+
+        target = addr
+        if 'address' in msg:
+            host, sep, port = str(msg['address']).partition(':')
+            target = (host, int(port)) if port.isdigit() else addr
+        self.peers.unsubscribe(target)
+        self.sendResponseWithCommand('unsubscribe_success', {'address': "%s:%d" % target}, addr)
+
+    def handleSpectrumAck(self, msg, addr):
+
+        peer = self.peers.find(addr)
+        if peer is not None and peer.reliable is not None:
+            peer.reliable.ack(msg['session_name'], int(msg['ack']), msg.get('sack', ()))
+
+    def handleSyncSession(self, msg, addr):
+
+        self.setClientOptions(msg, addr)
+        self.startSync(msg, addr)
+
+    def startSync(self, msg, addr):
+
+        # A new sync request from the same client replaces the running one
+        if addr in self.sync_streams:
+            self.sync_streams.pop(addr).stop()
+
+        stream = sync.SyncStream(lambda m: self.sendResponse(m, addr), msg)
+        self.sync_streams[addr] = stream
+
+        def syncDone(result):
+            if self.sync_streams.get(addr) is stream:
+                del self.sync_streams[addr]
+
+        def syncFailed(err):
+            if err.check(task.TaskStopped):
+                return
+            log.msg("Sync failed: %s" % err.getErrorMessage())
+            self.sendResponseWithInfo('error', "Sync failed: %s" % err.getErrorMessage(), addr)
+
+        d = stream.start()
+        d.addErrback(syncFailed)
+        d.addBoth(syncDone)
+
+    def configureDetectors(self, detector_data, configs, addr):
+
+        # Release the configured detectors, load the plugins on the plugin
+        # thread and warm up the detectors in parallel on their own threads,
+        # reporting progress until it is done
+        detector_ids = [detector_id for detector_id, config in configs]
+        log.msg("Configuring detectors " + ', '.join(detector_ids))
+        self.detector_data = dict(detector_data) # detector_data goes on to become the response
+        self.detector_state = DetectorState.Warming
+        self.pending_command = 'detector_config'
+        started = time.time()
+
+        def progress():
+            if addr is None:
+                return
+            self.sendResponseWithCommand('detector_config_progress', {
+                'detectors': detector_ids,
+                'elapsed': time.time() - started
+            }, addr)
+
+        def load(result):
+            loaded, self.plugins = self.plugins, {}
+            # Plugins of isolated detectors are only loaded in their processes
+            return self.callPlugin(self.loadPlugins, loaded,
+                    set(config['plugin_name'] for detector_id, config in configs if not config.get('isolated')))
+
+        def createDetector(detector_id, config):
+            if config.get('isolated'):
+                return process.ProcessDetector(detector_id, config['plugin_name'],
+                        config.get('max_channels', process.MAX_CHANNELS),
+                        lambda name, seconds: reactor.callFromThread(self.metrics.record, name, seconds),
+                        lambda name: reactor.callFromThread(self.metrics.count, name))
+            return self.plugins[config['plugin_name']].Detector(detector_id)
+
+        def warmUp(plugins):
+            self.plugins = plugins
+            self.workers = [DetectorWorker(detector_id, config['plugin_name'], createDetector(detector_id, config), config)
+                    for detector_id, config in configs]
+            return gather([worker.call(worker.detector.initializeDetector, worker.config) for worker in self.workers])
+
+        def configured(result):
+            self.detector_state = DetectorState.Warm
+            if addr is not None:
+                self.sendResponseWithCommand('detector_config_success', detector_data, addr)
+
+        def failed(err):
+            self.detector_state = DetectorState.Cold
+            return err
+
+        def done(result):
+            progress_loop.stop()
+            return self.commandDone(result)
+
+        progress_loop = task.LoopingCall(progress)
+        progress_loop.start(PROGRESS_INTERVAL)
+        d = self.releaseDetectors()
+        d.addCallback(load)
+        d.addCallback(warmUp)
+        d.addCallbacks(configured, failed)
+        d.addBoth(done)
+        return d
+
+    def releaseDetectors(self):
+
+        # Finalize the configured detectors and stop their threads
+        workers, self.workers = self.workers, []
+
+        def finalizeFailed(err, worker):
+            log.msg("Unable to finalize detector %s: %s" % (worker.detector_id, err.getErrorMessage()))
+
+        def stop(result):
+            for worker in workers:
+                worker.stop()
+
+        d = defer.gatherResults([worker.call(worker.detector.finalizeDetector).addErrback(finalizeFailed, worker) for worker in workers])
+        d.addCallback(stop)
+        return d
+
+    def initializeSession(self, msg, state=None):
+
+        # A journaled state resumes an interrupted session after its reserved
+        # indices
         log.msg("Initializing session " + msg['session_name'])
-        self.session_args = msg
-        self.spectrum_index = 0
-        self.spectrum_failures = 0
-        self.database_connection = database.create(self.detector_data, msg)
-        self.plugin.initializeSession(msg)
+        msg.setdefault('pipelined', True)
+        # Kept apart from msg, which goes on to become the response
+        self.session_args = dict(msg)
+        self.spectrum_index = state['index'] if state is not None else 0
+        for worker in self.workers:
+            worker.spectrum_index = state['detector_indices'].get(worker.detector_id, 0) if state is not None else 0
+            worker.spectrum_failures = 0
+            worker.livetime = 0.0
+        if state is not None:
+            self.database_writer = database.resume(self.detector_data, msg)
+        else:
+            self.database_writer = database.create(self.detector_data, msg)
+        self.reserveIndices()
+        return gather([worker.call(worker.detector.initializeSession, self.session_args) for worker in self.workers])
+
+    def reserveIndices(self):
+
+        # Journal the session with indices reserved ahead of the ones handed
+        # out, renewed when half of the reservation is used. The state is
+        # serialized here, the journal thread never sees dicts the reactor
+        # goes on to change
+        self.index_reserved = self.spectrum_index + journal.INDEX_RESERVE
+        self.callJournal(journal.write, json.loads(json.dumps({
+            'session_args': self.session_args,
+            'detector_data': self.detector_data,
+            'index': self.index_reserved,
+            'detector_indices': dict((worker.detector_id, worker.spectrum_index + journal.INDEX_RESERVE) for worker in self.workers)
+        })))
+
+    def resumeInterruptedSession(self):
+
+        # A journal left at startup belongs to a session the daemon stopped
+        # in, its detectors are configured again and it goes on
+        state = journal.read()
+        if state is None:
+            return
+        msg = state['session_args']
+        if database.sessionFile(msg.get('session_name')) is None:
+            log.msg("Journaled session database not found, session not resumed")
+            self.callJournal(journal.clear)
+            return
+        try:
+            aggregation = aggregate.parseConfig(msg.get('aggregate'))
+            configs = detectorConfigs(state['detector_data'])
+        except (ValueError, ProtocolError) as e:
+            log.msg("Unable to resume session %s: %s" % (msg['session_name'], str(e)))
+            self.callJournal(journal.clear)
+            return
+        log.msg("Resuming session %s at index %d" % (msg['session_name'], state['index']))
+
+        def resume(result):
+            d = self.initializeSession(msg, state)
+            self.startAggregation(msg, aggregation)
+            self.startSession(msg)
+            self.publishInfo('session_resumed', msg['session_name'])
+            return d
+
+        def failed(err):
+            log.msg("Unable to resume session %s: %s" % (msg['session_name'], err.getErrorMessage()))
+            if self.session_state == SessionState.Busy:
+                return self.endSession(msg)
+            self.callJournal(journal.clear)
+
+        d = self.configureDetectors(state['detector_data'], configs, None)
+        d.addCallback(resume)
+        d.addErrback(failed)
+        d.addErrback(log.err)
+        return d
 
     def finalizeSession(self, msg):
 
         log.msg("Finalizing session")
-        self.plugin.finalizeSession(msg)
-        database.close(self.database_connection)
-        self.database_connection = None
+
+        # Runs after any acquisition still on the detector threads, whose
+        # spectrums are stored before the database is closed
+        def closeDatabase(result):
+            database.close(self.database_writer)
+            self.database_writer = None
+            self.callJournal(journal.clear)
+            self.publishAggregate()
+            log.msg("Session duty cycle %.3f" % self.dutyCycle())
+            return result
+
+        d = gather([worker.call(worker.detector.finalizeSession, msg) for worker in self.workers])
+        d.addBoth(closeDatabase)
+        return d
+
+    def endSession(self, msg):
+
+        # Conflicting commands are rejected until the session is finalized
+        self.stopSession(msg)
+        self.pending_command = 'stop_session'
+        d = self.finalizeSession(msg)
+        d.addBoth(self.commandDone)
+        return d
 
     def startSession(self, msg):
 
         log.msg("Starting session " + msg['session_name'])
-        self.session_loop = task.LoopingCall(self.sessionTick)
-        self.session_loop.start(0.05)
+        self.session_start_time = time.time()
+        self.session_stop_time = None
+        self.session_livetime = 0.0
         self.session_state = SessionState.Busy
+        self.sessionTick()
 
     def stopSession(self, msg):
 
         log.msg("Stopping session")
-        self.session_loop.stop()
+        self.session_stop_time = time.time()
         self.session_state = SessionState.Ready
+        if self.aggregate_loop is not None and self.aggregate_loop.running:
+            self.aggregate_loop.stop()
+
+    def startAggregation(self, msg, aggregation):
+
+        # Detectors differ in channels, so each has its own sums. Sessions
+        # started without an aggregate configuration are not aggregated
+        self.aggregators = {}
+        self.aggregate_indices = {}
+        if aggregation is None:
+            return
+        window, interval, rois = aggregation
+        self.aggregators = {worker.detector_id: aggregate.Aggregator(msg['session_name'], window, rois, worker.detector_id)
+                for worker in self.workers}
+        if interval > 0.0:
+            self.aggregate_loop = task.LoopingCall(self.publishAggregate)
+            self.aggregate_loop.start(interval, now=False)
+
+    def publishAggregate(self):
+
+        # Subscribers that asked for aggregate channels also get the
+        # accumulated session spectrum. Nothing is sent for a detector until
+        # it has added new spectrums
+        wanted = any(peer.aggregate_channels for peer in self.peers.subscribers())
+        for detector_id, aggregator in self.aggregators.iteritems():
+            if aggregator.index == self.aggregate_indices.get(detector_id, -1):
+                continue
+            self.aggregate_indices[detector_id] = aggregator.index
+            summary = aggregator.summary()
+            if not wanted:
+                self.publish(summary)
+                continue
+            channels = aggregator.accumulated()
+            self.publish(dict(summary, channels=channels, num_channels=len(channels)), summary,
+                    lambda peer: peer.aggregate_channels)
+
+    def dutyCycle(self):
+
+        # Fraction of the session wall time covered by acquired livetime,
+        # averaged over the detectors
+        if self.session_start_time is None or not self.workers:
+            return 0.0
+        elapsed = (self.session_stop_time or time.time()) - self.session_start_time
+        return self.session_livetime / len(self.workers) / elapsed if elapsed > 0.0 else 0.0
 
     def sessionTick(self):
 
-        if self.spectrum_state == SpectrumState.Ready:
-            d = threads.deferToThread(self.aquireSpectrum)
-            d.addCallbacks(self.handleSpectrumSuccess, self.handleSpectrumFailure)
-            self.spectrum_state = SpectrumState.Busy
-
-    def aquireSpectrum(self):
+        # Start the next acquisition of each detector not acquiring, called
+        # again when an acquisition completes
+        if self.session_state != SessionState.Busy:
+            return
+        for worker in self.workers:
+            if worker.spectrum_state == SpectrumState.Ready:
+                d = worker.call(self.aquireSpectrum, worker)
+                d.addBoth(self.recordAcquisition, time.time())
+                d.addCallbacks(self.handleSpectrumSuccess, self.handleSpectrumFailure, callbackArgs=(worker, ), errbackArgs=(worker, ))
+                d.addErrback(log.err)
+                d.addBoth(self.handleSpectrumDone, worker)
+                worker.spectrum_state = SpectrumState.Busy
+
+    def aquireSpectrum(self, worker):
+
+        msg = worker.detector.acquireSpectrum(self.session_args)
+        msg['detector_id'] = worker.detector_id
+
+        # The live window ended now and started realtime seconds ago, the
+        # spectrum is positioned at its centre. All detectors read the same
+        # GPS thread
+        end = time.time()
+        start = end - float(msg['realtime'])
+        first = self.gps.interpolate(start)
+        last = self.gps.interpolate(end)
+
+        msg.update(self.gps.interpolate((start + end) / 2.0))
+        msg['time'] = first['time']
+        for name in ('latitude', 'longitude', 'altitude'):
+            msg[name + '_start'] = first[name]
+            msg[name + '_end'] = last[name]
 
-        position = self.gps.position
-        velocity = self.gps.velocity
-        time = self.gps.time
-
-        msg = self.plugin.acquireSpectrum(self.session_args)
+        return msg
 
-        msg.update(position)
-        msg.update(velocity)
-        msg['time'] = time
+    def recordAcquisition(self, result, started):
 
-        return msg
+        self.metrics.record('acquire_spectrum', time.time() - started, isinstance(result, failure.Failure))
+        return result
 
-    def handleSpectrumSuccess(self, msg):
+    def handleSpectrumSuccess(self, msg, worker):
 
         msg['index'] = self.spectrum_index
+        msg['detector_index'] = worker.spectrum_index
         self.spectrum_index += 1
-        database.insertSpectrum(self.database_connection, msg)
-        self.sendResponse(msg)
-        self.spectrum_state = SpectrumState.Ready
-
-    def handleSpectrumFailure(self, err):
-
-        self.sendResponseWithInfo('error', err.getErrorMessage())
-
-        self.spectrum_failures += 1
-        if self.spectrum_failures >= 3:
-            self.stopSession(self.session_args)
-            self.finalizeSession(self.session_args)
-            self.sendResponseWithInfo('error', "Acquiring spectrum has failed 3 times, stopping session")
-
-        self.spectrum_state = SpectrumState.Ready
+        worker.spectrum_index += 1
+        # Detector indices advance no faster than the session index, so its
+        # reservation covers theirs
+        if self.index_reserved - self.spectrum_index <= journal.INDEX_RESERVE // 2:
+            self.reserveIndices()
+        worker.livetime += float(msg['livetime'])
+        self.session_livetime += float(msg['livetime'])
+        database.insertSpectrum(self.database_writer, msg)
+        if self.database_writer is not None and self.database_writer.error is not None and self.session_state == SessionState.Busy:
+            self.publishInfo('error', "Session database failed: %s, stopping session" % self.database_writer.error)
+            self.endSession(self.session_args).addErrback(log.err)
+        self.window.add(msg)
+        aggregator = self.aggregators.get(worker.detector_id)
+        if aggregator is not None:
+            started = time.time()
+            aggregator.add(msg)
+            self.metrics.record('aggregate_spectrum', time.time() - started)
+        self.publish(msg, subscribers.summarize(msg))
+        for peer in self.peers.subscribers():
+            if peer.reliable is not None:
+                peer.reliable.sent(msg['session_name'], msg['index'])
+
+    def retransmit(self):
+
+        # Send unacknowledged spectrums again, from memory or, once they have
+        # left the window, from the session database
+        for peer in self.peers.subscribers():
+            if peer.reliable is None or peer.address in self.retransmit_lookups:
+                continue
+            indices = peer.reliable.due()
+            if not indices:
+                continue
+            session_name = peer.reliable.session_name
+            spectrums = [self.window.get(i) if session_name == self.window.session_name else None for i in indices]
+            missing = [i for i, spec in zip(indices, spectrums) if spec is None]
+            self.sendRetransmits(peer, [spec for spec in spectrums if spec is not None])
+            if missing:
+                # Spectrums not yet committed are found on a later attempt
+                self.retransmit_lookups.add(peer.address)
+                d = threads.deferToThreadPool(reactor, self.retransmit_pool, database.getSpectrums, session_name, missing)
+                d.addCallback(self.retransmitFromDisk, peer)
+                d.addErrback(lambda err: log.msg("Retransmit failed: %s" % err.getErrorMessage()))
+                d.addBoth(lambda _, address=peer.address: self.retransmit_lookups.discard(address))
+
+    def retransmitFromDisk(self, spectrums, peer):
+
+        self.metrics.count('retransmit_disk', len(spectrums))
+        if self.peers.find(peer.address) is peer:
+            self.sendRetransmits(peer, spectrums)
+
+    def sendRetransmits(self, peer, spectrums):
+
+        for spec in spectrums:
+            self.sendResponse(spec if peer.stream == subscribers.STREAM_FULL else subscribers.summarize(spec), peer.address)
+        self.metrics.count('retransmit', len(spectrums))
+
+    def handleSpectrumFailure(self, err, worker):
+
+        self.publishInfo('error', "Detector %s: %s" % (worker.detector_id, err.getErrorMessage()))
+
+        worker.spectrum_failures += 1
+        if worker.spectrum_failures >= 3 and self.session_state == SessionState.Busy:
+            self.endSession(self.session_args).addErrback(log.err)
+            self.publishInfo('error', "Acquiring spectrum from detector %s has failed 3 times, stopping session" % worker.detector_id)
+
+    def handleSpectrumDone(self, result, worker):
+
+        worker.spectrum_state = SpectrumState.Ready
+        self.sessionTick()
 
 if __name__ == "__main__":
+    log.startLogging(sys.stdout)
     reactor.listenUDP(9999, Controller())
     reactor.run()
@@ -0,0 +1,220 @@
+# Detector controller for gamma measurements
+# Copyright (C) 2016  Norwegain Radiation Protection Authority
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Dag Robole,
+
+# Live aggregation of session spectrums
+#
+# Keeps the channel sums of the last window spectrums, the count rates in
+# regions of interest over that window and the spectrum accumulated over the
+# whole session. The rolling sums are updated with the spectrum entering and
+# the one leaving the window, so each spectrum costs two passes over its
+# channels whatever the window. NumPy does the passes when available,
+# otherwise map over operator functions keeps them out of Python loops.
+#
+# Aggregation is off unless start_session carries an 'aggregate' item:
+#
+#   window    Number of spectrums in the rolling sums, default 10. Windows of
+#             large spectrums are shortened to keep the channels held for the
+#             window within MAX_RING_CHANNELS per detector
+#   interval  Seconds between spectrum_aggregate messages, default 1.
+#             0 disables the messages
+#   rois      List of {'name', 'start', 'end'} regions of interest, start and
+#             end are inclusive channel numbers
+
+import operator
+from array import array
+from collections import deque
+
+from gc_channels import UINT32, toArray
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+AGGREGATE_WINDOW = 10
+AGGREGATE_INTERVAL = 1.0
+
+MAX_AGGREGATE_WINDOW = 3600
+
+# Channel values held for the rolling sums of a detector, 16 MB as uint32
+MAX_RING_CHANNELS = 4 * 1024 * 1024
+
+def parseConfig(config):
+    """
+    Return window, interval and regions of interest from an aggregate
+    configuration, None without one. Raises ValueError if it is invalid
+    """
+    if config is None:
+        return None
+    if not isinstance(config, dict):
+        raise ValueError("aggregate must be a dictionary")
+    window = config.get('window', AGGREGATE_WINDOW)
+    interval = config.get('interval', AGGREGATE_INTERVAL)
+    if not isinstance(window, int) or not 1 <= window <= MAX_AGGREGATE_WINDOW:
+        raise ValueError("window must be 1 to %d spectrums" % MAX_AGGREGATE_WINDOW)
+    if not isinstance(interval, (int, long, float)) or interval < 0:
+        raise ValueError("invalid interval")
+    rois = []
+    for roi in config.get('rois', ()):
+        try:
+            name, start, end = unicode(roi['name']), int(roi['start']), int(roi['end'])
+        except (TypeError, KeyError, ValueError):
+            raise ValueError("regions of interest need name, start and end")
+        if start < 0 or end < start:
+            raise ValueError("invalid channels for region %s" % name)
+        rois.append((name, start, end))
+    return window, float(interval), rois
+
+class Aggregator(object):
+    """
+    Rolling and accumulated sums of the spectrums of one session
+    """
+    def __init__(self, session_name, window=AGGREGATE_WINDOW, rois=(), detector_id=None):
+        self.session_name = session_name
+        self.detector_id = detector_id
+        self.window = window # Shortened for large spectrums
+        self._requested_window = window
+        self.rois = rois
+        self.index = -1 # Index of the last spectrum added
+        self.spectrums = 0
+        self.livetime = 0.0
+        self.realtime = 0.0
+        self._recent = deque() # Livetime, realtime and total count of the window
+        self._ring = None # Channels of the window
+        self._rolling = None
+        self._accumulated = None
+
+    def _reset(self, num_channels):
+        self._recent.clear()
+        self.window = max(1, min(self._requested_window, MAX_RING_CHANNELS // max(1, num_channels)))
+        if numpy is not None:
+            self._ring = numpy.zeros((self.window, num_channels), numpy.uint32)
+            self._rolling = numpy.zeros(num_channels, numpy.int64)
+            self._accumulated = numpy.zeros(num_channels, numpy.int64)
+        else:
+            self._ring = deque()
+            self._rolling = [0] * num_channels
+            self._accumulated = [0] * num_channels
+
+    def add(self, msg):
+        """
+        Add a spectrum message
+        """
+        channels = toArray(msg['channels'])
+        if self._rolling is None or len(channels) != len(self._rolling):
+            self._reset(len(channels))
+
+        if numpy is not None:
+            values = numpy.frombuffer(channels, numpy.uint32)
+            slot = self.spectrums % self.window
+            if len(self._recent) == self.window:
+                self._rolling -= self._ring[slot]
+            self._ring[slot] = values
+            self._rolling += values
+            self._accumulated += values
+            total = int(values.sum())
+        else:
+            if len(self._recent) == self.window:
+                self._rolling = map(operator.sub, self._rolling, self._ring.popleft())
+            self._ring.append(channels)
+            self._rolling = map(operator.add, self._rolling, channels)
+            self._accumulated = map(operator.add, self._accumulated, channels)
+            total = sum(channels)
+
+        if len(self._recent) == self.window:
+            self._recent.popleft()
+        self._recent.append((float(msg['livetime']), float(msg['realtime']), total))
+        self.index = msg['index']
+        self.spectrums += 1
+        self.livetime += float(msg['livetime'])
+        self.realtime += float(msg['realtime'])
+
+    def _counts(self, start, end):
+        # Counts of the rolling sum in channels start to end, inclusive
+        if numpy is not None:
+            return int(self._rolling[start:end + 1].sum())
+        return sum(self._rolling[start:end + 1])
+
+    def summary(self):
+        """
+        Return a spectrum_aggregate message without channels
+        """
+        livetime = sum(r[0] for r in self._recent)
+        count = sum(r[2] for r in self._recent)
+        def rate(counts):
+            return counts / livetime if livetime > 0.0 else 0.0
+        rois = []
+        for name, start, end in self.rois:
+            counts = self._counts(start, end) if self._rolling is not None else 0
+            rois.append({'name': name, 'start': start, 'end': end, 'counts': counts, 'rate': rate(counts)})
+        accumulated = int(self._accumulated.sum()) if numpy is not None and self._accumulated is not None \
+                else sum(self._accumulated or ())
+        return {
+            'command': 'spectrum_aggregate',
+            'session_name': self.session_name,
+            'detector_id': self.detector_id,
+            'index': self.index,
+            'window': len(self._recent),
+            'livetime': livetime,
+            'realtime': sum(r[1] for r in self._recent),
+            'total_count': count,
+            'count_rate': rate(count),
+            'rois': rois,
+            'session_spectrums': self.spectrums,
+            'session_livetime': self.livetime,
+            'session_realtime': self.realtime,
+            'session_count': accumulated,
+            'session_count_rate': accumulated / self.livetime if self.livetime > 0.0 else 0.0
+        }
+
+    def accumulated(self):
+        """
+        Return the accumulated session spectrum as a uint32 array
+        """
+        if self._accumulated is None:
+            return array(UINT32)
+        if numpy is not None:
+            channels = array(UINT32)
+            channels.fromstring(numpy.minimum(self._accumulated, 0xffffffff).astype(numpy.uint32).tostring())
+            return channels
+        return array(UINT32, [min(c, 0xffffffff) for c in self._accumulated])
+
+if __name__ == "__main__":
+
+    # Time adding spectrums and taking summaries
+    import sys, random, time
+
+    num_channels = int(sys.argv[1]) if len(sys.argv) > 1 else 4096
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    random.seed(0)
+    spectrums = [{'index': i, 'livetime': 1.0, 'realtime': 1.01,
+            'channels': array(UINT32, [int(random.expovariate(1.0 / 5.0)) for c in xrange(num_channels)])}
+            for i in xrange(20)]
+    rois = [('roi%d' % i, i * num_channels // 8, (i + 1) * num_channels // 8 - 1) for i in xrange(8)]
+    aggregator = Aggregator('benchmark', AGGREGATE_WINDOW, rois)
+    t0 = time.time()
+    for i in xrange(iterations):
+        aggregator.add(dict(spectrums[i % len(spectrums)], index=i))
+    t1 = time.time()
+    for i in xrange(iterations):
+        aggregator.summary()
+    t2 = time.time()
+    print("%s, %d channels: %.1f us/add %.1f us/summary" % ('numpy' if numpy is not None else 'array', num_channels,
+        (t1 - t0) * 1e6 / iterations, (t2 - t1) * 1e6 / iterations))
@@ -0,0 +1,340 @@
+#!/usr/bin/env python2
+#
+# End to end benchmark for the gamma measurement daemon
+# Copyright (C) 2016  Norwegain Radiation Protection Authority
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Dag Robole,
+
+# Runs a Controller on a loopback UDP port with the simulated detector and a
+# fixed GPS position, drives it with a scripted client and writes the results
+# as JSON. Session databases are written to a temporary home directory.
+
+from __future__ import print_function
+
+import os, sys, json, time, socket, shutil, tempfile, argparse, resource
+
+from twisted.internet import reactor, task, threads
+
+import gammad
+import gc_database as database
+import gc_transport as fragmentation
+import gc_wire as wire
+
+# Largest plausible duty cycle, timers of the daemon and the detector differ
+MAX_DUTY_CYCLE = 1.05
+
+class FakeGps(object):
+    """
+    GPS replacement reporting a fixed position
+    """
+    position = {
+        'latitude': 59.9, 'latitude_error': 1.0, 'longitude': 10.7, 'longitude_error': 1.0,
+        'altitude': 100.0, 'altitude_error': 2.0
+    }
+    velocity = {
+        'track': 0.0, 'track_error': 0.0, 'speed': 0.0, 'speed_error': 0.0,
+        'climb': 0.0, 'climb_error': 0.0
+    }
+    time = '2016-01-01T12:00:00.000Z'
+
+    def interpolate(self, stamp):
+        values = dict(self.position)
+        values.update(self.velocity)
+        values['time'] = self.time
+        return values
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def join(self):
+        pass
+
+class BenchmarkController(gammad.Controller):
+    """
+    Controller recording when each acquisition completes
+    """
+    def __init__(self):
+        gammad.Controller.__init__(self, FakeGps())
+        self.acquired = [] # Completion times, acquisitions run one at a time so position equals index
+
+    def aquireSpectrum(self, worker):
+        msg = gammad.Controller.aquireSpectrum(self, worker)
+        self.acquired.append(time.time())
+        return msg
+
+class Timings(object):
+    """
+    Collect durations of calls to a module function
+    """
+    def __init__(self, module, name):
+        self.durations = []
+        self._module = module
+        self._name = name
+        self._function = module.__dict__[name]
+        function = self._function
+        durations = self.durations
+        def timed(*args, **kwargs):
+            t0 = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                durations.append(time.time() - t0)
+        setattr(module, name, timed)
+
+    def restore(self):
+        setattr(self._module, self._name, self._function)
+
+class ResourceSampler(object):
+    """
+    Sample process CPU time and resident memory at a fixed interval
+    """
+    def __init__(self, interval):
+        self.samples = []
+        self._start = time.time()
+        self._loop = task.LoopingCall(self.sample)
+        self._loop.start(interval)
+
+    def sample(self):
+        cpu = os.times()
+        self.samples.append({
+            'time': time.time() - self._start,
+            'cpu_seconds': cpu[0] + cpu[1],
+            'rss_bytes': _rss()
+        })
+
+    def stop(self):
+        self.sample()
+        self._loop.stop()
+
+def _rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def percentiles(values, points=(50, 90, 99)):
+    if not values:
+        return {}
+    values = sorted(values)
+    result = {'p%d' % p: values[min(len(values) - 1, int(len(values) * p / 100.0))] for p in points}
+    result['max'] = values[-1]
+    result['mean'] = sum(values) / len(values)
+    return result
+
+class Client(object):
+    """
+    Scripted UDP client
+    """
+    def __init__(self, address, timeout):
+        self._address = address
+        self._skt = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._skt.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+        self._skt.settimeout(timeout)
+        self._timeout = timeout
+        self._reassembler = fragmentation.Reassembler()
+
+    def send(self, msg):
+        self._skt.sendto(bytes(json.dumps(msg)), self._address)
+
+    def receive(self):
+        while True:
+            data, server = self._skt.recvfrom(65536)
+            data = self._reassembler.add(data, server)
+            if data is not None:
+                return wire.decode(data), time.time()
+
+    def request(self, msg, expect):
+        # Send msg and skip other messages until one of the expected commands arrives
+        self.send(msg)
+        while True:
+            response, received = self.receive()
+            if response['command'] in expect:
+                return response
+            if response['command'] == 'error' or response['command'].endswith('_error'):
+                raise RuntimeError(response['message'])
+
+    def drain(self, timeout):
+        # Discard messages until the socket has been quiet for timeout seconds
+        self._skt.settimeout(timeout)
+        try:
+            while True:
+                self.receive()
+        except socket.timeout:
+            pass
+        finally:
+            self._skt.settimeout(self._timeout)
+
+    def close(self):
+        self._skt.close()
+
+def runScenario(num_spectrums, num_channels, args):
+
+    controller = BenchmarkController()
+    port = threads.blockingCallFromThread(reactor, reactor.listenUDP, 0, controller, interface='127.0.0.1')
+    client = Client(('127.0.0.1', port.getHost().port), args.timeout)
+    inserts = Timings(database, 'insertSpectrum')
+    commits = Timings(database.SessionWriter, '_commit')
+    sampler = threads.blockingCallFromThread(reactor, ResourceSampler, args.sample_interval)
+    session_name = "benchmark_%d_%d" % (num_spectrums, num_channels)
+    result = {'num_spectrums': num_spectrums, 'num_channels': num_channels}
+
+    try:
+        client.request({
+            'command': 'detector_config',
+            'wire_format': args.wire_format,
+            'mtu': args.mtu,
+            'detector_data': {
+                'plugin_name': 'simulated',
+                'num_channels': num_channels,
+                'count_rate': args.count_rate,
+                'time_scale': args.time_scale,
+                'seed': 0
+            }
+        }, ('detector_config_success', ))
+
+        # Live acquisition
+        received = {}
+        t0 = time.time()
+        response = client.request({'command': 'start_session', 'session_name': session_name, 'ip': '127.0.0.1',
+            'comment': "benchmark", 'livetime': args.livetime}, ('start_session_success', ))
+        start_latency = time.time() - t0
+        try:
+            while len(received) < num_spectrums:
+                msg, t = client.receive()
+                if msg['command'] == 'spectrum':
+                    received[msg['index']] = t
+        except socket.timeout:
+            pass
+        t1 = time.time()
+        client.request({'command': 'stop_session', 'session_name': session_name}, ('stop_session_success', ))
+
+        # Livetime is reported in the scaled time the detector took, so the
+        # duty cycle can not exceed 1 beyond timer jitter
+        duty_cycle = controller.dutyCycle()
+        if duty_cycle > MAX_DUTY_CYCLE:
+            raise RuntimeError("Duty cycle %.3f above 1, livetime of the detector is not in wall time" % duty_cycle)
+
+        acquired = list(controller.acquired)
+        latencies = [received[i] - acquired[i] for i in received if i < len(acquired)]
+        result['live'] = {
+            'received': len(received),
+            'seconds': t1 - t0,
+            'spectrums_per_second': len(received) / (t1 - t0),
+            'duty_cycle': duty_cycle,
+            'start_latency_seconds': start_latency,
+            'start_latency_daemon_seconds': response['start_latency'],
+            'latency_seconds': percentiles(latencies),
+            'insert_spectrum_seconds': percentiles(inserts.durations),
+            'commit_seconds': percentiles(commits.durations),
+            'commits': len(commits.durations)
+        }
+
+        # Replay of the whole session, after spectrums acquired while stopping
+        client.drain(0.5)
+        count = 0
+        t0 = time.time()
+        complete = None
+        try:
+            client.send({'command': 'sync_session', 'session_name': session_name, 'indices_list': [], 'last_index': -1,
+                'sync_rate': args.sync_rate, 'sync_burst': args.sync_burst})
+            while True:
+                msg, t = client.receive()
+                if msg['command'] == 'spectrum':
+                    count += 1
+                elif msg['command'] == 'sync_session_complete':
+                    complete = msg
+                    break
+        except socket.timeout:
+            pass
+        t1 = time.time()
+        result['sync'] = {
+            'received': count,
+            'sent': complete['count'] if complete is not None else None,
+            'seconds': t1 - t0,
+            'spectrums_per_second': count / (t1 - t0)
+        }
+
+    finally:
+        inserts.restore()
+        commits.restore()
+        threads.blockingCallFromThread(reactor, sampler.stop)
+        result['resources'] = sampler.samples
+        threads.blockingCallFromThread(reactor, port.stopListening)
+        client.close()
+
+    return result
+
+def runBenchmarks(args):
+
+    results = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'settings': vars(args),
+        'scenarios': []
+    }
+    try:
+        for num_spectrums in args.spectrums:
+            for num_channels in args.channels:
+                print("Running %d spectrums with %d channels" % (num_spectrums, num_channels), file=sys.stderr)
+                results['scenarios'].append(runScenario(num_spectrums, num_channels, args))
+    finally:
+        reactor.callFromThread(reactor.stop)
+    return results
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--spectrums', type = lambda s: map(int, s.split(',')), default = [1000], help = "Comma separated session sizes. Default 1000")
+    parser.add_argument('--channels', type = lambda s: map(int, s.split(',')), default = [1024, 4096, 8192], help = "Comma separated channel counts. Default 1024,4096,8192")
+    parser.add_argument('--livetime', type = float, default = 1.0, help = "Simulated livetime in seconds. Default 1")
+    parser.add_argument('--time-scale', type = float, default = 200.0, help = "Speedup of the simulated detector. Default 200")
+    parser.add_argument('--count-rate', type = float, default = 5000.0, help = "Simulated counts per second. Default 5000")
+    parser.add_argument('--wire-format', default = wire.FORMAT_JSON, choices = wire.FORMATS, help = "Format of spectrum messages. Default json")
+    parser.add_argument('--mtu', type = int, help = "Datagram size limit. Default unlimited")
+    parser.add_argument('--sync-rate', type = float, default = 5000.0, help = "Sync datagrams per second. Default 5000")
+    parser.add_argument('--sync-burst', type = int, default = 50, help = "Sync datagram burst. Default 50")
+    parser.add_argument('--sample-interval', type = float, default = 0.5, help = "CPU/RSS sample interval in seconds. Default 0.5")
+    parser.add_argument('--timeout', type = float, default = 10.0, help = "Receive timeout in seconds. Default 10")
+    parser.add_argument('--output', help = "Write results to this file instead of stdout")
+    args = parser.parse_args()
+
+    home = tempfile.mkdtemp(prefix='gc_benchmark_')
+    os.environ['HOME'] = home
+    reactor.suggestThreadPoolSize(4)
+
+    results = {}
+    def run():
+        results.update(runBenchmarks(args))
+    reactor.callWhenRunning(reactor.callInThread, run)
+    try:
+        reactor.run()
+    finally:
+        database.closeReaders()
+        shutil.rmtree(home, ignore_errors=True)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python2
+#
+# Detector controller for gamma measurements
+# Copyright (C) 2016  Norwegain Radiation Protection Authority
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Dag Robole,
+
+# Rebuilds the session catalog from the session databases under ~/gc, each
+# summarized in a worker process, and lists the catalog. The session named
+# in the session journal is cataloged as running.
+
+from __future__ import print_function
+
+import sys, time, argparse
+
+import gc_database as database
+import gc_journal as journal
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type = int, help = "Worker processes summarizing session files. Default one per CPU")
+    parser.add_argument('--list', action = 'store_true', help = "List the catalog instead of rebuilding it")
+    parser.add_argument('--limit', type = int, default = database.MAX_LIST_LIMIT, help = "Sessions listed. Default %d" % database.MAX_LIST_LIMIT)
+    args = parser.parse_args()
+
+    if args.list:
+        sessions, total = database.listSessions(0, args.limit)
+        for entry in sessions:
+            print("%-32s %-24s %-24s %8d %12d %10d%s" % (entry['name'], entry['start_time'] or '-', entry['end_time'] or '-',
+                entry['spectrums'], entry['total_count'], entry['file_size'], " running" if entry['running'] else ""))
+        print("%d of %d sessions" % (len(sessions), total))
+        return
+
+    state = journal.read()
+    started = time.time()
+    count, failed = database.rebuildCatalog(args.processes, state['session_args'].get('session_name') if state is not None else None)
+    for dbpath, error in failed:
+        print("Unable to catalog %s: %s" % (dbpath, error), file=sys.stderr)
+    print("Cataloged %d sessions in %.2f seconds" % (count, time.time() - started))
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
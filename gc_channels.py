@@ -0,0 +1,132 @@
+# Detector controller for gamma measurements
+# Copyright (C) 2016  Norwegain Radiation Protection Authority
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Dag Robole,
+
+import sys, zlib
+from array import array
+
+# Channel storage formats. FORMAT_TEXT is the space separated string used by
+# the first session databases, the others store little-endian uint32 arrays.
+FORMAT_TEXT = 'text'
+FORMAT_UINT32 = 'uint32'
+FORMAT_UINT32_DELTA_ZLIB = 'uint32_delta_zlib'
+
+FORMATS = (FORMAT_TEXT, FORMAT_UINT32, FORMAT_UINT32_DELTA_ZLIB)
+
+# Array typecode holding 32 bit unsigned integers on this platform
+UINT32 = 'I' if array('I').itemsize == 4 else 'L'
+
+_swap = sys.byteorder != 'little'
+
+def toArray(channels):
+    """
+    Convert a channel list, array or space separated string to a uint32 array
+    """
+    if isinstance(channels, array) and channels.typecode == UINT32:
+        return channels
+    if isinstance(channels, basestring):
+        channels = channels.split()
+    return array(UINT32, map(int, channels))
+
+def toText(channels):
+    """
+    Convert channels to the space separated string used by the JSON protocol
+    """
+    if isinstance(channels, basestring):
+        return channels
+    return ' '.join(map(str, channels))
+
+def _delta(channels):
+    values = array(UINT32, channels)
+    for i in xrange(len(values) - 1, 0, -1):
+        values[i] = (values[i] - values[i - 1]) & 0xffffffff
+    return values
+
+def _undelta(values):
+    for i in xrange(1, len(values)):
+        values[i] = (values[i] + values[i - 1]) & 0xffffffff
+    return values
+
+def pack(channels, fmt):
+    """
+    Encode channels for storage using the given format
+    """
+    if fmt == FORMAT_TEXT:
+        return toText(channels)
+    if fmt == FORMAT_UINT32_DELTA_ZLIB:
+        values = _delta(toArray(channels))
+    else:
+        values = toArray(channels)
+    if _swap:
+        values = array(UINT32, values)
+        values.byteswap()
+    data = values.tostring()
+    if fmt == FORMAT_UINT32_DELTA_ZLIB:
+        data = zlib.compress(data)
+    return buffer(data)
+
+def unpack(data, fmt):
+    """
+    Decode stored channels to a uint32 array
+    """
+    if fmt == FORMAT_TEXT:
+        return toArray(data)
+    if fmt == FORMAT_UINT32_DELTA_ZLIB:
+        data = zlib.decompress(data)
+    values = array(UINT32)
+    values.fromstring(str(data))
+    if _swap:
+        values.byteswap()
+    if fmt == FORMAT_UINT32_DELTA_ZLIB:
+        _undelta(values)
+    return values
+
+if __name__ == "__main__":
+
+    # Compare storage size and insert/read speed of the channel formats
+    import os, random, sqlite3, tempfile, time
+
+    num_channels = int(sys.argv[1]) if len(sys.argv) > 1 else 4096
+    num_spectrums = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    random.seed(0)
+    spectrums = []
+    for n in xrange(num_spectrums):
+        spectrums.append(array(UINT32, [int(random.expovariate(1.0 / (400.0 * (1.0 - float(i) / num_channels) + 1.0)))
+            for i in xrange(num_channels)]))
+
+    for fmt in FORMATS:
+        fd, dbpath = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        connection = sqlite3.connect(dbpath)
+        connection.execute("create table spectrum (id integer primary key, channels blob not null)")
+        t0 = time.time()
+        encoded = [(pack(s, fmt), ) for s in spectrums]
+        connection.executemany("insert into spectrum (channels) values (?)", encoded)
+        connection.commit()
+        t1 = time.time()
+        for row in connection.execute("select channels from spectrum"):
+            unpack(row[0], fmt)
+        t2 = time.time()
+        connection.close()
+        size = os.path.getsize(dbpath)
+        os.remove(dbpath)
+        print("%-18s %8.0f bytes/spectrum %8.1f us/insert %8.1f us/read %8.0f bytes/spectrum on disk" % (fmt,
+            sum(len(e[0]) for e in encoded) / float(num_spectrums),
+            (t1 - t0) * 1e6 / num_spectrums, (t2 - t1) * 1e6 / num_spectrums,
+            size / float(num_spectrums)))
@@ -17,7 +17,9 @@
 #
 # Authors: Dag Robole,
 
-import os, json, sqlite3
+import os, json, time, zlib, shutil, threading, multiprocessing, Queue, sqlite3
+from collections import OrderedDict
+import gc_channels as channels
 from gc_exceptions import ProtocolError
 from twisted.python import log
 
@@ -28,7 +30,8 @@ CREATE TABLE `session` (
 	`ip` TEXT NOT NULL,
 	`comment` TEXT,
 	`livetime` REAL NOT NULL,
-	`detector_data` TEXT NOT NULL
+	`detector_data` TEXT NOT NULL,
+	`channel_format` TEXT NOT NULL DEFAULT 'text'
 );
 '''
 
@@ -51,57 +54,861 @@ CREATE TABLE `spectrum` (
 	`speed_error` REAL NOT NULL,
 	`climb` REAL NOT NULL,
 	`climb_error` REAL NOT NULL,
+	`latitude_start` REAL,
+	`longitude_start` REAL,
+	`altitude_start` REAL,
+	`latitude_end` REAL,
+	`longitude_end` REAL,
+	`altitude_end` REAL,
 	`livetime` REAL NOT NULL,
 	`realtime` REAL NOT NULL,
 	`total_count` INTEGER NOT NULL,
 	`num_channels` INTEGER NOT NULL,
-	`channels` TEXT NOT NULL
+	`channels` BLOB NOT NULL,
+	`detector_id` TEXT,
+	`detector_index` INTEGER
 );
 '''
 
-def create(detector_data, msg):
+# Spectrums of each detector are numbered from 0 by detector_index, alongside
+# the session_index they share
+_db_create_index_detector = '''
+CREATE UNIQUE INDEX `spectrum_detector` ON `spectrum` (`detector_id`, `detector_index`);
+'''
+
+# Spectra are handed to a write-behind thread and committed in batches, so the
+# reactor never waits for sqlite or the disk. A batch is committed when it holds
+# BATCH_SIZE spectra or when its oldest spectrum is BATCH_INTERVAL seconds old,
+# whichever comes first.
+#
+# Power loss guarantee: with SYNCHRONOUS = 'FULL' every commit is durable once it
+# returns, so the spectra lost are the ones passed to insertSpectrum since the
+# last commit: the batch being filled and the spectra queued behind it. The
+# queue holds at most QUEUE_BATCHES batches, a writer falling further behind
+# fails and the session is stopped, so at most (QUEUE_BATCHES + 1) * BATCH_SIZE
+# spectra can be lost. With 'NORMAL' the WAL is only synced on checkpoints, and
+# commits made since the last checkpoint may also be lost.
+#
+# A failed commit fails the writer as well, spectra are never dropped quietly.
+BATCH_SIZE = 10
+BATCH_INTERVAL = 5.0
+SYNCHRONOUS = 'FULL'
+QUEUE_BATCHES = 5
+
+# Channel format used for new sessions, see gc_channels
+CHANNEL_FORMAT = channels.FORMAT_UINT32
+
+_synchronous_levels = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+# Sessions start in spare databases with the schema already created, copied
+# from a template. Taking a spare is a rename, the session row is inserted by
+# the writer thread, which then tops the spares up again.
+SPARE_SESSIONS = 2
+
+_spare_lock = threading.Lock()
+
+_db_insert_session = "insert into session (name, ip, comment, livetime, detector_data, channel_format) values (?, ?, ?, ?, ?, ?)"
+
+_db_insert_spectrum = "insert into spectrum (session_id, session_name, session_index, start_time, latitude, latitude_error, longitude, longitude_error, altitude, altitude_error, track, track_error, speed, speed_error, climb, climb_error, latitude_start, longitude_start, altitude_start, latitude_end, longitude_end, altitude_end, livetime, realtime, total_count, num_channels, channels, detector_id, detector_index) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+class SessionWriter(threading.Thread):
+    """
+    Thread class owning the database connection of a running session
+    """
+    def __init__(self, dbpath, session_row, channel_format, batch_size, batch_interval, synchronous, prepared, resume=False):
+        """
+        Initialize the writer thread, the schema is created first unless the
+        database was prepared. A resumed session appends to its existing
+        session row
+        """
+        threading.Thread.__init__(self)
+        self._dbpath = dbpath
+        self._session_row = session_row
+        self._session_id = None
+        self._prepared = prepared
+        self._resume = resume
+        self.error = None # Set if the session could not be created or the writer failed
+        self._channel_format = channel_format
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+        self._synchronous = synchronous
+        self._queue = Queue.Queue(self._batch_size * QUEUE_BATCHES)
+        self._writable = False # Set once the session row is there, cleared by a failed commit
+        self._summary = _emptySummary() # Catalog values of the committed spectrums
+        self._cataloged = 0.0
+        self._stopping = False
+
+    def put(self, spec):
+        # Never blocks the caller, a full queue fails the writer instead
+        try:
+            self._queue.put_nowait(spec)
+        except Queue.Full:
+            if self.error is None:
+                self.error = "Database writer is %d spectrums behind" % self._queue.maxsize
+                log.msg("Database error: %s, spectrums lost" % self.error)
+
+    def close(self):
+        """
+        Commit all queued spectra and stop the thread
+        """
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        """
+        Entry point for the writer thread
+        """
+        try:
+            self._run()
+        except Exception as e:
+            self.error = "%s: %s" % (e.__class__.__name__, str(e))
+            log.err(None, "Session writer failed, spectrums are no longer stored")
+            # Discard the rest of the queue so close still returns
+            while not self._stopping:
+                self._stopping = self._queue.get() is None
+
+    def _run(self):
+        connection = sqlite3.connect(self._dbpath)
+        try:
+            self._write(connection)
+        finally:
+            connection.close()
+        if self._session_id is not None:
+            self._catalog(False)
+
+    def _write(self, connection):
+        try:
+            if not self._prepared:
+                _createSchema(connection)
+            connection.execute("PRAGMA synchronous=%s" % self._synchronous)
+            if self._resume:
+                row = connection.execute("select id from session where name=?", (self._session_row[0], )).fetchone()
+                if row is None:
+                    raise sqlite3.Error("session %s not found" % self._session_row[0])
+                self._session_id = row[0]
+                self._channel_format = channelFormat(connection)
+                self._summary = self._resumeSummary(connection)
+            else:
+                self._session_id = connection.execute(_db_insert_session, self._session_row).lastrowid
+                connection.commit()
+        except sqlite3.Error as e:
+            self._session_id = None
+            self.error = str(e)
+            log.msg("Database error: %s, session not stored" % self.error)
+        else:
+            self._writable = True
+            self._catalog(True)
+        try:
+            prepareSpares()
+        except (IOError, OSError, sqlite3.Error) as e:
+            log.msg("Unable to prepare spare sessions: %s" % str(e))
+        pending = []
+        deadline = None
+        while not self._stopping:
+            try:
+                if pending:
+                    spec = self._queue.get(True, max(0.0, deadline - time.time()))
+                else:
+                    spec = self._queue.get()
+            except Queue.Empty:
+                spec = None
+            else:
+                if spec is None:
+                    self._stopping = True
+                else:
+                    if not pending:
+                        deadline = time.time() + self._batch_interval
+                    pending.append(spec)
+                    if len(pending) < self._batch_size:
+                        continue
+            if pending and self._writable:
+                self._commit(connection, pending)
+            pending = []
+
+    def _resumeSummary(self, connection):
+        # The catalog entry written before the daemon stopped, with the
+        # spectrums committed after it. Spectrum ids count up from 1 and
+        # spectrums are never deleted, so those are the ones with ids above
+        # the cataloged count. Without a matching entry the whole database
+        # is summarized
+        try:
+            summary = _catalogEntry(self._session_row[0])
+        except (sqlite3.Error, OSError) as e:
+            log.msg("Unable to read session catalog: %s" % str(e))
+            summary = None
+        if summary is not None:
+            count = summary['spectrums']
+            last_id = connection.execute("select max(id) from spectrum").fetchone()[0] or 0
+            if last_id >= count:
+                after = _summarize(connection, count)
+                if count + after['spectrums'] == last_id:
+                    _mergeSummary(summary, after)
+                    return summary
+        return _summarize(connection)
+
+    def _catalog(self, running):
+        try:
+            updateCatalog(self._session_row[0], self._summary, self._dbpath, running)
+        except (sqlite3.Error, OSError) as e:
+            log.msg("Unable to update session catalog: %s" % str(e))
+        self._cataloged = time.time()
+
+    def _commit(self, connection, specs):
+        try:
+            connection.executemany(_db_insert_spectrum, [
+                (self._session_id, spec['session_name'], spec['index'], spec['time'],
+                    spec['latitude'], spec['latitude_error'], spec['longitude'], spec['longitude_error'],
+                    spec['altitude'], spec['altitude_error'], spec['track'], spec['track_error'],
+                    spec['speed'], spec['speed_error'], spec['climb'], spec['climb_error'],
+                    spec.get('latitude_start'), spec.get('longitude_start'), spec.get('altitude_start'),
+                    spec.get('latitude_end'), spec.get('longitude_end'), spec.get('altitude_end'),
+                    spec['livetime'], spec['realtime'], spec['total_count'], spec['num_channels'], channels.pack(spec['channels'], self._channel_format),
+                    spec.get('detector_id'), spec.get('detector_index'))
+                for spec in specs])
+            connection.commit()
+            _addToSummary(self._summary, specs)
+            if time.time() - self._cataloged > CATALOG_INTERVAL:
+                self._catalog(True)
+        except sqlite3.Error as e:
+            connection.rollback()
+            self._writable = False
+            self.error = str(e)
+            log.msg("Database error: %s, %d spectrums lost, no more are stored" % (self.error, len(specs)))
+
+def _sessionPath(session_name, create_dir=False):
     dbpath = os.path.expanduser("~/gc/")
-    if not os.path.isdir(dbpath):
+    if create_dir and not os.path.isdir(dbpath):
         os.makedirs(dbpath)
-    dbpath += msg["session_name"] + ".db"
-    connection = sqlite3.connect(dbpath)
-    cursor = connection.cursor()
-    cursor.execute(_db_create_table_session)
-    cursor.execute(_db_create_table_spectrum)
-    cursor.execute("insert into session (name, ip, comment, livetime, detector_data) values (?, ?, ?, ?, ?)",
-           (msg['session_name'], msg['ip'], msg['comment'], msg['livetime'], json.dumps(detector_data)))
+    return dbpath + session_name + ".db"
+
+def _createSchema(connection):
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(_db_create_table_session)
+    connection.execute(_db_create_table_spectrum)
+    connection.execute(_db_create_index_detector)
     connection.commit()
-    return connection
 
-def close(connection):
-    if connection is not None:
-        connection.close()
+def _spareDir():
+    return os.path.expanduser("~/gc/.spare/")
+
+# Spares are named after the schema they were made with, so a schema change
+# never starts a session in an old layout
+_spare_prefix = "spare_%08x_" % (zlib.crc32(_db_create_table_session + _db_create_table_spectrum + _db_create_index_detector) & 0xffffffff)
 
-def insertSpectrum(connection, spec):
-    if connection is None:
+def prepareSpares(count=SPARE_SESSIONS):
+    """
+    Make sure count spare session databases are ready
+    """
+    with _spare_lock:
+        spare_dir = _spareDir()
+        if not os.path.isdir(spare_dir):
+            os.makedirs(spare_dir)
+        template = spare_dir + _spare_prefix + "template"
+        for name in os.listdir(spare_dir):
+            if not name.startswith(_spare_prefix) or name.endswith(".tmp"):
+                os.remove(spare_dir + name)
+        if not os.path.isfile(template):
+            connection = sqlite3.connect(template + ".tmp")
+            try:
+                _createSchema(connection)
+            finally:
+                connection.close()
+            os.rename(template + ".tmp", template)
+        spares = [name for name in os.listdir(spare_dir) if name.startswith(_spare_prefix) and name.endswith(".db")]
+        for n in xrange(len(spares), count):
+            path = spare_dir + _spare_prefix + "%d_%d.db" % (int(time.time() * 1e6), n)
+            shutil.copyfile(template, path + ".tmp")
+            os.rename(path + ".tmp", path)
+
+def _takeSpare(dbpath):
+    # Move a spare database to dbpath, returns False if there was none
+    with _spare_lock:
+        spare_dir = _spareDir()
+        if not os.path.isdir(spare_dir):
+            return False
+        for name in sorted(os.listdir(spare_dir)):
+            if name.startswith(_spare_prefix) and name.endswith(".db"):
+                os.rename(spare_dir + name, dbpath)
+                return True
+    return False
+
+def sessionFile(session_name):
+    """
+    Return the path of a session database, None if there is no such session
+    """
+    if not session_name or os.sep in session_name or session_name.startswith('.'):
+        return None
+    dbpath = _sessionPath(session_name)
+    return dbpath if os.path.isfile(dbpath) else None
+
+def _writerOptions(msg, command):
+    # Database options of a start_session message, checked before any file
+    # is touched
+    synchronous = str(msg.get('db_synchronous', SYNCHRONOUS)).upper()
+    if synchronous not in _synchronous_levels:
+        raise ProtocolError(command, "Invalid database synchronous level: %s" % synchronous)
+    try:
+        batch_size = int(msg.get('db_batch_size', BATCH_SIZE))
+        batch_interval = float(msg.get('db_batch_interval', BATCH_INTERVAL))
+    except (TypeError, ValueError):
+        raise ProtocolError(command, "Invalid database batch size or interval")
+    if batch_size < 1 or not batch_interval > 0.0:
+        raise ProtocolError(command, "Invalid database batch size or interval")
+    return batch_size, batch_interval, synchronous
+
+def create(detector_data, msg):
+    batch_size, batch_interval, synchronous = _writerOptions(msg, 'start_session_error')
+    channel_format = msg.get('db_channel_format', CHANNEL_FORMAT)
+    if channel_format not in channels.FORMATS:
+        raise ProtocolError('start_session_error', "Invalid channel format: %s" % channel_format)
+    session_row = (msg['session_name'], msg['ip'], msg['comment'], msg['livetime'], json.dumps(detector_data), channel_format)
+    dbpath = _sessionPath(msg["session_name"], True)
+    if os.path.exists(dbpath):
+        raise ProtocolError('start_session_error', "Session %s already exists" % msg["session_name"])
+    try:
+        prepared = _takeSpare(dbpath)
+    except OSError as e:
+        log.msg("Unable to use spare session: %s" % str(e))
+        prepared = False
+    writer = SessionWriter(dbpath, session_row, channel_format, batch_size, batch_interval, synchronous, prepared)
+    writer.start()
+    return writer
+
+def resume(detector_data, msg):
+    """
+    Return a writer appending to the database of an interrupted session
+    """
+    batch_size, batch_interval, synchronous = _writerOptions(msg, 'error')
+    dbpath = sessionFile(msg['session_name'])
+    if dbpath is None:
+        raise ProtocolError('error', "Session database of %s not found" % msg['session_name'])
+    session_row = (msg['session_name'], msg['ip'], msg['comment'], msg['livetime'], json.dumps(detector_data), None)
+    writer = SessionWriter(dbpath, session_row, None, batch_size, batch_interval, synchronous, True, True)
+    writer.start()
+    return writer
+
+def close(writer):
+    if writer is not None:
+        writer.close()
+
+def insertSpectrum(writer, spec):
+    if writer is None:
         return
-    cursor = connection.cursor()
-    cursor.execute("select id from session where name=?", (spec['session_name'], ))
-    row = cursor.fetchone()
-    cursor.execute("insert into spectrum (session_id, session_name, session_index, start_time, latitude, latitude_error, longitude, longitude_error, altitude, altitude_error, track, track_error, speed, speed_error, climb, climb_error, livetime, realtime, total_count, num_channels, channels) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-           (int(row[0]), spec['session_name'], spec['index'], spec['time'],
-               spec['latitude'], spec['latitude_error'], spec['longitude'], spec['longitude_error'],
-               spec['altitude'], spec['altitude_error'], spec['track'], spec['track_error'],
-               spec['speed'], spec['speed_error'], spec['climb'], spec['climb_error'],
-               spec['livetime'], spec['realtime'], spec['total_count'], spec['num_channels'], spec['channels']))
-    connection.commit()
+    writer.put(spec)
 
-def getSyncSpectrums(session_name, indices_list, last_index):
-    dbpath = os.path.expanduser("~/gc/")
-    if not os.path.isdir(dbpath):
-        os.makedirs(dbpath)
-    dbpath += session_name + ".db"
+def channelFormat(connection):
+    """
+    Return the channel format of a session database, databases created before
+    the format was recorded in the session table store channels as text
+    """
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(session)")]
+    if 'channel_format' not in columns:
+        return channels.FORMAT_TEXT
+    row = connection.execute("select channel_format from session limit 1").fetchone()
+    return row[0] if row is not None else channels.FORMAT_TEXT
+
+def migrate(session_name, channel_format=CHANNEL_FORMAT):
+    """
+    Convert the channels of a finished session database to another format
+    """
+    if channel_format not in channels.FORMATS:
+        raise ProtocolError('error', "Invalid channel format: %s" % channel_format)
+    dbpath = _sessionPath(session_name)
     if not os.path.isfile(dbpath):
         raise ProtocolError('error', "Session database not found")
-    conn = sqlite3.connect(dbpath)
-    cur = conn.cursor()
-    cur.execute("select * from spectrum where session_index in ({seq}) or session_index > {last}".format(seq=','.join(map(str, indices_list)), last=last_index))
-    res = cur.fetchall()
-    conn.close()
-    return res
+    if any(reader.dbpath == dbpath for reader in _busy_readers):
+        raise ProtocolError('error', "Session %s is being synced" % session_name)
+    reader = _readers.pop(dbpath, None)
+    if reader is not None:
+        reader.close()
+    connection = sqlite3.connect(dbpath)
+    try:
+        old_format = channelFormat(connection)
+        if old_format == channel_format:
+            return
+        if 'channel_format' not in [row[1] for row in connection.execute("PRAGMA table_info(session)")]:
+            connection.execute("alter table session add column `channel_format` TEXT NOT NULL DEFAULT 'text'")
+        rows = connection.execute("select id, channels from spectrum").fetchall()
+        connection.executemany("update spectrum set channels=? where id=?",
+                [(channels.pack(channels.unpack(row[1], old_format), channel_format), row[0]) for row in rows])
+        connection.execute("update session set channel_format=?", (channel_format, ))
+        connection.commit()
+        connection.execute("VACUUM")
+    finally:
+        connection.close()
+
+# The catalog holds one entry per session database, so sessions can be listed
+# without opening their files. The writer thread of a session keeps its entry
+# up to date from the spectrums it commits, at most every CATALOG_INTERVAL
+# seconds and when the session is closed. rebuildCatalog makes the catalog
+# again from the session files. Positions at 0, 0 are taken as missing fixes
+# and left out of the bounding box
+CATALOG_FILE = "~/gc/.catalog.db"
+CATALOG_INTERVAL = 30.0
+CATALOG_TIMEOUT = 10.0
+
+# Default and largest number of entries listed at a time
+LIST_LIMIT = 20
+MAX_LIST_LIMIT = 100
+
+_db_create_table_catalog = '''
+CREATE TABLE IF NOT EXISTS `catalog` (
+	`name` TEXT NOT NULL PRIMARY KEY,
+	`start_time` TEXT,
+	`end_time` TEXT,
+	`spectrums` INTEGER NOT NULL,
+	`livetime` REAL NOT NULL,
+	`total_count` INTEGER NOT NULL,
+	`latitude_min` REAL,
+	`latitude_max` REAL,
+	`longitude_min` REAL,
+	`longitude_max` REAL,
+	`file_size` INTEGER NOT NULL,
+	`running` INTEGER NOT NULL DEFAULT 0
+);
+'''
+
+_db_create_index_catalog = '''
+CREATE INDEX IF NOT EXISTS `catalog_start_time` ON `catalog` (`start_time`);
+'''
+
+_summary_fields = ('start_time', 'end_time', 'spectrums', 'livetime', 'total_count',
+    'latitude_min', 'latitude_max', 'longitude_min', 'longitude_max')
+
+_catalog_fields = ('name', ) + _summary_fields + ('file_size', 'running')
+
+_db_replace_catalog = "insert or replace into catalog (%s) values (%s)" % (
+    ', '.join(_catalog_fields), ', '.join(':' + field for field in _catalog_fields))
+
+_db_summarize = '''
+select count(*), total(livetime), total(total_count), min(nullif(start_time, '')), max(nullif(start_time, '')),
+    min(case when latitude != 0 or longitude != 0 then latitude end),
+    max(case when latitude != 0 or longitude != 0 then latitude end),
+    min(case when latitude != 0 or longitude != 0 then longitude end),
+    max(case when latitude != 0 or longitude != 0 then longitude end)
+from spectrum where id > ?
+'''
+
+def _emptySummary():
+    return {'spectrums': 0, 'livetime': 0.0, 'total_count': 0, 'start_time': None, 'end_time': None,
+        'latitude_min': None, 'latitude_max': None, 'longitude_min': None, 'longitude_max': None}
+
+def _summarize(connection, after=0):
+    # Catalog values of the spectrums of a session database, those with ids
+    # above after
+    row = connection.execute(_db_summarize, (after, )).fetchone()
+    return {'spectrums': row[0], 'livetime': row[1], 'total_count': int(row[2]), 'start_time': row[3], 'end_time': row[4],
+        'latitude_min': row[5], 'latitude_max': row[6], 'longitude_min': row[7], 'longitude_max': row[8]}
+
+def _addToSummary(summary, specs):
+    # Catalog values updated with committed spectrums, as _summarize would
+    # find them
+    def bound(key, value, f):
+        summary[key] = value if summary[key] is None else f(summary[key], value)
+    for spec in specs:
+        summary['spectrums'] += 1
+        summary['livetime'] += float(spec['livetime'])
+        summary['total_count'] += int(spec['total_count'])
+        if spec['time']:
+            bound('start_time', spec['time'], min)
+            bound('end_time', spec['time'], max)
+        if spec['latitude'] != 0 or spec['longitude'] != 0:
+            bound('latitude_min', spec['latitude'], min)
+            bound('latitude_max', spec['latitude'], max)
+            bound('longitude_min', spec['longitude'], min)
+            bound('longitude_max', spec['longitude'], max)
+
+def _mergeSummary(summary, other):
+    # Catalog values of both summaries
+    for key in ('spectrums', 'livetime', 'total_count'):
+        summary[key] += other[key]
+    for key, f in (('start_time', min), ('end_time', max), ('latitude_min', min), ('latitude_max', max),
+            ('longitude_min', min), ('longitude_max', max)):
+        if other[key] is not None:
+            summary[key] = other[key] if summary[key] is None else f(summary[key], other[key])
+
+def _openCatalog():
+    path = os.path.expanduser(CATALOG_FILE)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    connection = sqlite3.connect(path, timeout=CATALOG_TIMEOUT)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(_db_create_table_catalog)
+    connection.execute(_db_create_index_catalog)
+    return connection
+
+def updateCatalog(session_name, summary, dbpath, running):
+    """
+    Replace the catalog entry of a session
+    """
+    connection = _openCatalog()
+    try:
+        with connection:
+            connection.execute(_db_replace_catalog, dict(summary, name=session_name,
+                file_size=os.path.getsize(dbpath), running=int(running)))
+    finally:
+        connection.close()
+
+def _catalogEntry(session_name):
+    # Catalog values of a session, None if it is not cataloged
+    connection = _openCatalog()
+    try:
+        row = connection.execute("select %s from catalog where name=?" % ', '.join(_summary_fields), (session_name, )).fetchone()
+    finally:
+        connection.close()
+    return dict(zip(_summary_fields, row)) if row is not None else None
+
+def listSessions(offset=0, limit=LIST_LIMIT, name=None, since=None, until=None, running=None, area=None):
+    """
+    Return catalog entries matching the filters, the most recent first, and
+    the number of entries matching. Name matches part of session names, since
+    and until are ISO 8601 times the sessions must overlap and area is a
+    bounding box (latitude_min, longitude_min, latitude_max, longitude_max)
+    the sessions must overlap
+    """
+    clauses, params = [], []
+    if name is not None:
+        clauses.append("instr(name, ?) > 0")
+        params.append(name)
+    if since is not None:
+        clauses.append("end_time >= ?")
+        params.append(since)
+    if until is not None:
+        clauses.append("start_time <= ?")
+        params.append(until)
+    if running is not None:
+        clauses.append("running = ?")
+        params.append(int(running))
+    if area is not None:
+        clauses.append("latitude_max >= ? and longitude_max >= ? and latitude_min <= ? and longitude_min <= ?")
+        params.extend(area)
+    where = " where " + " and ".join(clauses) if clauses else ""
+    connection = _openCatalog()
+    try:
+        connection.row_factory = sqlite3.Row
+        total = connection.execute("select count(*) from catalog" + where, params).fetchone()[0]
+        rows = connection.execute("select * from catalog" + where + " order by start_time is null, start_time desc, name limit ? offset ?",
+                params + [limit, offset]).fetchall()
+    finally:
+        connection.close()
+    sessions = []
+    for row in rows:
+        entry = dict(zip(row.keys(), row))
+        entry['running'] = bool(entry['running'])
+        sessions.append(entry)
+    return sessions, total
+
+def _summarizeFile(dbpath):
+    # Catalog entry of a session database file, runs in the rebuild workers
+    try:
+        connection = sqlite3.connect(dbpath, timeout=CATALOG_TIMEOUT)
+        try:
+            summary = _summarize(connection)
+        finally:
+            connection.close()
+        return dbpath, summary, os.path.getsize(dbpath), None
+    except (sqlite3.Error, OSError) as e:
+        return dbpath, None, 0, str(e)
+
+def rebuildCatalog(processes=None, running=None):
+    """
+    Make the catalog again from the session databases, summarized by
+    processes worker processes, one per CPU by default. running names the
+    session still running, if any. Returns the number of sessions and the
+    files that could not be read
+    """
+    directory = os.path.expanduser("~/gc")
+    paths = [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if
+            name.endswith('.db') and not name.startswith('.')] if os.path.isdir(directory) else []
+    if processes == 1 or len(paths) < 2:
+        results = map(_summarizeFile, paths)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_summarizeFile, paths, 1)
+        finally:
+            pool.close()
+            pool.join()
+    failed = []
+    connection = _openCatalog()
+    try:
+        with connection:
+            connection.execute("delete from catalog")
+            for dbpath, summary, size, error in results:
+                if summary is None:
+                    failed.append((dbpath, error))
+                    continue
+                session_name = os.path.basename(dbpath)[:-len('.db')]
+                connection.execute(_db_replace_catalog, dict(summary, name=session_name, file_size=size,
+                    running=int(session_name == running)))
+    finally:
+        connection.close()
+    return len(results) - len(failed), failed
+
+def prepareCatalog(running=None):
+    """
+    Build the catalog if there is none
+    """
+    if not os.path.isfile(os.path.expanduser(CATALOG_FILE)):
+        count, failed = rebuildCatalog(1, running)
+        log.msg("Session catalog built, %d sessions" % count)
+        for dbpath, error in failed:
+            log.msg("Unable to catalog %s: %s" % (dbpath, error))
+
+_window_fields = ('latitude_start', 'longitude_start', 'altitude_start', 'latitude_end', 'longitude_end', 'altitude_end')
+
+_detector_fields = ('detector_id', 'detector_index')
+
+def _rowToSpectrum(row, channel_format):
+    spec = {
+        'command': 'spectrum',
+        'session_name': row['session_name'],
+        'index': row['session_index'],
+        'time': row['start_time'],
+        'latitude': row['latitude'],
+        'latitude_error': row['latitude_error'],
+        'longitude': row['longitude'],
+        'longitude_error': row['longitude_error'],
+        'altitude': row['altitude'],
+        'altitude_error': row['altitude_error'],
+        'track': row['track'],
+        'track_error': row['track_error'],
+        'speed': row['speed'],
+        'speed_error': row['speed_error'],
+        'climb': row['climb'],
+        'climb_error': row['climb_error'],
+        'livetime': row['livetime'],
+        'realtime': row['realtime'],
+        'total_count': row['total_count'],
+        'num_channels': row['num_channels'],
+        'channels': channels.unpack(row['channels'], channel_format)
+    }
+    # Databases from before positions were interpolated have no window
+    # columns, nor detector columns from before sessions had several detectors
+    keys = row.keys()
+    for field in _window_fields + _detector_fields:
+        if field in keys and row[field] is not None:
+            spec[field] = row[field]
+    return spec
+
+# Number of session databases kept open for reading
+READER_POOL_SIZE = 4
+
+# Index lists compressing to more ranges than this are passed to sqlite as one
+# JSON parameter instead of one BETWEEN clause per range
+SYNC_INLINE_RANGES = 16
+
+_MAX_INDEX = 2**63 - 1
+
+_readers = OrderedDict()
+_busy_readers = set() # Readers with users, in the pool or not
+
+class _Reader(object):
+    """
+    Query only connection to a session database. Readers with users left are
+    not closed when they leave the pool, the last user closes them
+    """
+    def __init__(self, dbpath):
+        self.dbpath = dbpath
+        self.users = 0
+        self.closed = False
+        self.connection = sqlite3.connect(dbpath)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA query_only=ON")
+        self._channel_format = None
+        try:
+            self.connection.execute("select json_array()")
+            self.has_json = True
+        except sqlite3.OperationalError:
+            self.has_json = False
+
+    @property
+    def channel_format(self):
+        # The writer thread of a new session inserts the session row after
+        # the database is opened, the format is only cached once it is there
+        if self._channel_format is None and self.connection.execute("select 1 from session limit 1").fetchone() is not None:
+            self._channel_format = channelFormat(self.connection)
+        return self._channel_format
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.connection.close()
+
+class _Rows(object):
+    """
+    Iterator over the spectrums of range queries, keeping its reader open
+    until it is exhausted or closed
+    """
+    def __init__(self, reader, queries, chunk_size):
+        reader.users += 1
+        _busy_readers.add(reader)
+        self._reader = reader
+        self._rows = _iterRows(reader, queries, chunk_size)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return next(self._rows)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if self._reader is None:
+            return
+        self._rows.close()
+        reader, self._reader = self._reader, None
+        reader.users -= 1
+        if reader.users == 0:
+            _busy_readers.discard(reader)
+            if _readers.get(reader.dbpath) is not reader:
+                reader.close()
+
+def _getReader(session_name):
+    dbpath = _sessionPath(session_name)
+    reader = _readers.pop(dbpath, None)
+    if reader is None:
+        if not os.path.isfile(dbpath):
+            raise ProtocolError('error', "Session database not found")
+        reader = _Reader(dbpath)
+        while len(_readers) >= READER_POOL_SIZE:
+            evicted = _readers.popitem(False)[1]
+            if evicted.users == 0:
+                evicted.close()
+    _readers[dbpath] = reader
+    return reader
+
+def closeReaders():
+    while _readers:
+        _readers.popitem()[1].close()
+
+def compressRanges(indices):
+    """
+    Compress a list of indices to sorted, non overlapping (first, last) ranges
+    """
+    ranges = []
+    for index in sorted(set(map(int, indices))):
+        if ranges and index == ranges[-1][1] + 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return [tuple(r) for r in ranges]
+
+def _syncRanges(indices_list, last_index, resume_index):
+    ranges = compressRanges(i for i in indices_list if i <= last_index)
+    ranges.append((int(last_index) + 1, _MAX_INDEX))
+    return [(max(first, resume_index + 1), last) for first, last in ranges if last > resume_index]
+
+def iterSyncSpectrums(session_name, indices_list, last_index, resume_index=-1, chunk_size=100):
+    """
+    Return an iterator over the spectrums requested by a sync, ordered by index.
+    Rows are fetched chunk_size at a time and spectrums with index not above
+    resume_index are skipped
+    """
+    reader = _getReader(session_name)
+    ranges = _syncRanges(list(indices_list), int(last_index), int(resume_index))
+    return _Rows(reader, _rangeQueries(reader, ranges), chunk_size)
+
+def getSpectrums(session_name, indices):
+    """
+    Return the stored spectrums with the given indices, ordered by index.
+    The lookup has a connection of its own, so it can run on any thread
+    """
+    dbpath = sessionFile(session_name)
+    if dbpath is None:
+        raise ProtocolError('error', "Session database not found")
+    reader = _Reader(dbpath)
+    try:
+        return list(_iterRows(reader, _rangeQueries(reader, compressRanges(indices)), 100))
+    finally:
+        reader.close()
+
+def _rangeQueries(reader, ranges):
+    # Queries selecting the spectrums in the sorted, disjoint index ranges
+    if reader.has_json and len(ranges) > SYNC_INLINE_RANGES:
+        queries = [("select spectrum.* from json_each(?) as r join spectrum on spectrum.session_index between json_extract(r.value, '$[0]') and json_extract(r.value, '$[1]') order by spectrum.session_index",
+            (json.dumps(ranges), ))]
+    else:
+        queries = []
+        for i in xrange(0, len(ranges), SYNC_INLINE_RANGES):
+            batch = ranges[i:i + SYNC_INLINE_RANGES]
+            queries.append(("select * from spectrum where " + " or ".join(["session_index between ? and ?"] * len(batch))
+                + " order by session_index", [index for r in batch for index in r]))
+    return queries
+
+def _iterRows(reader, queries, chunk_size):
+    # Ranges are sorted and disjoint, so running the queries in turn keeps the
+    # spectrums ordered by index. The format is looked up once rows are
+    # found, the session row is committed before any spectrum
+    for query, params in queries:
+        cur = reader.connection.execute(query, params)
+        try:
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                channel_format = reader.channel_format
+                for row in rows:
+                    yield _rowToSpectrum(row, channel_format)
+        finally:
+            cur.close()
+
+def getSyncSpectrums(session_name, indices_list, last_index):
+    return list(iterSyncSpectrums(session_name, indices_list, last_index))
+
+if __name__ == "__main__":
+
+    # Benchmark sync queries against sessions of 10k and 100k spectrums
+    import sys, random, shutil, tempfile
+
+    num_channels = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+
+    os.environ['HOME'] = tempfile.mkdtemp()
+    random.seed(0)
+    spectrum_channels = channels.toArray([random.randint(0, 100) for i in xrange(num_channels)])
+
+    def legacyQuery(session_name, indices_list, last_index):
+        conn = sqlite3.connect(_sessionPath(session_name))
+        conn.row_factory = sqlite3.Row
+        res = [_rowToSpectrum(row, channels.FORMAT_UINT32) for row in conn.execute(
+            "select * from spectrum where session_index in ({seq}) or session_index > {last}".format(
+            seq=','.join(map(str, indices_list)), last=last_index)).fetchall()]
+        conn.close()
+        return res
+
+    try:
+        for num_spectrums in (10000, 100000):
+            session_name = "bench_%d" % num_spectrums
+            writer = create({}, {'session_name': session_name, 'ip': '127.0.0.1', 'comment': "benchmark",
+                'livetime': 1.0, 'db_batch_size': 1000, 'db_synchronous': 'OFF'})
+            for index in xrange(num_spectrums):
+                insertSpectrum(writer, {'session_name': session_name, 'index': index, 'time': '',
+                    'latitude': 0.0, 'latitude_error': 0.0, 'longitude': 0.0, 'longitude_error': 0.0,
+                    'altitude': 0.0, 'altitude_error': 0.0, 'track': 0.0, 'track_error': 0.0,
+                    'speed': 0.0, 'speed_error': 0.0, 'climb': 0.0, 'climb_error': 0.0,
+                    'livetime': 1.0, 'realtime': 1.0, 'total_count': 0, 'num_channels': num_channels,
+                    'channels': spectrum_channels})
+            close(writer)
 
+            cases = [
+                ("tail", [], num_spectrums - 100),
+                ("gap 100..5000", range(100, 5001), num_spectrums - 1),
+                ("1% scattered", random.sample(xrange(num_spectrums), num_spectrums / 100), num_spectrums - 1),
+                ("10% scattered", random.sample(xrange(num_spectrums), num_spectrums / 10), num_spectrums - 1)
+            ]
+            for name, indices_list, last_index in cases:
+                t0 = time.time()
+                count = len(getSyncSpectrums(session_name, indices_list, last_index))
+                t1 = time.time()
+                try:
+                    legacyQuery(session_name, indices_list, last_index)
+                    legacy = "%8.1f ms" % ((time.time() - t1) * 1000.0)
+                except sqlite3.Error as e:
+                    legacy = "failed (%s)" % str(e)
+                print("%6d spectrums %-14s %6d rows %8.1f ms, legacy %s" % (num_spectrums, name, count, (t1 - t0) * 1000.0, legacy))
+    finally:
+        closeReaders()
+        shutil.rmtree(os.environ['HOME'])
@@ -0,0 +1,173 @@
+# Detector controller for gamma measurements
+# Copyright (C) 2016  Norwegain Radiation Protection Authority
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Dag Robole,
+
+# Transfer of a session database file
+#
+# The file is sent as it is, in chunks with a crc32 each. The client answers
+# with dump_ack messages naming the next chunk it needs, the daemon keeps at
+# most window chunks beyond that in flight and goes back to the acknowledged
+# chunk when acks stop coming. A dump_session request with an offset resumes
+# the transfer, provided the snapshot id still matches.
+#
+# A running session keeps changing the file, so the transfer reads a
+# snapshot: a read transaction is held open after the WAL has been fully
+# checkpointed. Checkpoints can not copy frames newer than an open read
+# transaction into the file, so the file stays as it was for the whole
+# transfer while the session writes on into the WAL.
+
+import time, mmap, zlib, sqlite3
+
+from twisted.internet import reactor, defer
+
+import gc_transport as transport
+
+# Default and largest chunk size in bytes, chunks larger than the MTU are
+# fragmented
+DUMP_CHUNK_SIZE = 32768
+MAX_CHUNK_SIZE = 60000
+
+# Default and largest number of unacknowledged chunks in flight. A full window
+# is sent in one reactor turn
+DUMP_WINDOW = 16
+MAX_DUMP_WINDOW = 64
+
+# Seconds without acks before resending from the acknowledged chunk, and
+# before giving up on the client
+DUMP_TIMEOUT = 1.0
+DUMP_IDLE_TIMEOUT = 30.0
+
+# Attempts at finding the WAL fully checkpointed
+SNAPSHOT_ATTEMPTS = 20
+
+class Snapshot(object):
+    """
+    Read only view of a session database file that stays consistent while
+    it is open
+    """
+    def __init__(self, dbpath):
+        """
+        Open the snapshot, this blocks while waiting for a quiet moment
+        between commits
+        """
+        self._connection = sqlite3.connect(dbpath, isolation_level=None, check_same_thread=False)
+        try:
+            for attempt in xrange(SNAPSHOT_ATTEMPTS):
+                self._connection.execute("BEGIN")
+                count, last = self._connection.execute("select count(*), max(session_index) from spectrum").fetchone()
+                page_count = self._connection.execute("PRAGMA page_count").fetchone()[0]
+                page_size = self._connection.execute("PRAGMA page_size").fetchone()[0]
+                checkpoint = sqlite3.connect(dbpath)
+                try:
+                    busy, frames, copied = checkpoint.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+                finally:
+                    checkpoint.close()
+                # Every frame copied means the file holds what the read
+                # transaction sees, a commit since would have left frames
+                if frames == copied:
+                    break
+                self._connection.execute("ROLLBACK")
+                time.sleep(0.05 * (attempt + 1))
+            else:
+                raise IOError("Session database is too busy to take a snapshot")
+
+            self.size = page_count * page_size
+            self.spectrums = count
+            self.id = zlib.crc32("%d:%d:%s" % (self.size, count, last)) & 0xffffffff
+            self._file = open(dbpath, 'rb')
+            self._map = mmap.mmap(self._file.fileno(), self.size, access=mmap.ACCESS_READ) if self.size > 0 else None
+        except Exception:
+            self._connection.close()
+            raise
+
+    def read(self, offset, size):
+        return self._map[offset:offset + size] if self._map is not None else ''
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+        self._connection.close()
+
+class DumpTransfer(object):
+    """
+    Send the chunks of a snapshot to one client
+    """
+    def __init__(self, send, snapshot, chunk_size=DUMP_CHUNK_SIZE, window=DUMP_WINDOW, offset=0, clock=time.time):
+        """
+        Initialize the transfer, send is called with each chunk message.
+        Offset is the first chunk to send
+        """
+        self._send = send
+        self.snapshot = snapshot
+        self.chunk_size = chunk_size
+        self.chunks = (snapshot.size + chunk_size - 1) // chunk_size
+        self._window = max(1, window)
+        self.offset = min(max(0, offset), self.chunks)
+        self._acked = self.offset # Next chunk the client needs
+        self._next = self._acked # Next chunk to send
+        self._clock = clock
+        self._progress = clock()
+        self._timer = None
+        self.sent = 0
+        self.resent = 0
+        self.done = defer.Deferred()
+
+    def start(self):
+        self._timer = reactor.callLater(DUMP_TIMEOUT, self._timeout)
+        self._fill()
+
+    def ack(self, index):
+        if index > self._acked:
+            self._acked = min(index, self.chunks)
+            self._next = max(self._next, self._acked)
+            self._progress = self._clock()
+            if self._timer is not None and self._timer.active():
+                self._timer.reset(DUMP_TIMEOUT)
+        self._fill()
+
+    def stop(self):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        self.snapshot.close()
+
+    def _fill(self):
+        if self._timer is None:
+            return
+        if self._acked >= self.chunks:
+            self.stop()
+            self.done.callback(self)
+            return
+        while self._next < min(self._acked + self._window, self.chunks):
+            data = self.snapshot.read(self._next * self.chunk_size, self.chunk_size)
+            self._send(transport.encodeChunk(self.snapshot.id, self._next, data))
+            self._next += 1
+            self.sent += 1
+
+    def _timeout(self):
+        if self._clock() - self._progress > DUMP_IDLE_TIMEOUT:
+            self.stop()
+            self.done.errback(IOError("Dump abandoned, no acknowledgement for %.0f seconds" % DUMP_IDLE_TIMEOUT))
+            return
+        # Go back to the first chunk the client is missing
+        self.resent += self._next - self._acked
+        self._next = self._acked
+        self._timer = reactor.callLater(DUMP_TIMEOUT, self._timeout)
+        self._fill()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python2
+#
+# Fake gpsd for testing the gamma measurement daemon
+# Copyright (C) 2016  Norwegain Radiation Protection Authority
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Dag Robole,
+
+# Serves the gpsd JSON protocol on a TCP port. Clients that send ?WATCH get
+# TPV reports at a fixed rate, replayed from a log or generated along a
+# circular track. Each report is stamped with the time it is sent, so the
+# latency of a fix is the time the reader received it minus its gps time.
+#
+# Logs may hold gpsd JSON lines, as written by gpspipe -w, or NMEA sentences.
+# RMC and GGA sentences are merged into TPV reports, other lines are skipped.
+
+from __future__ import print_function
+
+import sys, json, math, time, argparse, threading
+
+from twisted.internet import reactor, task, protocol
+from twisted.protocols.basic import LineReceiver
+
+import gc_gps as gps
+
+_version = {'class': 'VERSION', 'release': 'fake', 'proto_major': 3, 'proto_minor': 11}
+
+def formatTime(epoch):
+    """
+    Format a gpsd time string with microsecond resolution
+    """
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(epoch)) + '.%06dZ' % int((epoch % 1.0) * 1e6)
+
+def _nmeaCoordinate(value, hemisphere):
+    # NMEA coordinates are (d)ddmm.mmmm
+    if not value:
+        return None
+    degrees = int(float(value) / 100.0)
+    coordinate = degrees + (float(value) - degrees * 100.0) / 60.0
+    return -coordinate if hemisphere in ('S', 'W') else coordinate
+
+def parseNmea(lines):
+    """
+    Merge RMC and GGA sentences into TPV reports
+    """
+    report = {'class': 'TPV', 'mode': 1}
+    for line in lines:
+        fields = line.strip().split('*')[0].split(',')
+        sentence = fields[0][3:]
+        if sentence == 'RMC' and len(fields) > 8:
+            if fields[2] != 'A':
+                report['mode'] = 1
+            else:
+                report['mode'] = max(report['mode'], 2)
+                report['lat'] = _nmeaCoordinate(fields[3], fields[4])
+                report['lon'] = _nmeaCoordinate(fields[5], fields[6])
+                if fields[7]:
+                    report['speed'] = float(fields[7]) * 0.514444 # Knots to m/s
+                if fields[8]:
+                    report['track'] = float(fields[8])
+        elif sentence == 'GGA' and len(fields) > 9:
+            if fields[6] in ('', '0'):
+                report['mode'] = 1
+            else:
+                report['lat'] = _nmeaCoordinate(fields[2], fields[3])
+                report['lon'] = _nmeaCoordinate(fields[4], fields[5])
+                if fields[9]:
+                    report['alt'] = float(fields[9])
+                    report['mode'] = 3
+        else:
+            continue
+        yield dict((k, v) for k, v in report.iteritems() if v is not None)
+
+def loadLog(path):
+    """
+    Read TPV reports from a gpsd JSON or NMEA log
+    """
+    with open(path) as f:
+        lines = f.readlines()
+    reports = []
+    for line in lines:
+        if line.startswith('{'):
+            try:
+                report = json.loads(line)
+            except ValueError:
+                continue
+            if report.get('class') == 'TPV':
+                reports.append(report)
+    reports.extend(parseNmea(line for line in lines if line.startswith('$')))
+    return reports
+
+def syntheticTrack(count, latitude=59.9, longitude=10.7, radius=100.0, speed=10.0, rate=1.0):
+    """
+    Generate TPV reports along a circle of radius meters flown at speed m/s
+    """
+    reports = []
+    for i in xrange(count):
+        angle = speed * i / rate / radius
+        reports.append({
+            'class': 'TPV', 'mode': 3,
+            'lat': latitude + math.degrees(radius * math.sin(angle) / 6371000.0),
+            'lon': longitude + math.degrees(radius * (1.0 - math.cos(angle)) / 6371000.0 / math.cos(math.radians(latitude))),
+            'alt': 100.0, 'track': (90.0 - math.degrees(angle)) % 360.0, 'speed': speed, 'climb': 0.0,
+            'epx': 3.0, 'epy': 3.0, 'epv': 5.0, 'epd': 1.0, 'eps': 0.5, 'epc': 0.5
+        })
+    return reports
+
+class GpsdProtocol(LineReceiver):
+    """
+    One gpsd client connection
+    """
+    delimiter = '\n'
+
+    def connectionMade(self):
+        self.sendLine(json.dumps(_version))
+
+    def lineReceived(self, line):
+        if line.startswith('?WATCH'):
+            self.sendLine(json.dumps({'class': 'DEVICES', 'devices': [{'class': 'DEVICE', 'path': '/dev/fake'}]}))
+            self.sendLine(json.dumps({'class': 'WATCH', 'enable': True, 'json': True}))
+            self.factory.watchers.add(self)
+
+    def connectionLost(self, reason):
+        self.factory.watchers.discard(self)
+
+class FakeGpsd(protocol.Factory):
+    """
+    Send TPV reports to all watching clients at rate reports per second
+    """
+    protocol = GpsdProtocol
+
+    def __init__(self, reports, rate, repeat=True):
+        self.watchers = set()
+        self.sent = 0
+        self._reports = reports
+        self._repeat = repeat
+        self._loop = task.LoopingCall(self.tick)
+        self._rate = rate
+
+    def start(self):
+        self._loop.start(1.0 / self._rate, now=False)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def tick(self):
+        if not self.watchers:
+            return
+        if self.sent >= len(self._reports) and not self._repeat:
+            self.stop()
+            return
+        report = dict(self._reports[self.sent % len(self._reports)])
+        report['time'] = formatTime(time.time())
+        line = json.dumps(report)
+        for watcher in self.watchers:
+            watcher.sendLine(line)
+        self.sent += 1
+
+class LatencyGpsThread(gps.GpsThread):
+    """
+    Gps thread recording the latency of each fix
+    """
+    def __init__(self, port, count):
+        gps.GpsThread.__init__(self, '127.0.0.1', port)
+        self.latencies = []
+        self.done = threading.Event()
+        self._count = count
+
+    def _addFix(self, fix):
+        gps.GpsThread._addFix(self, fix)
+        self.latencies.append(fix.received - fix.gps_time)
+        if len(self.latencies) >= self._count:
+            self.done.set()
+
+def measure(port, count, timeout):
+
+    thread = LatencyGpsThread(port, count)
+    thread.start()
+    try:
+        thread.done.wait(timeout)
+    finally:
+        thread.stop()
+        thread.join()
+        reactor.callFromThread(reactor.stop)
+
+    latencies = sorted(thread.latencies)
+    if not latencies:
+        print("No fixes received")
+        return
+    print("%d fixes, latency ms: p50 %.3f p90 %.3f p99 %.3f max %.3f" % (len(latencies),
+        latencies[len(latencies) // 2] * 1e3, latencies[int(len(latencies) * 0.9)] * 1e3,
+        latencies[int(len(latencies) * 0.99)] * 1e3, latencies[-1] * 1e3))
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type = int, default = gps.GPSD_PORT, help = "TCP port to listen on, 0 picks a free port. Default %d" % gps.GPSD_PORT)
+    parser.add_argument('--log', help = "gpsd JSON or NMEA log to replay. Default is a generated circular track")
+    parser.add_argument('--rate', type = float, default = 1.0, help = "Reports per second. Default 1")
+    parser.add_argument('--once', action = 'store_true', help = "Stop after one pass through the log")
+    parser.add_argument('--measure', type = int, metavar = 'COUNT', help = "Read COUNT fixes with the gps thread and print their latency")
+    parser.add_argument('--timeout', type = float, default = 60.0, help = "Longest time to wait for --measure. Default 60")
+    args = parser.parse_args()
+
+    reports = loadLog(args.log) if args.log else syntheticTrack(3600, rate=args.rate)
+    if not reports:
+        print("No reports in %s" % args.log, file=sys.stderr)
+        sys.exit(1)
+
+    server = FakeGpsd(reports, args.rate, not args.once)
+    port = reactor.listenTCP(args.port, server, interface='127.0.0.1')
+    server.start()
+
+    if args.measure:
+        reactor.callWhenRunning(reactor.callInThread, measure, port.getHost().port, args.measure, args.timeout)
+    else:
+        print("Serving %d reports on port %d" % (len(reports), port.getHost().port))
+    reactor.run()
+
+if __name__ == "__main__":
+    main()
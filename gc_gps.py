@@ -17,134 +17,341 @@
 #
 # Authors: Dag Robole,
 
-import threading
-from gps import *
+# Reads TPV reports from the gpsd JSON stream. The reader thread blocks on
+# the gpsd socket and a stop pipe, so a fix is handled as soon as gpsd sends
+# it.
+
+import os, json, socket, select, threading, time, calendar
+from collections import namedtuple
+
+GPSD_HOST = '127.0.0.1'
+GPSD_PORT = 2947
+
+# Seconds between attempts to reach gpsd
+RECONNECT_INTERVAL = 2.0
+
+# Number of fixes kept for interpolation
+GPS_HISTORY = 256
+
+_watch = '?WATCH={"enable":true,"json":true};\n'
+
+_fix_fields = ('stamp', 'received', 'gps_time', 'time', 'mode',
+    'latitude', 'latitude_error', 'longitude', 'longitude_error', 'altitude', 'altitude_error',
+    'track', 'track_error', 'speed', 'speed_error', 'climb', 'climb_error')
+
+# Fix values and the TPV report keys they are read from
+_report_fields = (
+    ('latitude', 'lat'), ('latitude_error', 'epy'), ('longitude', 'lon'), ('longitude_error', 'epx'),
+    ('altitude', 'alt'), ('altitude_error', 'epv'), ('track', 'track'), ('track_error', 'epd'),
+    ('speed', 'speed'), ('speed_error', 'eps'), ('climb', 'climb'), ('climb_error', 'epc')
+)
+
+_interpolated_fields = ('latitude', 'longitude', 'altitude', 'speed', 'climb')
+
+_error_fields = ('latitude_error', 'longitude_error', 'altitude_error', 'track_error', 'speed_error', 'climb_error')
+
+class GpsFix(namedtuple('GpsFix', _fix_fields)):
+    """
+    Immutable gps fix. Stamp is the local time of the fix, received the local
+    time the report was read, gps_time the fix time on the gps clock (None
+    without a gps time) and mode the gpsd fix quality (0 unknown, 1 no fix,
+    2 2D fix, 3 3D fix)
+    """
+    __slots__ = ()
+
+    @property
+    def position(self):
+        return {
+            'latitude' : self.latitude, 'latitude_error' : self.latitude_error,
+            'longitude' : self.longitude, 'longitude_error' : self.longitude_error,
+            'altitude' : self.altitude, 'altitude_error' : self.altitude_error
+        }
+
+    @property
+    def velocity(self):
+        return {
+            'track' : self.track, 'track_error' : self.track_error,
+            'speed' : self.speed, 'speed_error' : self.speed_error,
+            'climb' : self.climb, 'climb_error' : self.climb_error
+        }
+
+_empty_fix = GpsFix(0.0, 0.0, None, '', 0, *([0.0] * 12))
+
+def parseTime(utc):
+    """
+    Convert a gpsd ISO 8601 time string to seconds since the epoch
+    """
+    seconds, dot, fraction = utc.rstrip('Z').partition('.')
+    epoch = calendar.timegm(time.strptime(seconds, '%Y-%m-%dT%H:%M:%S'))
+    return epoch + (float('0.' + fraction) if fraction else 0.0)
+
+def formatTime(epoch):
+    """
+    Convert seconds since the epoch to a gpsd style ISO 8601 time string
+    """
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(epoch)) + '.%03dZ' % int((epoch % 1.0) * 1000.0)
 
 class GpsThread(threading.Thread):
     """
     Thread class to handle the gps driver
     """
-    def __init__(self, event):
+    def __init__(self, host=GPSD_HOST, port=GPSD_PORT):
         """
         Initialize the gps thread
         """
         threading.Thread.__init__(self)
-        self._stopped = event
-        self._gpsd = gps(mode = WATCH_ENABLE)
-        self._latitude = 0.0
-        self._latitude_err = 0.0
-        self._longitude = 0.0
-        self._longitude_err = 0.0
-        self._altitude = 0.0
-        self._altitude_err = 0.0
-        self._track = 0.0
-        self._track_err = 0.0
-        self._speed = 0.0
-        self._speed_err = 0.0
-        self._climb = 0.0
-        self._climb_err = 0.0
-        self._time = ''
+        self._address = (host, port)
+        self._stop_read, self._stop_write = os.pipe() # Written to by stop()
+        # The pipe is closed by the first join() to find the thread gone, a
+        # later stop() must not write to a closed or reused descriptor
+        self._pipe_lock = threading.Lock()
+        self._pipe_closed = False
+        # The current fix is replaced whole, so readers always see the values
+        # of one report
+        self._fix = _empty_fix
+        # Ring of fixes ordered by stamp. The gps thread fills a slot before
+        # bumping the counter, and slots are replaced whole, so readers need
+        # no lock
+        self._fixes = [None] * GPS_HISTORY
+        self._fix_count = 0
+        self._clock_offset = None # Local clock minus gps clock
+
+    def stop(self):
+        """
+        Make the gps thread return, call join() to wait for it
+        """
+        with self._pipe_lock:
+            if not self._pipe_closed:
+                os.write(self._stop_write, 'x')
+
+    def join(self, timeout=None):
+        """
+        Wait for the gps thread to return, then close the stop pipe
+        """
+        threading.Thread.join(self, timeout)
+        if self.is_alive():
+            return
+        with self._pipe_lock:
+            if not self._pipe_closed:
+                self._pipe_closed = True
+                os.close(self._stop_read)
+                os.close(self._stop_write)
+
+    def _wait(self, skt, timeout=None):
+        # Wait for data on skt, returns False when stopped
+        readable = select.select([self._stop_read] + ([skt] if skt is not None else []), [], [], timeout)[0]
+        return self._stop_read not in readable
 
     def run(self):
         """
         Entry point for the gps thread
         """
-        # Process any buffered gps signals every 0.5 seconds
-        while not self._stopped.wait(0.5):
-            # Update our last measurement until buffer is empty
-            while self._gpsd.waiting():
-                self._gpsd.next()
-                if not math.isnan(self._gpsd.fix.latitude):
-                    self._latitude = self._gpsd.fix.latitude
-                if not math.isnan(self._gpsd.fix.epx):
-                    self._latitude_err = self._gpsd.fix.epx
-                if not math.isnan(self._gpsd.fix.longitude):
-                    self._longitude = self._gpsd.fix.longitude
-                if not math.isnan(self._gpsd.fix.epy):
-                    self._longitude_err = self._gpsd.fix.epy
-                if not math.isnan(self._gpsd.fix.altitude):
-                    self._altitude = self._gpsd.fix.altitude
-                if not math.isnan(self._gpsd.fix.epv):
-                    self._altitude_err = self._gpsd.fix.epv
-                if not math.isnan(self._gpsd.fix.track):
-                    self._track = self._gpsd.fix.track
-                if not math.isnan(self._gpsd.fix.epd):
-                    self._track_err = self._gpsd.fix.epd
-                if not math.isnan(self._gpsd.fix.speed):
-                    self._speed = self._gpsd.fix.speed
-                if not math.isnan(self._gpsd.fix.eps):
-                    self._speed_err = self._gpsd.fix.eps
-                if not math.isnan(self._gpsd.fix.climb):
-                    self._climb = self._gpsd.fix.climb
-                if not math.isnan(self._gpsd.fix.epc):
-                    self._climb_err = self._gpsd.fix.epc
-                if self._gpsd.utc != None and self._gpsd.utc != '':
-                    self._time = self._gpsd.utc
+        while True:
+            try:
+                skt = socket.create_connection(self._address, RECONNECT_INTERVAL)
+            except socket.error:
+                if not self._wait(None, RECONNECT_INTERVAL):
+                    return
+                continue
+            try:
+                skt.settimeout(None)
+                skt.sendall(_watch)
+                pending = ''
+                while self._wait(skt):
+                    data = skt.recv(8192)
+                    if not data:
+                        break # gpsd went away, reconnect
+                    received = time.time()
+                    lines = (pending + data).split('\n')
+                    pending = lines.pop()
+                    for line in lines:
+                        self._report(line, received)
+                else:
+                    return
+            except socket.error:
+                pass
+            finally:
+                skt.close()
+
+    def _report(self, line, received):
+        """
+        Build a new fix from a TPV report, fields missing from the report keep
+        their previous values
+        """
+        if '"TPV"' not in line:
+            return
+        try:
+            report = json.loads(line)
+        except ValueError:
+            return
+        if report.get('class') != 'TPV':
+            return
+
+        last = self._fix
+        values = {}
+        for name, key in _report_fields:
+            value = report.get(key)
+            values[name] = getattr(last, name) if value is None else float(value)
+        utc = report.get('time')
+        if isinstance(utc, (int, float)): # Older gpsd sends seconds since the epoch
+            utc = formatTime(utc)
+        values['time'] = utc if utc else last.time
+        values['mode'] = int(report.get('mode', 0))
+
+        try:
+            gps_time = parseTime(values['time'])
+        except ValueError:
+            gps_time = None
+        if gps_time is None:
+            stamp = received
+        else:
+            # Reports may be read late, the smallest offset seen is the best
+            # estimate of the clock difference. A large increase means the
+            # local clock was set
+            offset = received - gps_time
+            if self._clock_offset is None or offset < self._clock_offset or offset > self._clock_offset + 1.0:
+                self._clock_offset = offset
+            stamp = gps_time + self._clock_offset
+
+        fix = GpsFix(stamp=stamp, received=received, gps_time=gps_time, **values)
+        self._fix = fix
+        self._addFix(fix)
+
+    def _addFix(self, fix):
+        """
+        Store a fix in the history ring
+        """
+        count = self._fix_count
+        if count > 0 and fix.stamp <= self._fixes[(count - 1) % GPS_HISTORY].stamp:
+            return
+        self._fixes[count % GPS_HISTORY] = fix
+        self._fix_count = count + 1
+
+    def _bracket(self, stamp):
+        # Return the newest fix at or before stamp and the oldest fix after it
+        count = self._fix_count
+        before = after = None
+        for n in xrange(count - 1, max(count - GPS_HISTORY, 0) - 1, -1):
+            fix = self._fixes[n % GPS_HISTORY]
+            if after is not None and fix.stamp >= after.stamp:
+                break # Slot was overwritten by a newer fix
+            if fix.stamp <= stamp:
+                before = fix
+                break
+            after = fix
+        return before, after
+
+    def snapshot(self):
+        """
+        Return the current fix, position, velocity, time and fix quality all
+        come from the same report
+        """
+        return self._fix
+
+    def interpolate(self, stamp):
+        """
+        Return position, velocity and time at local time stamp, linearly
+        interpolated between the surrounding fixes
+        """
+        before, after = self._bracket(stamp)
+        if before is None and after is None:
+            fix = self._fix
+            values = fix.position
+            values.update(fix.velocity)
+            values['time'] = fix.time
+            return values
+        if before is None or after is None:
+            fix = before if before is not None else after
+            values = {name: getattr(fix, name) for name in _interpolated_fields + _error_fields}
+            values['track'] = fix.track
+        else:
+            fix = before
+            w = (stamp - before.stamp) / (after.stamp - before.stamp)
+            values = {name: getattr(before, name) + (getattr(after, name) - getattr(before, name)) * w for name in _interpolated_fields}
+            values.update({name: max(getattr(before, name), getattr(after, name)) for name in _error_fields})
+            values['track'] = (before if w < 0.5 else after).track
+        values['time'] = formatTime(fix.gps_time + (stamp - fix.stamp)) if fix.gps_time is not None else fix.time
+        return values
 
     @property
     def latitude(self):
-        return self._latitude
+        return self._fix.latitude
 
     @property
     def latitude_err(self):
-        return self._latitude_err
+        return self._fix.latitude_error
 
     @property
     def longitude(self):
-        return self._longitude
+        return self._fix.longitude
 
     @property
     def longitude_err(self):
-        return self._longitude_err
+        return self._fix.longitude_error
 
     @property
     def altitude(self):
-        return self._altitude
+        return self._fix.altitude
 
     @property
     def altitude_err(self):
-        return self._altitude_err
+        return self._fix.altitude_error
 
     @property
     def track(self):
-        return self._track
+        return self._fix.track
 
     @property
     def track_err(self):
-        return self._track_err
+        return self._fix.track_error
 
     @property
     def speed(self):
-        return self._speed
+        return self._fix.speed
 
     @property
     def speed_err(self):
-        return self._speed_err
+        return self._fix.speed_error
 
     @property
     def climb(self):
-        return self._climb
+        return self._fix.climb
 
     @property
     def climb_err(self):
-        return self._climb_err
+        return self._fix.climb_error
 
     @property
     def time(self):
-        return self._time
+        return self._fix.time
 
     @property
     def position(self):
-        return {
-            'latitude' : self._latitude, 'latitude_error' : self._latitude_err,
-            'longitude' : self._longitude, 'longitude_error' : self._longitude_err,
-            'altitude' : self._altitude, 'altitude_error' : self._altitude_err
-        }
+        return self._fix.position
 
     @property
     def velocity(self):
-        return {
-            'track' : self._track, 'track_error' : self._track_err,
-            'speed' : self._speed, 'speed_error' : self._speed_err,
-            'climb' : self._climb, 'climb_error' : self._climb_err
-       }
+        return self._fix.velocity
+
+if __name__ == "__main__":
+
+    # Measure the cost of reading gps state on the acquisition path
+    import timeit
+
+    thread = GpsThread()
+    now = time.time()
+    def tpv(stamp):
+        return json.dumps({'class': 'TPV', 'mode': 3, 'time': formatTime(stamp),
+            'lat': 59.9, 'epy': 3.0, 'lon': 10.7, 'epx': 3.0, 'alt': 100.0, 'epv': 5.0,
+            'track': 90.0, 'epd': 1.0, 'speed': 10.0, 'eps': 0.5, 'climb': 0.0, 'epc': 0.5})
+    for i in xrange(GPS_HISTORY):
+        thread._report(tpv(now - GPS_HISTORY + i), now - GPS_HISTORY + i + 0.05)
+    line = tpv(now)
+
+    n = 100000
+    for name, statement in (
+            ('snapshot()', lambda: thread.snapshot()),
+            ('position + velocity + time', lambda: (thread.position, thread.velocity, thread.time)),
+            ('interpolate()', lambda: thread.interpolate(now - 10.5)),
+            ('TPV report', lambda: thread._report(line, time.time()))):
+        print("%-28s %8.3f us" % (name, timeit.timeit(statement, number=n) * 1e6 / n))
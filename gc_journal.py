@@ -0,0 +1,94 @@
+# Detector controller for gamma measurements
+# Copyright (C) 2016  Norwegain Radiation Protection Authority
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Dag Robole,
+
+# Journal of the running session
+#
+# The journal holds what it takes to resume a session after the daemon
+# stopped without finishing it: the start_session arguments, the detector
+# configuration and reservations of spectrum indices. It is written to a
+# temporary file and renamed over the old one, so a crash leaves either the
+# old or the new journal. It is removed when the session is finalized, a
+# journal found at startup means the session was interrupted.
+#
+# Indices are reserved INDEX_RESERVE ahead of the ones handed out and the
+# reservation is renewed before it runs out. A resumed session continues
+# after the reservation, so an index published before the crash is never
+# reused, even if its spectrum was still waiting to be committed. The gap
+# left in the indices covers the spectrums lost with the daemon.
+
+import os, json, errno
+
+from twisted.python import log
+
+JOURNAL_FILE = "~/gc/session.journal"
+
+# Spectrum indices reserved by each journal write
+INDEX_RESERVE = 50
+
+def _path():
+    return os.path.expanduser(JOURNAL_FILE)
+
+def write(state):
+    """
+    Replace the journal with state, durably
+    """
+    path = _path()
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path + ".tmp", 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + ".tmp", path)
+    # The rename is only durable once the directory is synced
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def read():
+    """
+    Return the journaled state, None if there is no usable journal
+    """
+    try:
+        with open(_path()) as f:
+            state = json.load(f)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            log.msg("Unable to read session journal: %s" % str(e))
+        return None
+    except ValueError as e:
+        log.msg("Session journal is corrupt: %s" % str(e))
+        return None
+    if not isinstance(state, dict) or not all(key in state for key in ('session_args', 'detector_data', 'index', 'detector_indices')):
+        log.msg("Session journal is incomplete, ignored")
+        return None
+    return state
+
+def clear():
+    """
+    Remove the journal
+    """
+    try:
+        os.remove(_path())
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
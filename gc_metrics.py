@@ -0,0 +1,118 @@
+# Detector controller for gamma measurements
+# Copyright (C) 2016  Norwegain Radiation Protection Authority
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Dag Robole,
+
+import time
+from collections import deque
+from twisted.python import log
+
+# Number of recent durations kept per name for percentiles
+LATENCY_SAMPLES = 1024
+
+# Default log limit, messages per interval in seconds
+LOG_LIMIT = 10
+LOG_INTERVAL = 1.0
+
+class Timer(object):
+    """
+    Call count, error count and durations of one operation
+    """
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._samples = deque(maxlen=LATENCY_SAMPLES)
+
+    def record(self, seconds, failed=False):
+        self.count += 1
+        if failed:
+            self.errors += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self._samples.append(seconds)
+
+    def summary(self):
+        """
+        Return counts and latencies in seconds, percentiles cover the most
+        recent calls
+        """
+        samples = sorted(self._samples)
+        def percentile(p):
+            return samples[min(len(samples) - 1, int(len(samples) * p))] if samples else 0.0
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': percentile(0.5),
+            'p99': percentile(0.99),
+            'max': self.max
+        }
+
+class Metrics(object):
+    """
+    Timers and counters by name
+    """
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._started = clock()
+        self._timers = {}
+        self._counters = {}
+
+    def count(self, name, n=1):
+        self._counters[name] = self._counters.get(name, 0) + n
+
+    def record(self, name, seconds, failed=False):
+        timer = self._timers.get(name)
+        if timer is None:
+            timer = self._timers[name] = Timer()
+        timer.record(seconds, failed)
+
+    def summary(self):
+        return {
+            'uptime': self._clock() - self._started,
+            'timers': {name: timer.summary() for name, timer in self._timers.iteritems()},
+            'counters': dict(self._counters)
+        }
+
+class LogLimiter(object):
+    """
+    Log at most limit messages per interval, the number of dropped messages
+    is logged with the first message of the next interval
+    """
+    def __init__(self, limit=LOG_LIMIT, interval=LOG_INTERVAL, clock=time.time):
+        self._limit = limit
+        self._interval = interval
+        self._clock = clock
+        self._window = clock()
+        self._count = 0
+        self._suppressed = 0
+
+    def msg(self, text):
+        now = self._clock()
+        if now - self._window >= self._interval:
+            if self._suppressed:
+                log.msg("%d messages suppressed" % self._suppressed)
+            self._window = now
+            self._count = 0
+            self._suppressed = 0
+        if self._count < self._limit:
+            self._count += 1
+            log.msg(text)
+        else:
+            self._suppressed += 1
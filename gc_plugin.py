@@ -0,0 +1,63 @@
+# Detector controller for gamma measurements
+# Copyright (C) 2016  Norwegain Radiation Protection Authority
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Dag Robole,
+
+import time
+
+# Polling intervals used once an acquisition has passed its expected end
+POLL_MIN_INTERVAL = 0.005
+POLL_MAX_INTERVAL = 0.05
+
+def waitForAcquisition(busy, expected_end, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL):
+    """
+    Sleep until the expected end of an acquisition, then poll busy() with an
+    exponential backoff until it returns False
+    """
+    delay = expected_end - time.time()
+    if delay > 0.0:
+        time.sleep(delay)
+    interval = min_interval
+    while busy():
+        time.sleep(interval)
+        interval = min(interval * 2.0, max_interval)
+
+class Detector(object):
+    """
+    Base class of the detectors a plugin drives. A plugin module defines a
+    Detector subclass, each instance drives one detector unit, and all calls
+    to an instance come from the same thread. Module functions
+    initializePlugin and finalizePlugin set up and tear down what the
+    detectors of a plugin share, such as a driver library
+    """
+    def __init__(self, detector_id):
+        self.detector_id = detector_id
+
+    def initializeDetector(self, config):
+        pass
+
+    def finalizeDetector(self):
+        pass
+
+    def initializeSession(self, args):
+        pass
+
+    def finalizeSession(self, args):
+        pass
+
+    def acquireSpectrum(self, args):
+        raise NotImplementedError
@@ -0,0 +1,234 @@
+# Detector controller for gamma measurements
+# Copyright (C) 2016  Norwegain Radiation Protection Authority
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Dag Robole,
+
+# Detectors isolated in child processes
+#
+# A ProcessDetector stands in for the detector of a plugin and forwards each
+# call over a pipe to a child process running the plugin. The channels of an
+# acquired spectrum are written to a ring of slots in shared memory and only
+# the slot and the rest of the message go through the pipe. A driver that
+# hangs or crashes takes down the child only: the child is killed when a call
+# times out, a new one is started and configured again, the running session
+# is initialized in it and the acquisition is tried once more.
+
+import mmap, time, signal, importlib, multiprocessing
+from array import array
+
+from twisted.python import log
+
+import gc_plugin as plugin
+from gc_channels import UINT32, toArray
+from gc_exceptions import ProtocolError
+
+# Slots in the shared memory ring and the largest spectrum a slot holds
+RING_SLOTS = 4
+MAX_CHANNELS = 16384
+
+# Seconds to wait for a call before the child is considered hung. An
+# acquisition may take its livetime on top of this
+CALL_TIMEOUT = 120.0
+ACQUIRE_TIMEOUT = 30.0
+
+# Attempts at a call that finds its child dead, each in a new child
+CALL_ATTEMPTS = 2
+
+class _WorkerDied(Exception):
+    pass
+
+def _workerMain(plugin_name, detector_id, connection, ring, slots, slot_size):
+
+    # Runs in the child. Interrupts are left to the daemon, which stops the
+    # child through the pipe
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    module = importlib.import_module('plugin_' + plugin_name)
+    module.initializePlugin()
+    detector = module.Detector(detector_id)
+    slot = 0
+    try:
+        while True:
+            try:
+                name, args = connection.recv()
+            except EOFError:
+                break
+            if name == 'stop':
+                break
+            try:
+                result = getattr(detector, name)(*args)
+                if name != 'acquireSpectrum':
+                    connection.send(('ok', result))
+                    continue
+                data = toArray(result.pop('channels')).tostring()
+                if len(data) > slot_size:
+                    raise ProtocolError('error', "Spectrum of %d channels does not fit in shared memory" % (len(data) // 4))
+                offset = slot * slot_size
+                ring[offset:offset + len(data)] = data
+                slot = (slot + 1) % slots
+                connection.send(('spectrum', result, offset, len(data), time.time()))
+            except ProtocolError as e:
+                connection.send(('protocol_error', e.command, e.message))
+            except Exception as e:
+                connection.send(('error', str(e)))
+    finally:
+        module.finalizePlugin()
+
+class ProcessDetector(plugin.Detector):
+    """
+    Detector of a plugin running in a child process. Calls block the calling
+    thread until the child answers
+    """
+    def __init__(self, detector_id, plugin_name, max_channels=MAX_CHANNELS, record=None, count=None):
+        """
+        Initialize the detector, the child is started by the first call.
+        record is called with a metric name and a duration in seconds, count
+        with a metric name, both on the calling thread
+        """
+        plugin.Detector.__init__(self, detector_id)
+        self.plugin_name = plugin_name
+        self._slot_size = int(max_channels) * 4
+        # Anonymous shared memory, inherited by every child forked later
+        self._ring = mmap.mmap(-1, RING_SLOTS * self._slot_size)
+        self._record = record if record is not None else lambda name, seconds: None
+        self._count = count if count is not None else lambda name: None
+        self._process = None
+        self._connection = None
+        self._config = None # Replayed in a restarted child
+        self._session = None
+        self.starts = 0
+
+    def _start(self):
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_workerMain, name='detector-%s' % self.detector_id,
+                args=(self.plugin_name, self.detector_id, child, self._ring, RING_SLOTS, self._slot_size))
+        process.daemon = True
+        process.start()
+        child.close()
+        self._process, self._connection = process, parent
+        self.starts += 1
+        if self.starts > 1:
+            log.msg("Restarted worker process of detector %s, pid %d" % (self.detector_id, process.pid))
+            self._count('detector_restart')
+
+    def _kill(self):
+        if self._process is None:
+            return
+        if self._process.is_alive():
+            self._process.terminate()
+        self._process.join(1.0)
+        self._connection.close()
+        self._process = None
+        self._connection = None
+
+    def _call(self, name, args, timeout):
+        try:
+            self._connection.send((name, args))
+            if not self._connection.poll(timeout):
+                raise _WorkerDied("%s timed out after %.0f seconds" % (name, timeout))
+            reply = self._connection.recv()
+        except (EOFError, IOError, OSError):
+            self._process.join(1.0)
+            raise _WorkerDied("exited with code %s" % self._process.exitcode)
+        if reply[0] == 'protocol_error':
+            raise ProtocolError(reply[1], reply[2])
+        if reply[0] == 'error':
+            raise ProtocolError('error', reply[1])
+        return reply
+
+    def _ensure(self):
+        # Start a child if there is none and bring it to the state of the one
+        # it replaces
+        if self._process is not None:
+            return
+        self._start()
+        if self._config is not None:
+            self._call('initializeDetector', (self._config, ), CALL_TIMEOUT)
+        if self._session is not None:
+            self._call('initializeSession', (self._session, ), CALL_TIMEOUT)
+
+    def _invoke(self, name, args, timeout=CALL_TIMEOUT):
+        for attempt in xrange(CALL_ATTEMPTS):
+            try:
+                self._ensure()
+                return self._call(name, args, timeout)
+            except _WorkerDied as e:
+                log.msg("Worker process of detector %s failed in %s: %s" % (self.detector_id, name, str(e)))
+                self._kill()
+                error = e
+        raise ProtocolError('error', "Worker process of detector %s failed: %s" % (self.detector_id, str(error)))
+
+    def initializeDetector(self, config):
+        self._invoke('initializeDetector', (config, ))
+        self._config = config
+
+    def finalizeDetector(self):
+        try:
+            if self._process is not None:
+                self._call('finalizeDetector', (), CALL_TIMEOUT)
+                self._connection.send(('stop', ()))
+                self._process.join(CALL_TIMEOUT)
+        except (_WorkerDied, ProtocolError) as e:
+            log.msg("Unable to finalize detector %s: %s" % (self.detector_id, str(e)))
+        finally:
+            self._kill()
+            self._config = None
+
+    def initializeSession(self, args):
+        self._invoke('initializeSession', (args, ))
+        self._session = args
+
+    def finalizeSession(self, args):
+        self._session = None
+        self._invoke('finalizeSession', (args, ))
+
+    def acquireSpectrum(self, args):
+        reply = self._invoke('acquireSpectrum', (args, ), float(args.get('livetime', 0.0)) + ACQUIRE_TIMEOUT)
+        kind, msg, offset, size, sent = reply
+        channels = array(UINT32)
+        channels.fromstring(self._ring[offset:offset + size])
+        msg['channels'] = channels
+        self._record('detector_ipc', time.time() - sent)
+        return msg
+
+if __name__ == "__main__":
+
+    # Per spectrum cost of acquiring in a child process compared to in the
+    # calling thread, with a simulated detector fast enough to leave the
+    # IPC overhead
+    import sys
+    import plugin_simulated
+
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    args = {'session_name': 'benchmark', 'livetime': 1.0}
+
+    for num_channels in (1024, 4096, 16384):
+        config = {'num_channels': num_channels, 'count_rate': 1000.0, 'time_scale': 1e6}
+        ipc = []
+        detectors = [('thread', plugin_simulated.Detector('thread')),
+            ('process', ProcessDetector('process', 'simulated', record=lambda name, seconds: ipc.append(seconds)))]
+        for name, detector in detectors:
+            detector.initializeDetector(config)
+            detector.initializeSession(args)
+            t0 = time.time()
+            for i in xrange(iterations):
+                detector.acquireSpectrum(args)
+            elapsed = (time.time() - t0) / iterations
+            detector.finalizeSession(args)
+            detector.finalizeDetector()
+            print("%5d channels %-8s %8.1f us/spectrum" % (num_channels, name, elapsed * 1e6))
+        ipc.sort()
+        print("%5d channels handoff p50 %.1f us p99 %.1f us" % (num_channels, ipc[len(ipc) // 2] * 1e6, ipc[int(len(ipc) * 0.99)] * 1e6))
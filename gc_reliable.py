@@ -0,0 +1,120 @@
+# Detector controller for gamma measurements
+# Copyright (C) 2016  Norwegain Radiation Protection Authority
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Dag Robole,
+
+# Reliable delivery of live spectrums
+#
+# Reliable subscribers acknowledge spectrums with spectrum_ack messages
+# carrying a cumulative ack, the highest index below which everything has
+# arrived, and a selective list of indices received above it. Spectrums not
+# acknowledged in time are sent again with exponential backoff. Recent
+# spectrums are kept in memory, older ones are read back from the session
+# database.
+
+import time
+from collections import OrderedDict
+
+# Number of recent spectrums kept in memory for retransmission
+RETRANSMIT_WINDOW = 256
+
+# Seconds before the first retransmission, doubled on each attempt
+RETRANSMIT_TIMEOUT = 0.5
+RETRANSMIT_MAX_TIMEOUT = 8.0
+
+# Retransmissions of one spectrum before it is left for sync_session
+RETRANSMIT_ATTEMPTS = 8
+
+# Seconds between checks for spectrums due for retransmission
+RETRANSMIT_INTERVAL = 0.1
+
+class SpectrumWindow(object):
+    """
+    The most recent spectrums of a session by index
+    """
+    def __init__(self, size=RETRANSMIT_WINDOW):
+        self._size = size
+        self._spectrums = OrderedDict()
+        self.session_name = None
+
+    def add(self, msg):
+        if msg['session_name'] != self.session_name:
+            self.clear(msg['session_name'])
+        self._spectrums[msg['index']] = msg
+        while len(self._spectrums) > self._size:
+            self._spectrums.popitem(last=False)
+
+    def get(self, index):
+        return self._spectrums.get(index)
+
+    def clear(self, session_name=None):
+        self._spectrums.clear()
+        self.session_name = session_name
+
+class ReliableState(object):
+    """
+    Spectrums sent to one reliable subscriber and not yet acknowledged
+    """
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._pending = {} # Index to [due time, timeout, attempts]
+        self.session_name = None
+        self.acked = -1 # Cumulative ack
+        self.retransmits = 0
+        self.abandoned = 0
+
+    def sent(self, session_name, index):
+        if session_name != self.session_name:
+            self._pending.clear()
+            self.session_name = session_name
+            self.acked = -1
+        self._pending[index] = [self._clock() + RETRANSMIT_TIMEOUT, RETRANSMIT_TIMEOUT, 0]
+
+    def ack(self, session_name, cumulative, selective=()):
+        if session_name != self.session_name:
+            return
+        if cumulative > self.acked:
+            self.acked = cumulative
+            for index in [i for i in self._pending if i <= cumulative]:
+                del self._pending[index]
+        for index in selective:
+            self._pending.pop(index, None)
+
+    def due(self):
+        """
+        Return the sorted indices to send again now and back off their next
+        retransmission. Indices out of attempts are dropped
+        """
+        now = self._clock()
+        indices = []
+        for index, entry in self._pending.items():
+            if entry[0] > now:
+                continue
+            if entry[2] >= RETRANSMIT_ATTEMPTS:
+                del self._pending[index]
+                self.abandoned += 1
+                continue
+            entry[1] = min(entry[1] * 2.0, RETRANSMIT_MAX_TIMEOUT)
+            entry[0] = now + entry[1]
+            entry[2] += 1
+            indices.append(index)
+        self.retransmits += len(indices)
+        return sorted(indices)
+
+    @property
+    def pending(self):
+        return len(self._pending)
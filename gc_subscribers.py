@@ -0,0 +1,163 @@
+# Detector controller for gamma measurements
+# Copyright (C) 2016  Norwegain Radiation Protection Authority
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Dag Robole,
+
+# Peers are the addresses the daemon talks to, each with its own wire format
+# and MTU. A subscribed peer also receives the live stream, either full
+# spectrums or summaries without channels. Subscriptions expire unless the
+# peer is heard from within its timeout, any datagram counts as a heartbeat.
+# A multicast group can be subscribed on behalf of its listeners, it is kept
+# alive by the subscribe requests naming it.
+
+import time, socket
+
+import gc_wire as wire
+import gc_transport as fragmentation
+
+STREAM_FULL = 'full'
+STREAM_SUMMARY = 'summary'
+STREAMS = (STREAM_FULL, STREAM_SUMMARY)
+
+# Seconds a subscription lives without a heartbeat
+SUBSCRIBER_TIMEOUT = 60.0
+
+# Seconds a peer without subscription keeps its options
+PEER_TIMEOUT = 3600.0
+
+def summarize(msg):
+    """
+    Return the summary stream version of a spectrum message
+    """
+    summary = {k: v for k, v in msg.iteritems() if k != 'channels'}
+    summary['command'] = 'spectrum_summary'
+    return summary
+
+def isMulticast(host):
+    try:
+        return 224 <= ord(socket.inet_aton(host)[0]) <= 239
+    except socket.error:
+        return False
+
+class Peer(object):
+    """
+    Options and subscription of one address
+    """
+    def __init__(self, address, now):
+        self.address = address
+        self.wire_format = wire.FORMAT_JSON
+        self.fragmenter = fragmentation.Fragmenter()
+        self.stream = None # Not subscribed
+        self.reliable = None # ReliableState of a reliable subscriber
+        self.aggregate_channels = False # Accumulated spectrums wanted with aggregates
+        self.timeout = SUBSCRIBER_TIMEOUT
+        self.last_seen = now
+
+    def encode(self, msg):
+        return self.fragmenter.fragment(wire.encode(msg, self.wire_format))
+
+class PeerTable(object):
+    """
+    Peers by address
+    """
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._peers = {}
+
+    def get(self, address):
+        """
+        Return the peer at address, adding it if unknown
+        """
+        peer = self._peers.get(address)
+        if peer is None:
+            peer = self._peers[address] = Peer(address, self._clock())
+        return peer
+
+    def find(self, address):
+        return self._peers.get(address)
+
+    def touch(self, address):
+        peer = self._peers.get(address)
+        if peer is not None:
+            peer.last_seen = self._clock()
+
+    def subscribe(self, address, stream=STREAM_FULL, timeout=SUBSCRIBER_TIMEOUT):
+        peer = self.get(address)
+        peer.stream = stream
+        peer.timeout = float(timeout)
+        peer.last_seen = self._clock()
+        return peer
+
+    def unsubscribe(self, address):
+        peer = self._peers.get(address)
+        if peer is not None:
+            peer.stream = None
+
+    def subscribers(self):
+        return [peer for peer in self._peers.itervalues() if peer.stream is not None]
+
+    def expire(self, keep=()):
+        """
+        End subscriptions not heard from within their timeout and forget idle
+        peers, except those at addresses in keep. Returns the addresses whose
+        subscription ended
+        """
+        now = self._clock()
+        expired = []
+        for address, peer in self._peers.items():
+            if address in keep:
+                continue
+            idle = now - peer.last_seen
+            if peer.stream is not None and idle > peer.timeout:
+                peer.stream = None
+                expired.append(address)
+            if peer.stream is None and idle > PEER_TIMEOUT:
+                del self._peers[address]
+        return expired
+
+    def publish(self, msg, write, summary=None, select=None):
+        """
+        Send msg to full stream subscribers and summary, or msg if there is no
+        summary, to summary stream subscribers. select, called with a peer,
+        picks the peers getting msg instead. Each message is encoded once
+        per wire format and fragmented once per MTU. Returns the number of
+        datagrams written
+        """
+        encoded = {}
+        fragmented = {}
+        count = 0
+        for peer in self._peers.itervalues():
+            if peer.stream is None:
+                continue
+            if summary is None:
+                variant = msg
+            elif select is not None:
+                variant = msg if select(peer) else summary
+            else:
+                variant = summary if peer.stream == STREAM_SUMMARY else msg
+            key = (id(variant), peer.wire_format)
+            data = encoded.get(key)
+            if data is None:
+                data = encoded[key] = wire.encode(variant, peer.wire_format)
+            key += (peer.fragmenter.mtu, )
+            datagrams = fragmented.get(key)
+            if datagrams is None:
+                datagrams = fragmented[key] = peer.fragmenter.fragment(data)
+            for datagram in datagrams:
+                write(datagram, peer.address)
+            count += len(datagrams)
+        return count
@@ -0,0 +1,126 @@
+# Detector controller for gamma measurements
+# Copyright (C) 2016  Norwegain Radiation Protection Authority
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Dag Robole,
+
+import time
+from twisted.internet import reactor, task
+from twisted.python import log
+
+import gc_database as database
+
+# Default sync pacing in datagrams per second and the number of datagrams
+# that may be sent back to back before pacing kicks in. A fragmented spectrum
+# costs one token per fragment
+SYNC_RATE = 200.0
+SYNC_BURST = 20
+
+# Number of rows read from the session database at a time
+SYNC_CHUNK_SIZE = 50
+
+class TokenBucket(object):
+    """
+    Token bucket limiting a sender to rate tokens per second
+    """
+    def __init__(self, rate, burst, clock=time.time):
+        """
+        Initialize a full bucket
+        """
+        if rate <= 0:
+            raise ValueError("Rate must be positive")
+        self._rate = float(rate)
+        self._burst = max(1.0, float(burst))
+        self._tokens = self._burst
+        self._clock = clock
+        self._stamp = clock()
+
+    def consume(self, count=1):
+        """
+        Take count tokens and return the number of seconds to wait before the
+        bucket is out of debt
+        """
+        now = self._clock()
+        self._tokens = min(self._burst, self._tokens + (now - self._stamp) * self._rate)
+        self._stamp = now
+        self._tokens -= count
+        if self._tokens >= 0.0:
+            return 0.0
+        return -self._tokens / self._rate
+
+class SyncStream(object):
+    """
+    Stream the spectrums of a sync_session request without blocking the reactor
+    """
+    def __init__(self, send, msg):
+        """
+        Initialize the stream, send is called with each message to deliver
+        and returns the number of datagrams it took
+        """
+        self._send = send
+        self.session_name = msg['session_name']
+        self._bucket = TokenBucket(float(msg.get('sync_rate', SYNC_RATE)), int(msg.get('sync_burst', SYNC_BURST)))
+        self._spectrums = database.iterSyncSpectrums(self.session_name, list(msg['indices_list']),
+                int(msg['last_index']), int(msg.get('resume_index', -1)), SYNC_CHUNK_SIZE)
+        self._task = None
+        self.count = 0
+        self.first_index = None
+        self.last_index = None
+
+    def start(self):
+        """
+        Start streaming, returns a Deferred firing when the stream is done
+        """
+        self._task = task.cooperate(self._stream())
+        return self._task.whenDone()
+
+    def stop(self):
+        """
+        Stop streaming without sending the completion marker
+        """
+        if self._task is not None:
+            try:
+                self._task.stop()
+            except task.TaskDone:
+                pass
+            self._spectrums.close()
+
+    def _stream(self):
+        # The rows are closed however the stream ends, a failed send included,
+        # so the session reader is released
+        try:
+            for spec in self._spectrums:
+                datagrams = self._send(spec)
+                self.count += 1
+                if self.first_index is None:
+                    self.first_index = spec['index']
+                self.last_index = spec['index']
+                delay = self._bucket.consume(max(1, datagrams))
+                if delay > 0.0:
+                    yield task.deferLater(reactor, delay, lambda: None)
+                else:
+                    yield None
+        finally:
+            self._spectrums.close()
+
+        log.msg("Sync of session %s complete, %d spectrums sent" % (self.session_name, self.count))
+        self._send({
+            'command': 'sync_session_complete',
+            'session_name': self.session_name,
+            'count': self.count,
+            'first_index': self.first_index,
+            'last_index': self.last_index
+        })
@@ -0,0 +1,166 @@
+# Detector controller for gamma measurements
+# Copyright (C) 2016  Norwegain Radiation Protection Authority
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Dag Robole,
+
+# Datagram fragmentation
+#
+# Messages larger than the configured MTU are split into fragments, each
+# starting with a little-endian header:
+#
+#   magic 'GF', message id, fragment index, fragment count, message length,
+#   crc32 of the message
+#
+# Message ids come from one counter shared by all fragmenters, so fragments
+# published to several peers never share an id with the other messages of a
+# peer. The length and crc32 let the reassembler drop a message stitched
+# together from fragments of different messages.
+#
+# Messages that fit in one datagram are sent as they are, so peers that never
+# ask for an MTU see no difference.
+#
+# File chunks of a session dump are sent as binary messages with the header:
+#
+#   magic 'GD', two pad bytes, snapshot id, chunk index, crc32 of the data
+
+import struct, time, zlib, itertools
+
+MAGIC = 'GF'
+CHUNK_MAGIC = 'GD'
+
+# Smallest MTU accepted, leaves room for the header and some payload
+MIN_MTU = 256
+
+# Seconds an incomplete message is kept waiting for missing fragments
+REASSEMBLY_TIMEOUT = 5.0
+
+_header = struct.Struct('<2sHHHII')
+_message_ids = itertools.count(1)
+_chunk_header = struct.Struct('<2sxxIII')
+
+class Fragmenter(object):
+    """
+    Split messages into datagrams of at most mtu bytes
+    """
+    def __init__(self, mtu=None):
+        """
+        Initialize the fragmenter, an mtu of None disables fragmentation
+        """
+        self.mtu = mtu
+
+    @property
+    def mtu(self):
+        return self._mtu
+
+    @mtu.setter
+    def mtu(self, mtu):
+        if mtu is not None and int(mtu) < MIN_MTU:
+            raise ValueError("MTU must be at least %d bytes" % MIN_MTU)
+        self._mtu = None if mtu is None else int(mtu)
+
+    def fragment(self, data):
+        """
+        Return the list of datagrams carrying data
+        """
+        if self._mtu is None or len(data) <= self._mtu:
+            return [data]
+        size = self._mtu - _header.size
+        count = (len(data) + size - 1) // size
+        if count > 0xffff:
+            raise ValueError("Message too large to fragment")
+        message_id = next(_message_ids) & 0xffff
+        crc = zlib.crc32(data) & 0xffffffff
+        return [_header.pack(MAGIC, message_id, i, count, len(data), crc) + data[i * size:(i + 1) * size]
+                for i in xrange(count)]
+
+def isFragment(data):
+    return data[:len(MAGIC)] == MAGIC
+
+class Reassembler(object):
+    """
+    Collect fragments and return messages once all their fragments arrived
+    """
+    def __init__(self, timeout=REASSEMBLY_TIMEOUT, clock=time.time):
+        """
+        Initialize the reassembler
+        """
+        self._timeout = timeout
+        self._clock = clock
+        self._pending = {}
+
+    def add(self, data, source=None):
+        """
+        Add a datagram, returns the complete message or None
+        """
+        if not isFragment(data):
+            return data
+        now = self._clock()
+        self.collect(now)
+        if len(data) < _header.size:
+            return None
+        magic, message_id, index, count, length, crc = _header.unpack_from(data)
+        if index >= count:
+            return None
+        key = (source, message_id)
+        entry = self._pending.get(key)
+        # A fragment of another message under the same id starts over
+        if entry is None or entry[1] != (count, length, crc):
+            entry = [now, (count, length, crc), {}]
+            self._pending[key] = entry
+        entry[2][index] = data[_header.size:]
+        if len(entry[2]) < count:
+            return None
+        del self._pending[key]
+        message = ''.join(entry[2][i] for i in xrange(count))
+        if len(message) != length or zlib.crc32(message) & 0xffffffff != crc:
+            return None
+        return message
+
+    def collect(self, now=None):
+        """
+        Drop incomplete messages older than the timeout
+        """
+        if now is None:
+            now = self._clock()
+        for key in [k for k, entry in self._pending.iteritems() if now - entry[0] > self._timeout]:
+            del self._pending[key]
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+def isChunk(data):
+    return data[:len(CHUNK_MAGIC)] == CHUNK_MAGIC
+
+def encodeChunk(snapshot, index, data):
+    """
+    Return a file chunk message
+    """
+    return _chunk_header.pack(CHUNK_MAGIC, snapshot, index, zlib.crc32(data) & 0xffffffff) + data
+
+def decodeChunk(message):
+    """
+    Return snapshot id, chunk index and data of a file chunk message, raises
+    ValueError if the data is damaged
+    """
+    if len(message) < _chunk_header.size or not isChunk(message):
+        raise ValueError("Not a file chunk")
+    magic, snapshot, index, crc = _chunk_header.unpack_from(message)
+    data = message[_chunk_header.size:]
+    if zlib.crc32(data) & 0xffffffff != crc:
+        raise ValueError("Chunk %d failed checksum" % index)
+    return snapshot, index, data
@@ -0,0 +1,157 @@
+# Detector controller for gamma measurements
+# Copyright (C) 2016  Norwegain Radiation Protection Authority
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Dag Robole,
+
+# Binary spectrum messages
+#
+# A binary message starts with a fixed little-endian header followed by the
+# session name, the time string, the detector id and the channel data:
+#
+#   magic 'GC', version, message type, flags, name length, time length,
+#   detector id length, index, detector index, num_channels, channel data length,
+#   latitude, latitude_error, longitude, longitude_error, altitude, altitude_error,
+#   track, track_error, speed, speed_error, climb, climb_error,
+#   livetime, realtime, total_count
+#
+# Channel data are uint32 little-endian counts, zlib compressed if FLAG_ZLIB
+# is set. Messages that do not start with MAGIC are JSON.
+
+import json, struct, zlib
+import gc_channels as channels
+
+MAGIC = 'GC'
+VERSION = 2
+
+MSG_SPECTRUM = 1
+
+FLAG_ZLIB = 0x01
+
+# Wire formats a client can ask for with 'wire_format'
+FORMAT_JSON = 'json'
+FORMAT_BINARY = 'binary'
+FORMAT_BINARY_ZLIB = 'binary_zlib'
+
+FORMATS = (FORMAT_JSON, FORMAT_BINARY, FORMAT_BINARY_ZLIB)
+
+_header = struct.Struct('<2sBBBBBBIIII14dQ')
+
+_gps_fields = ('latitude', 'latitude_error', 'longitude', 'longitude_error', 'altitude', 'altitude_error',
+        'track', 'track_error', 'speed', 'speed_error', 'climb', 'climb_error')
+
+def encodeSpectrum(msg, compress=False):
+    """
+    Encode a spectrum message in the binary format
+    """
+    session_name = msg['session_name'].encode('utf-8')
+    time_str = str(msg['time'])
+    detector_id = (msg.get('detector_id') or u'').encode('utf-8')
+    data = str(channels.pack(msg['channels'], channels.FORMAT_UINT32))
+    flags = 0
+    if compress:
+        data = zlib.compress(data, 1)
+        flags |= FLAG_ZLIB
+    header = _header.pack(MAGIC, VERSION, MSG_SPECTRUM, flags, len(session_name), len(time_str), len(detector_id),
+            msg['index'], msg.get('detector_index') or 0, msg['num_channels'], len(data),
+            *([float(msg[f]) for f in _gps_fields] + [float(msg['livetime']), float(msg['realtime']), int(msg['total_count'])]))
+    return header + session_name + time_str + detector_id + data
+
+def decodeSpectrum(data):
+    """
+    Decode a binary spectrum message to a spectrum dictionary
+    """
+    fields = _header.unpack_from(data)
+    magic, version, msgtype, flags, name_len, time_len, id_len, index, detector_index, num_channels, data_len = fields[:11]
+    if magic != MAGIC or msgtype != MSG_SPECTRUM:
+        raise ValueError("Not a binary spectrum message")
+    if version != VERSION:
+        raise ValueError("Unsupported binary message version %d" % version)
+    offset = _header.size
+    session_name = data[offset:offset + name_len].decode('utf-8')
+    offset += name_len
+    time_str = data[offset:offset + time_len]
+    offset += time_len
+    detector_id = data[offset:offset + id_len].decode('utf-8')
+    offset += id_len
+    counts = data[offset:offset + data_len]
+    if len(counts) != data_len:
+        raise ValueError("Binary spectrum message is truncated")
+    if flags & FLAG_ZLIB:
+        counts = zlib.decompress(counts)
+    msg = dict(zip(_gps_fields, fields[11:23]))
+    msg.update({
+        'command': 'spectrum',
+        'session_name': session_name,
+        'index': index,
+        'time': time_str,
+        'livetime': fields[23],
+        'realtime': fields[24],
+        'total_count': fields[25],
+        'num_channels': num_channels,
+        'channels': channels.unpack(counts, channels.FORMAT_UINT32)
+    })
+    # Spectrums of sessions from before there were several detectors have
+    # no detector id
+    if detector_id:
+        msg['detector_id'] = detector_id
+        msg['detector_index'] = detector_index
+    return msg
+
+def isBinary(data):
+    return data[:len(MAGIC)] == MAGIC
+
+def encode(msg, wire_format=FORMAT_JSON):
+    """
+    Encode a message, spectrums use the binary format if requested
+    """
+    if wire_format != FORMAT_JSON and msg.get('command') == 'spectrum':
+        return encodeSpectrum(msg, wire_format == FORMAT_BINARY_ZLIB)
+    return bytes(json.dumps(msg, default=channels.toText))
+
+def decode(data):
+    """
+    Decode a JSON or binary message
+    """
+    if isBinary(data):
+        return decodeSpectrum(data)
+    return json.loads(data.decode("utf-8"))
+
+if __name__ == "__main__":
+
+    # Compare encode/decode throughput and message size of the wire formats
+    import sys, random, time
+
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    random.seed(0)
+    for num_channels in (1024, 4096, 8192):
+        msg = {'command': 'spectrum', 'session_name': '01012000_121212', 'index': 1234,
+                'time': '2016-01-01T12:12:12.000Z', 'livetime': 2.0, 'realtime': 2.01, 'total_count': 0,
+                'num_channels': num_channels,
+                'channels': channels.toArray([int(random.expovariate(1.0 / 20.0)) for i in xrange(num_channels)])}
+        for f in _gps_fields:
+            msg[f] = random.random() * 100.0
+        for wire_format in FORMATS:
+            t0 = time.time()
+            for i in xrange(iterations):
+                data = encode(msg, wire_format)
+            t1 = time.time()
+            for i in xrange(iterations):
+                decode(data)
+            t2 = time.time()
+            print("%5d channels %-12s %6d bytes %9.0f encodes/s %9.0f decodes/s" % (num_channels, wire_format, len(data),
+                iterations / (t1 - t0), iterations / (t2 - t1)))
@@ -18,115 +18,206 @@
 # Authors: Dag Robole,
 
 import sys, time
+from array import array
 from ctypes import *
+from gc_channels import UINT32
+import gc_plugin as plugin
+from gc_plugin import waitForAcquisition
 from gc_exceptions import ProtocolError
 
 TOTAL_RESULT_CHANNELS = 4096
 
-_so = CDLL('/usr/lib/libSpectrometerDriver.so')
-
-_so.kr_Initialise.argtypes = [c_void_p, c_void_p]
-_so.kr_Initialise.restype = c_int
-_so.kr_GetNextDetector.argtypes = [c_uint]
-_so.kr_GetNextDetector.restype = c_uint
-_so.kr_GetDeviceSerial.argtypes = [c_uint, POINTER(c_char), c_int, POINTER(c_int)]
-_so.kr_GetDeviceSerial.restype = c_int
-_so.kr_ClearAcquiredData.argtypes = [c_uint]
-_so.kr_ClearAcquiredData.restype = c_int
-_so.kr_BeginDataAcquisition.argtypes = [c_uint, c_uint, c_uint]
-_so.kr_BeginDataAcquisition.restype = c_int
-_so.kr_IsAcquiringData.argtypes = [c_uint]
-_so.kr_IsAcquiringData.restype = c_int
-_so.kr_GetAcquiredDataEx.argtypes = [c_uint, POINTER(c_uint), POINTER(c_uint), POINTER(c_uint), POINTER(c_uint), c_uint]
-_so.kr_GetAcquiredDataEx.restype = c_int
-
-_did = c_uint(0)
-
-def _setDetector(serialname):
-    global _did
-    _did = c_uint(0)
-
-    serial = (c_char * 200)()
-    serial_size = c_int(0)
-    while True:
-        _did = _so.kr_GetNextDetector(_did)
-        if _did == 0:
-            break
-
-        _so.kr_GetDeviceName(_did, serial, 200, byref(serial_size))
-        if serial.value == serialname:
-            print "Using detector %s\n" % (serial.value)
-            return
-
-    raise ProtocolError('detector_config_error', "Detector not found: %s" % (serialname))
+LIBRARY_PATH = '/usr/lib/libSpectrometerDriver.so'
+
+_so = None # Driver library, loaded by initializePlugin
+
+def _load(library=None):
+    global _so
+    so = library if library is not None else CDLL(LIBRARY_PATH)
+    so.kr_Initialise.argtypes = [c_void_p, c_void_p]
+    so.kr_Initialise.restype = c_int
+    so.kr_GetNextDetector.argtypes = [c_uint]
+    so.kr_GetNextDetector.restype = c_uint
+    so.kr_GetDeviceSerial.argtypes = [c_uint, POINTER(c_char), c_int, POINTER(c_int)]
+    so.kr_GetDeviceSerial.restype = c_int
+    so.kr_ClearAcquiredData.argtypes = [c_uint]
+    so.kr_ClearAcquiredData.restype = c_int
+    so.kr_BeginDataAcquisition.argtypes = [c_uint, c_uint, c_uint]
+    so.kr_BeginDataAcquisition.restype = c_int
+    so.kr_IsAcquiringData.argtypes = [c_uint]
+    so.kr_IsAcquiringData.restype = c_int
+    so.kr_GetAcquiredDataEx.argtypes = [c_uint, POINTER(c_uint), POINTER(c_uint), POINTER(c_uint), POINTER(c_uint), c_uint]
+    so.kr_GetAcquiredDataEx.restype = c_int
+    so.kr_StopDataAcquisition.argtypes = [c_uint]
+    so.kr_StopDataAcquisition.restype = c_int
+    _so = so
 
 def initializePlugin():
+    if _so is None:
+        _load()
     _so.kr_Initialise(c_void_p(None), c_void_p(None))
 
 def finalizePlugin():
-    _so.kr_Destruct()
-
-def initializeDetector(config):
-    global _did
-
-    if set(config) < set(('serialnumber', 'voltage', 'lld')):
-        raise ProtocolError('detector_config_error', "Unable to initialize detector: missing configuration items")
-
-    _setDetector(config['serialnumber'])
-
-def finalizeDetector(config):
-    pass
-
-def initializeSession(config):
-    pass
-
-def finalizeSession(config):
-    pass
-
-def acquireSpectrum(args):
-    global _did
-
-    if set(args) < set(('session_name', 'livetime')):
-        raise ProtocolError('error', "Unable to acquire spectrum: Missing arguments")
-
-    if _did == 0:
-        raise ProtocolError('error', "Unable to acquire spectrum: Invalid detector id")
-
-    lt = int(args['livetime'] * 1000.0)
-    # _so.kr_ClearAcquiredData(_did)
-    _so.kr_BeginDataAcquisition(_did, c_uint(0), c_uint(lt))
-
-    while _so.kr_IsAcquiringData(_did):
-        time.sleep(0.1)
-
-    total_count = c_uint(0)
-    livetime = c_uint(0)
-    realtime = c_uint(0)
-    spectrum = (c_uint * TOTAL_RESULT_CHANNELS)()
-    flags = c_uint(1)
-    _so.kr_GetAcquiredDataEx(_did, spectrum, byref(total_count), byref(realtime), byref(livetime), flags)
-
-    # Add spectrum data to response message
-    msg = {
-        'command': 'spectrum',
-        'session_name': args['session_name'],
-        'channels': ' '.join(map(str, spectrum)),
-        'num_channels': TOTAL_RESULT_CHANNELS,
-        'total_count': int(total_count.value),
-        'livetime': float(livetime.value) * 1000.0,
-        'realtime': float(realtime.value) * 1000.0
-    }
-
-    return msg
+    if _so is not None:
+        _so.kr_Destruct()
+
+class Detector(plugin.Detector):
+    """
+    One Kromek detector, found by its serial number
+    """
+    def __init__(self, detector_id):
+        plugin.Detector.__init__(self, detector_id)
+        self._did = c_uint(0)
+        self._armed = False # True while an acquisition is running
+        self._expected_end = 0.0 # Earliest time the running acquisition can complete
+
+        # Acquisition buffers, reused for every spectrum
+        self._spectrum = (c_uint * TOTAL_RESULT_CHANNELS)()
+        self._total_count = c_uint(0)
+        self._livetime = c_uint(0)
+        self._realtime = c_uint(0)
+
+    def _setDetector(self, serialname):
+        # Detectors are enumerated by the driver, several can be connected
+        did = 0
+        serial = (c_char * 200)()
+        serial_size = c_int(0)
+        while True:
+            did = _so.kr_GetNextDetector(did)
+            if did == 0:
+                break
+
+            _so.kr_GetDeviceName(did, serial, 200, byref(serial_size))
+            if serial.value == serialname:
+                print "Using detector %s\n" % (serial.value)
+                self._did = c_uint(did)
+                return
+
+        raise ProtocolError('detector_config_error', "Detector not found: %s" % (serialname))
+
+    def initializeDetector(self, config):
+
+        if set(config) < set(('serialnumber', 'voltage', 'lld')):
+            raise ProtocolError('detector_config_error', "Unable to initialize detector: missing configuration items")
+
+        self._setDetector(config['serialnumber'])
+
+    def initializeSession(self, args):
+        self._armed = False
+
+    def finalizeSession(self, args):
+        if self._armed:
+            _so.kr_StopDataAcquisition(self._did)
+            self._armed = False
+
+    def _startAcquisition(self, livetime):
+        # _so.kr_ClearAcquiredData(self._did)
+        _so.kr_BeginDataAcquisition(self._did, c_uint(0), c_uint(int(livetime * 1000.0)))
+        self._expected_end = time.time() + float(livetime)
+        self._armed = True
+
+    def _readSpectrum(self):
+        # The buffer is overwritten by the next acquisition, which may start
+        # before this spectrum is stored, so the channels are copied out with a
+        # single memcpy instead of converting each count to a Python integer
+        _so.kr_GetAcquiredDataEx(self._did, self._spectrum, byref(self._total_count), byref(self._realtime),
+                byref(self._livetime), c_uint(1))
+        channels = array(UINT32)
+        channels.fromstring(buffer(self._spectrum))
+        return channels
+
+    def acquireSpectrum(self, args):
+
+        if set(args) < set(('session_name', 'livetime')):
+            raise ProtocolError('error', "Unable to acquire spectrum: Missing arguments")
+
+        if self._did.value == 0:
+            raise ProtocolError('error', "Unable to acquire spectrum: Invalid detector id")
+
+        if not self._armed:
+            self._startAcquisition(args['livetime'])
+
+        waitForAcquisition(lambda: _so.kr_IsAcquiringData(self._did), self._expected_end)
+
+        self._armed = False
+
+        channels = self._readSpectrum()
+
+        # Arm the next acquisition before handing this spectrum over
+        if args.get('pipelined', False):
+            self._startAcquisition(args['livetime'])
+
+        # Add spectrum data to response message
+        msg = {
+            'command': 'spectrum',
+            'session_name': args['session_name'],
+            'channels': channels,
+            'num_channels': TOTAL_RESULT_CHANNELS,
+            'total_count': int(self._total_count.value),
+            'livetime': float(self._livetime.value) / 1000.0,
+            'realtime': float(self._realtime.value) / 1000.0
+        }
+
+        return msg
+
+class _StubFunction(object):
+    # Callable taking argtypes and restype like a library function
+    def __init__(self, f):
+        self._f = f
+
+    def __call__(self, *args):
+        return self._f(*args)
+
+class _StubLibrary(object):
+    """
+    Driver library stand-in that returns a fixed spectrum at once
+    """
+    def __init__(self):
+        counts = (c_uint * TOTAL_RESULT_CHANNELS)(*[(i * 7919) % 251 for i in xrange(TOTAL_RESULT_CHANNELS)])
+        def getAcquiredData(did, spectrum, total_count, realtime, livetime, flags):
+            memmove(spectrum, counts, sizeof(counts))
+            return 0
+        for name in ('kr_Initialise', 'kr_Destruct', 'kr_GetNextDetector', 'kr_GetDeviceSerial', 'kr_ClearAcquiredData',
+                'kr_BeginDataAcquisition', 'kr_IsAcquiringData', 'kr_StopDataAcquisition'):
+            setattr(self, name, _StubFunction(lambda *args: 0))
+        self.kr_GetAcquiredDataEx = _StubFunction(getAcquiredData)
+
+def _benchmark(iterations):
+
+    # Per spectrum readout cost with a new buffer converted count by count,
+    # as before, and with the reused buffer copied out in one piece
+    _load(_StubLibrary())
+    detector = Detector('benchmark')
+    detector._did = c_uint(1)
+
+    def allocateAndConvert():
+        total_count, livetime, realtime = c_uint(0), c_uint(0), c_uint(0)
+        spectrum = (c_uint * TOTAL_RESULT_CHANNELS)()
+        _so.kr_GetAcquiredDataEx(detector._did, spectrum, byref(total_count), byref(realtime), byref(livetime), c_uint(1))
+        return array(UINT32, spectrum)
+
+    assert allocateAndConvert() == detector._readSpectrum()
+    for name, f in (('new buffer, per count', allocateAndConvert), ('reused buffer, memcpy', detector._readSpectrum)):
+        t0 = time.time()
+        for i in xrange(iterations):
+            f()
+        print "%-22s %8.1f us/spectrum" % (name, (time.time() - t0) * 1e6 / iterations)
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ['benchmark']:
+        _benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 2000)
+        sys.exit(0)
+
     try:
         initializePlugin()
+        detector = Detector('kromek')
         config = {'serialnumber':'GR1A', 'voltage':700, 'lld':32}
-        initializeDetector(config)
+        detector.initializeDetector(config)
 
         args = {'session_name':'01012000_121212', 'livetime':2}
-        msg = acquireSpectrum(args)
+        detector.initializeSession(args)
+        msg = detector.acquireSpectrum(args)
+        detector.finalizeSession(args)
 
         print msg
 
@@ -18,6 +18,10 @@
 # Authors: Dag Robole,
 
 import os, sys, time
+from array import array
+from gc_channels import UINT32
+import gc_plugin as plugin
+from gc_plugin import waitForAcquisition
 from gc_exceptions import ProtocolError
 
 # Import API for the detector
@@ -30,10 +34,11 @@ from CommandCodes import *
 from ParameterTypes import *
 from PhaData import *
 
-_detector_interface_ip = '10.0.1.4'
+# Defaults for detector configuration items ip and input
+DETECTOR_INTERFACE_IP = '10.0.1.4'
+DETECTOR_INPUT = 1
+
 _detector_group = 1
-_detector_input = 1
-_detector = None
 
 def initializePlugin():
 	pass
@@ -41,102 +46,142 @@ def initializePlugin():
 def finalizePlugin():
 	pass
 
-def initializeDetector(config):
-
-    if set(config) < set(('voltage', 'coarse_gain', 'fine_gain', 'num_channels', 'lld', 'uld')):
-        raise ProtocolError('detector_config_error', "Unable to initialize detector: missing configuration items")
-
-    # Create and acquire detector
-    global _detector
-    _detector = DeviceFactory.createInstance(DeviceFactory.DeviceInterface.IDevice)
-    _detector.open("", _detector_interface_ip)
-    _detector.lock('administrator', 'password', _detector_input)
-
-    # Osprey API constants
-    Stabilized_Probe_Busy = 0x00080000
-    Stabilized_Probe_OK = 0x00100000
-
-    # Set voltage
-    probe_status = _detector.getParameter(ParameterCodes.Input_Status, _detector_input)
-    if((probe_status & Stabilized_Probe_OK) != Stabilized_Probe_OK):
-        _detector.setParameter(ParameterCodes.Input_Voltage, int(config['voltage']), _detector_input)
-        _detector.setParameter(ParameterCodes.Input_VoltageStatus, True, _detector_input)
-        # Wait until ramping is complete
-        while(_detector.getParameter(ParameterCodes.Input_VoltageRamping, _detector_input) is True):
-            time.sleep(0.4)
-
-    # Set infinite session timeout
-    _detector.setParameter(ParameterCodes.Configuration_SessionTimeout, 0, _detector_input)
-
-    # Set gain levels and discriminators
-    _detector.setParameter(ParameterCodes.Input_CoarseGain, float(config['coarse_gain']), _detector_input) # [1.0, 2.0, 4.0, 8.0]
-    _detector.setParameter(ParameterCodes.Input_FineGain, float(config['fine_gain']), _detector_input) # [1.0, 5.0]
-    _detector.setParameter(ParameterCodes.Input_NumberOfChannels, int(config['num_channels']), _detector_input)
-    _detector.setParameter(ParameterCodes.Input_LLDmode, 1, _detector_input) # Set manual LLD mode
-    _detector.setParameter(ParameterCodes.Input_LLD, float(config['lld']), _detector_input)
-    _detector.setParameter(ParameterCodes.Input_ULD, float(config['uld']), _detector_input)
-
-def finalizeDetector(config):
-    pass
-
-def initializeSession(config):
-    pass
-
-def finalizeSession(config):
-    pass
-
-def acquireSpectrum(args):
-
-    if set(args) < set(('session_name', 'livetime')):
-        raise ProtocolError('error', "Unable to acquire spectrum: Missing arguments")
-
-    # Reset acquisition
-    _detector.control(CommandCodes.Stop, _detector_input)
-    _detector.control(CommandCodes.Abort, _detector_input)
-    _detector.setParameter(ParameterCodes.Input_SCAstatus, 0, _detector_input)
-    _detector.setParameter(ParameterCodes.Counter_Status, 0, _detector_input)
-    _detector.setParameter(ParameterCodes.Input_Mode, 0, _detector_input)
-    _detector.setParameter(ParameterCodes.Preset_Options, 1, _detector_input)
-    _detector.control(CommandCodes.Clear, _detector_input)
-    _detector.setParameter(ParameterCodes.Input_CurrentGroup, _detector_group, _detector_input)
-
-    # Setup presets
-    _detector.setParameter(ParameterCodes.Preset_Live, float(args['livetime']), _detector_input)
-    # Clear data and time
-    _detector.control(CommandCodes.Clear, _detector_input)
-    # Start the acquisition
-    _detector.control(CommandCodes.Start, _detector_input)
-
-    while True:
-        sd = _detector.getSpectralData(_detector_input, _detector_group)
-        if ((0 == (StatusBits.Busy & sd.getStatus())) and (0 == (StatusBits.Waiting & sd.getStatus()))):
-            break
-        time.sleep(0.1)
-
-    # Extract spectrum from detector
-    channels = sd.getSpectrum().getCounts()
-
-    # Add spectrum data to response message
-    msg = {
-        'command': 'spectrum',
-        'session_name': args['session_name'],
-        'channels': ' '.join(map(str, channels)),
-        'num_channels': len(channels),
-        'total_count': sum(channels),
-        'livetime': sd.getLiveTime(),
-        'realtime': sd.getRealTime()
-    }
-
-    return msg
+class Detector(plugin.Detector):
+    """
+    One Osprey detector, reached at its interface IP address
+    """
+    def __init__(self, detector_id):
+        plugin.Detector.__init__(self, detector_id)
+        self._detector = None
+        self._input = DETECTOR_INPUT
+        self._armed = False # True while an acquisition is running
+        self._expected_end = 0.0 # Earliest time the running acquisition can complete
+
+    def initializeDetector(self, config):
+
+        if set(config) < set(('voltage', 'coarse_gain', 'fine_gain', 'num_channels', 'lld', 'uld')):
+            raise ProtocolError('detector_config_error', "Unable to initialize detector: missing configuration items")
+
+        # Create and acquire detector
+        self._input = int(config.get('input', DETECTOR_INPUT))
+        detector = DeviceFactory.createInstance(DeviceFactory.DeviceInterface.IDevice)
+        detector.open("", str(config.get('ip', DETECTOR_INTERFACE_IP)))
+        detector.lock('administrator', 'password', self._input)
+        self._detector = detector
+
+        # Osprey API constants
+        Stabilized_Probe_Busy = 0x00080000
+        Stabilized_Probe_OK = 0x00100000
+
+        # Set voltage
+        probe_status = detector.getParameter(ParameterCodes.Input_Status, self._input)
+        if((probe_status & Stabilized_Probe_OK) != Stabilized_Probe_OK):
+            detector.setParameter(ParameterCodes.Input_Voltage, int(config['voltage']), self._input)
+            detector.setParameter(ParameterCodes.Input_VoltageStatus, True, self._input)
+            # Wait until ramping is complete
+            while(detector.getParameter(ParameterCodes.Input_VoltageRamping, self._input) is True):
+                time.sleep(0.4)
+
+        # Set infinite session timeout
+        detector.setParameter(ParameterCodes.Configuration_SessionTimeout, 0, self._input)
+
+        # Set gain levels and discriminators
+        detector.setParameter(ParameterCodes.Input_CoarseGain, float(config['coarse_gain']), self._input) # [1.0, 2.0, 4.0, 8.0]
+        detector.setParameter(ParameterCodes.Input_FineGain, float(config['fine_gain']), self._input) # [1.0, 5.0]
+        detector.setParameter(ParameterCodes.Input_NumberOfChannels, int(config['num_channels']), self._input)
+        detector.setParameter(ParameterCodes.Input_LLDmode, 1, self._input) # Set manual LLD mode
+        detector.setParameter(ParameterCodes.Input_LLD, float(config['lld']), self._input)
+        detector.setParameter(ParameterCodes.Input_ULD, float(config['uld']), self._input)
+
+    def initializeSession(self, args):
+
+        if set(args) < set(('session_name', 'livetime')):
+            raise ProtocolError('error', "Unable to initialize session: Missing arguments")
+
+        self._armed = False
+
+        # Reset acquisition
+        detector = self._detector
+        detector.control(CommandCodes.Stop, self._input)
+        detector.control(CommandCodes.Abort, self._input)
+        detector.setParameter(ParameterCodes.Input_SCAstatus, 0, self._input)
+        detector.setParameter(ParameterCodes.Counter_Status, 0, self._input)
+        detector.setParameter(ParameterCodes.Input_Mode, 0, self._input)
+        detector.setParameter(ParameterCodes.Preset_Options, 1, self._input)
+        detector.control(CommandCodes.Clear, self._input)
+        detector.setParameter(ParameterCodes.Input_CurrentGroup, _detector_group, self._input)
+
+        # Setup presets
+        detector.setParameter(ParameterCodes.Preset_Live, float(args['livetime']), self._input)
+
+    def finalizeSession(self, args):
+
+        if self._armed:
+            self._detector.control(CommandCodes.Stop, self._input)
+            self._detector.control(CommandCodes.Abort, self._input)
+            self._armed = False
+
+    def _startAcquisition(self, livetime):
+
+        # Clear data and time
+        self._detector.control(CommandCodes.Clear, self._input)
+        # Start the acquisition
+        self._detector.control(CommandCodes.Start, self._input)
+        self._expected_end = time.time() + float(livetime)
+        self._armed = True
+
+    def acquireSpectrum(self, args):
+
+        if set(args) < set(('session_name', 'livetime')):
+            raise ProtocolError('error', "Unable to acquire spectrum: Missing arguments")
+
+        if not self._armed:
+            self._startAcquisition(args['livetime'])
+
+        # Live time can not pass faster than real time, so there is no point
+        # asking the detector for data before the preset has had time to expire
+        data = []
+        def busy():
+            sd = self._detector.getSpectralData(self._input, _detector_group)
+            data[:] = [sd]
+            return (0 != (StatusBits.Busy & sd.getStatus())) or (0 != (StatusBits.Waiting & sd.getStatus()))
+
+        waitForAcquisition(busy, self._expected_end)
+        sd = data[0]
+
+        self._armed = False
+
+        # Extract spectrum from detector
+        channels = array(UINT32, sd.getSpectrum().getCounts())
+
+        # Arm the next acquisition before handing this spectrum over
+        if args.get('pipelined', False):
+            self._startAcquisition(args['livetime'])
+
+        # Add spectrum data to response message
+        msg = {
+            'command': 'spectrum',
+            'session_name': args['session_name'],
+            'channels': channels,
+            'num_channels': len(channels),
+            'total_count': sum(channels),
+            'livetime': sd.getLiveTime(),
+            'realtime': sd.getRealTime()
+        }
+
+        return msg
 
 if __name__ == "__main__":
     try:
         initializePlugin()
+        detector = Detector('osprey')
         config = {'voltage':650, 'coarse_gain':1.0, 'fine_gain':1.15, 'num_channels':1024, 'lld':3, 'uld':110}
-        initializeDetector(config)
+        detector.initializeDetector(config)
 
         args = {'session_name':'01012001_121212', 'livetime':2}
-        msg = acquireSpectrum(args)
+        detector.initializeSession(args)
+        msg = detector.acquireSpectrum(args)
+        detector.finalizeSession(args)
 
         print msg
 
@@ -144,4 +189,3 @@ if __name__ == "__main__":
         print "Exception", err
     finally:
         finalizePlugin()
-
@@ -0,0 +1,209 @@
+# Simulated detector plugin for load testing
+# Copyright (C) 2016  Norwegain Radiation Protection Authority
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Authors: Dag Robole,
+
+# Detector configuration items, all optional:
+#
+#   num_channels  Number of channels, default 1024
+#   count_rate    Mean counts per second over the whole spectrum, default 2000
+#   peaks         List of {'channel', 'fwhm', 'fraction'} dictionaries. Channel
+#                 and fwhm are in channels, fraction is the share of all counts
+#                 in the peak. Default is a Cs-137 and a K-40 like peak
+#   dead_time     Dead time per count in seconds, default 5e-6
+#   time_scale    Run this many times faster than real time, default 1. The
+#                 livetime and realtime reported are the scaled times the
+#                 acquisition took, and the counts are those of the scaled
+#                 livetime, so count rates stay those configured
+#   seed          Random seed, default 0
+#   fail_every    Make every n-th acquisition fail, default 0 (never)
+
+import math, random, time, bisect
+from array import array
+from gc_channels import UINT32
+import gc_plugin as plugin
+from gc_plugin import waitForAcquisition
+from gc_exceptions import ProtocolError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def _defaultPeaks(num_channels):
+    return [
+        {'channel': 0.33 * num_channels, 'fwhm': 0.025 * num_channels, 'fraction': 0.08},
+        {'channel': 0.73 * num_channels, 'fwhm': 0.04 * num_channels, 'fraction': 0.03}
+    ]
+
+def _spectrumShape(num_channels, peaks):
+    # Exponential continuum with gaussian peaks on top, normalized to 1
+    continuum = [math.exp(-5.0 * i / num_channels) for i in xrange(num_channels)]
+    scale = (1.0 - sum(p['fraction'] for p in peaks)) / sum(continuum)
+    shape = [c * scale for c in continuum]
+    for p in peaks:
+        sigma = max(float(p['fwhm']) / 2.355, 0.5)
+        weights = [math.exp(-0.5 * ((i - float(p['channel'])) / sigma) ** 2) for i in xrange(num_channels)]
+        total = sum(weights)
+        if total > 0.0:
+            for i in xrange(num_channels):
+                shape[i] += float(p['fraction']) * weights[i] / total
+    return shape
+
+def initializePlugin():
+    pass
+
+def finalizePlugin():
+    pass
+
+class Detector(plugin.Detector):
+    """
+    Simulated detector, each instance has its own random stream
+    """
+    def __init__(self, detector_id):
+        plugin.Detector.__init__(self, detector_id)
+        self._config = None
+        self._random = None
+        self._numpy_random = None
+        self._cdf = None # Cumulative channel probabilities
+        self._shape = None # Channel probabilities
+        self._acquisitions = 0
+        self._armed = False # True while an acquisition is running
+        self._expected_end = 0.0 # Time the running acquisition completes
+        self._realtime = 0.0
+
+    def initializeDetector(self, config):
+
+        num_channels = int(config.get('num_channels', 1024))
+        if num_channels < 1:
+            raise ProtocolError('detector_config_error', "Unable to initialize detector: invalid number of channels")
+        if float(config.get('time_scale', 1.0)) <= 0.0:
+            raise ProtocolError('detector_config_error', "Unable to initialize detector: invalid time scale")
+
+        self._config = {
+            'num_channels': num_channels,
+            'count_rate': float(config.get('count_rate', 2000.0)),
+            'dead_time': float(config.get('dead_time', 5e-6)),
+            'time_scale': float(config.get('time_scale', 1.0)),
+            'fail_every': int(config.get('fail_every', 0))
+        }
+        seed = int(config.get('seed', 0))
+        self._random = random.Random(seed)
+        self._numpy_random = numpy.random.RandomState(seed) if numpy is not None else None
+        self._shape = _spectrumShape(num_channels, config.get('peaks', _defaultPeaks(num_channels)))
+        self._cdf = []
+        total = 0.0
+        for p in self._shape:
+            total += p
+            self._cdf.append(total)
+        self._acquisitions = 0
+
+    def initializeSession(self, args):
+        self._armed = False
+
+    def finalizeSession(self, args):
+        self._armed = False
+
+    def _startAcquisition(self, livetime):
+        # Dead time stretches real time beyond the requested live time
+        self._realtime = float(livetime) * (1.0 + self._config['count_rate'] * self._config['dead_time'])
+        self._expected_end = time.time() + self._realtime / self._config['time_scale']
+        self._armed = True
+
+    def _poisson(self, mean):
+        # Knuth for small means, normal approximation for large ones
+        if mean > 50.0:
+            return max(0, int(round(self._random.gauss(mean, math.sqrt(mean)))))
+        limit = math.exp(-mean)
+        k = 0
+        p = self._random.random()
+        while p > limit:
+            k += 1
+            p *= self._random.random()
+        return k
+
+    def _generateChannels(self, livetime):
+        expected = self._config['count_rate'] * float(livetime)
+        if self._numpy_random is not None:
+            counts = self._numpy_random.poisson(numpy.array(self._shape) * expected).astype('<u4')
+            channels = array(UINT32)
+            channels.fromstring(counts.tostring())
+            return channels
+        # A Poisson distributed total spread over the channels is equivalent to
+        # independent Poisson counts per channel
+        channels = array(UINT32, [0] * self._config['num_channels'])
+        last = len(self._cdf) - 1
+        for n in xrange(self._poisson(expected)):
+            channels[min(bisect.bisect(self._cdf, self._random.random() * self._cdf[-1]), last)] += 1
+        return channels
+
+    def acquireSpectrum(self, args):
+
+        if set(args) < set(('session_name', 'livetime')):
+            raise ProtocolError('error', "Unable to acquire spectrum: Missing arguments")
+
+        if self._config is None:
+            raise ProtocolError('error', "Unable to acquire spectrum: Detector not initialized")
+
+        if not self._armed:
+            self._startAcquisition(args['livetime'])
+
+        waitForAcquisition(lambda: time.time() < self._expected_end, self._expected_end)
+        self._armed = False
+        realtime = self._realtime / self._config['time_scale']
+        livetime = float(args['livetime']) / self._config['time_scale']
+
+        self._acquisitions += 1
+        if self._config['fail_every'] > 0 and self._acquisitions % self._config['fail_every'] == 0:
+            raise ProtocolError('error', "Simulated acquisition failure %d" % self._acquisitions)
+
+        channels = self._generateChannels(livetime)
+
+        # Arm the next acquisition before handing this spectrum over
+        if args.get('pipelined', False):
+            self._startAcquisition(args['livetime'])
+
+        msg = {
+            'command': 'spectrum',
+            'session_name': args['session_name'],
+            'channels': channels,
+            'num_channels': len(channels),
+            'total_count': sum(channels),
+            'livetime': livetime,
+            'realtime': realtime
+        }
+
+        return msg
+
+if __name__ == "__main__":
+    try:
+        initializePlugin()
+        detector = Detector('simulated')
+        config = {'num_channels':1024, 'count_rate':5000, 'time_scale':10}
+        detector.initializeDetector(config)
+
+        args = {'session_name':'01012000_121212', 'livetime':2}
+        detector.initializeSession(args)
+        msg = detector.acquireSpectrum(args)
+        detector.finalizeSession(args)
+
+        print("total_count %d in %d channels" % (msg['total_count'], msg['num_channels']))
+
+    except ProtocolError as err:
+        print("Exception %s" % err)
+    finally:
+        finalizePlugin()